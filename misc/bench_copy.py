@@ -0,0 +1,104 @@
+#! /usr/bin/env python
+
+"""Measure full_copy() throughput on local PostgreSQL.
+
+Copies table between two databases with single and double
+buffered CopyPipe, and with previous StringIO-based pipe.
+
+Usage: bench_copy.py SRC_CONNSTR DST_CONNSTR [rows]
+
+Creates table bench_copy in both databases.
+"""
+
+import sys, time, os.path
+from cStringIO import StringIO
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '../python'))
+
+import skytools
+import skytools.sqltools
+
+class StringPipe(object):
+    """Previous StringIO-based CopyPipe."""
+    def __init__(self, dstcurs, tablename = None, limit = 512*1024,
+                 sql_from = None, double_buffer = False):
+        self.tablename = tablename
+        self.sql_from = sql_from
+        self.dstcurs = dstcurs
+        self.buf = StringIO()
+        self.limit = limit
+        self.write_hook = None
+        self.flush_hook = None
+        self.total_rows = 0
+        self.total_bytes = 0
+    def write(self, data):
+        self.total_bytes += len(data)
+        self.total_rows += data.count("\n")
+        if self.buf.tell() >= self.limit:
+            pos = data.find('\n')
+            if pos >= 0:
+                self.buf.write(data[:pos + 1])
+                self.flush()
+                data = data[pos + 1:]
+        self.buf.write(data)
+    def flush(self):
+        if self.buf.tell() <= 0:
+            return
+        self.buf.seek(0)
+        self.dstcurs.copy_expert(self.sql_from, self.buf)
+        self.buf.seek(0)
+        self.buf.truncate()
+    def close(self):
+        pass
+
+def setup(src_db, dst_db, rows):
+    q = "create table bench_copy (id int4 primary key, txt text, num numeric, ts timestamptz)"
+    for db in (src_db, dst_db):
+        curs = db.cursor()
+        curs.execute("drop table if exists bench_copy")
+        curs.execute(q)
+        db.commit()
+    curs = src_db.cursor()
+    curs.execute("insert into bench_copy"
+                 " select i, repeat(md5(i::text), 4), i * 1.5, now()"
+                 " from generate_series(1, %s) i", [rows])
+    src_db.commit()
+
+def bench(name, src_db, dst_db, double_buffer = True):
+    dst_curs = dst_db.cursor()
+    dst_curs.execute("truncate bench_copy")
+    dst_db.commit()
+
+    t = time.time()
+    nbytes, nrows = skytools.full_copy('bench_copy', src_db.cursor(), dst_curs,
+                                       double_buffer = double_buffer)
+    dst_db.commit()
+    src_db.commit()
+    dur = time.time() - t
+    print "%-10s %8.3f s  %8.1f MB/s  %10.0f rows/s" % (
+            name, dur, nbytes / dur / (1024*1024), nrows / dur)
+
+def main():
+    if len(sys.argv) < 3:
+        print __doc__
+        sys.exit(1)
+    rows = 1000000
+    if len(sys.argv) > 3:
+        rows = int(sys.argv[3])
+
+    src_db = skytools.connect_database(sys.argv[1])
+    dst_db = skytools.connect_database(sys.argv[2])
+    setup(src_db, dst_db, rows)
+
+    bench('single', src_db, dst_db, False)
+    bench('double', src_db, dst_db, True)
+
+    new_pipe = skytools.sqltools.CopyPipe
+    skytools.sqltools.CopyPipe = StringPipe
+    try:
+        bench('stringio', src_db, dst_db, False)
+    finally:
+        skytools.sqltools.CopyPipe = new_pipe
+
+if __name__ == '__main__':
+    main()
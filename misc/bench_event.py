@@ -0,0 +1,88 @@
+#! /usr/bin/env python
+
+"""Measure per-event overhead of pgq.Event.
+
+Compares event creation and field access on plain tuple rows
+(EventCursor) against previous design, where event wrapped
+DictRow from regular cursor and resolved fields via __getattr__.
+
+Usage: bench_event.py [count]
+"""
+
+import sys, time, os.path
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '../python'))
+
+import skytools
+import skytools.psycopgwrapper
+from pgq.event import Event, EVENT_COLUMNS, _fldmap
+
+_old_fldmap = {}
+for _k, _v in _fldmap.items():
+    _old_fldmap[_k] = 'ev_' + _v
+
+class RowEvent(object):
+    """Previous DictRow-based event."""
+    __slots__ = ('_event_row', 'retry_time', 'queue_name')
+    def __init__(self, queue_name, row):
+        self._event_row = row
+        self.retry_time = 60
+        self.queue_name = queue_name
+    def __getattr__(self, key):
+        return self._event_row[_old_fldmap[key]]
+
+class FakeCursor(object):
+    """Enough of cursor for DictRow constructor."""
+    def __init__(self):
+        self.index = {}
+        for i, k in enumerate(EVENT_COLUMNS):
+            self.index[k] = i
+        self.description = [(k,) for k in EVENT_COLUMNS]
+
+def make_tuples(count):
+    res = []
+    for i in xrange(count):
+        res.append((i, None, 1000 + i, None, 'I:id', 'id=%d&data=foo' % i,
+                    'public.tbl', None, None, None))
+    return res
+
+def make_dictrows(tuples):
+    curs = FakeCursor()
+    res = []
+    for t in tuples:
+        r = skytools.psycopgwrapper._CompatRow(curs)
+        r[:] = t
+        res.append(r)
+    return res
+
+def walk(cls, rows):
+    n = 0
+    for r in rows:
+        ev = cls('q', r)
+        if ev.type and ev.data and ev.extra1:
+            n += ev.id
+    return n
+
+def bench(name, cls, rows, extra = 0):
+    t = time.time()
+    walk(cls, rows)
+    dur = time.time() - t + extra
+    print "%-10s %8.3f s  %6.3f usec/event" % (name, dur, dur * 1000000.0 / len(rows))
+
+def main():
+    count = 1000000
+    if len(sys.argv) > 1:
+        count = int(sys.argv[1])
+
+    tuples = make_tuples(count)
+
+    # row allocation is part of per-event cost
+    t = time.time()
+    dictrows = make_dictrows(tuples)
+    alloc = time.time() - t
+
+    bench('dictrow', RowEvent, dictrows, alloc)
+    bench('compact', Event, tuples)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,92 @@
+#! /usr/bin/env python
+
+"""Measure snapshot visibility checks on catching-up table.
+
+Compares Snapshot.contains() per event and Snapshot.contains_many()
+per fetched block against previous linear scan over xip list.
+Events are spread over txids between xmin and xmax, several
+events per transaction, like in real batch.
+
+Usage: bench_snapshot.py [events] [xip_count ...]
+"""
+
+import sys, time, os.path, random
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '../python'))
+
+from skytools.sqltools import Snapshot
+
+BLOCK = 300
+
+class ListSnapshot(Snapshot):
+    """Previous list-based lookup."""
+    def contains(self, txid):
+        txid = int(txid)
+        if txid < self.xmin:
+            return True
+        if txid >= self.xmax:
+            return False
+        if txid in self.txid_list:
+            return False
+        return True
+
+def make_snapshot(xip_count):
+    xmin = 1000000
+    xmax = xmin + xip_count * 4
+    xip = random.sample(xrange(xmin, xmax), xip_count)
+    xip.append(xmin)
+    xip.sort()
+    return '%d:%d:%s' % (xmin, xmax, ','.join([str(x) for x in xip]))
+
+def make_txids(sn_str, count):
+    sn = Snapshot(sn_str)
+    res = []
+    while len(res) < count:
+        txid = random.randint(sn.xmin - 100, sn.xmax + 100)
+        res.extend([txid] * random.randint(1, 10))
+    return res[:count]
+
+def run_single(sn, txids):
+    n = 0
+    for txid in txids:
+        if not sn.contains(txid):
+            n += 1
+    return n
+
+def run_block(sn, txids):
+    n = 0
+    for i in xrange(0, len(txids), BLOCK):
+        for vis in sn.contains_many(txids[i : i + BLOCK]):
+            if not vis:
+                n += 1
+    return n
+
+def bench(name, func, sn, txids, expect):
+    t = time.time()
+    n = func(sn, txids)
+    dur = time.time() - t
+    if n != expect:
+        raise Exception('%s: bad result: %d != %d' % (name, n, expect))
+    print "  %-8s %8.3f s  %8.3f usec/event" % (name, dur, dur * 1000000.0 / len(txids))
+
+def main():
+    count = 200000
+    sizes = [10, 100, 1000, 5000, 20000]
+    if len(sys.argv) > 1:
+        count = int(sys.argv[1])
+    if len(sys.argv) > 2:
+        sizes = [int(a) for a in sys.argv[2:]]
+
+    for xip_count in sizes:
+        sn_str = make_snapshot(xip_count)
+        txids = make_txids(sn_str, count)
+        old = ListSnapshot(sn_str)
+        expect = run_single(Snapshot(sn_str), txids)
+
+        print "xip=%d" % xip_count
+        bench('list', run_single, old, txids, expect)
+        bench('single', run_single, Snapshot(sn_str), txids, expect)
+        bench('block', run_block, Snapshot(sn_str), txids, expect)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,60 @@
+#! /usr/bin/env python
+
+"""Measure decoding of urlencoded row events.
+
+Compares db_urldecode() per event against decode_urlenc_batch()
+on same list, both for C and Python implementation.
+
+Usage: bench_urldecode.py [events] [columns]
+"""
+
+import sys, time, os.path
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '../python'))
+
+import skytools._pyquoting
+try:
+    import skytools._cquoting
+except ImportError:
+    print "skytools._cquoting not built, testing Python version only"
+    skytools._cquoting = None
+
+def make_rows(count, ncols):
+    rows = []
+    for i in xrange(count):
+        vals = {'id': str(i)}
+        for c in range(ncols - 1):
+            vals['col%d' % c] = 'value %d/%d' % (i, c)
+        rows.append(skytools._pyquoting.db_urlencode(vals))
+    return rows
+
+def per_row(mod, rows):
+    dec = mod.db_urldecode
+    return [dec(r) for r in rows]
+
+def batch(mod, rows):
+    return mod.decode_urlenc_batch(rows)
+
+def bench(name, func, mod, rows):
+    t = time.time()
+    func(mod, rows)
+    dur = time.time() - t
+    print "%-10s %8.3f s  %8.3f usec/event" % (name, dur, dur * 1000000.0 / len(rows))
+
+def main():
+    count = 200000
+    ncols = 10
+    if len(sys.argv) > 1:
+        count = int(sys.argv[1])
+    if len(sys.argv) > 2:
+        ncols = int(sys.argv[2])
+
+    rows = make_rows(count, ncols)
+    if skytools._cquoting:
+        bench('c/row', per_row, skytools._cquoting, rows)
+        bench('c/batch', batch, skytools._cquoting, rows)
+    bench('py/row', per_row, skytools._pyquoting, rows)
+    bench('py/batch', batch, skytools._pyquoting, rows)
+
+if __name__ == '__main__':
+    main()
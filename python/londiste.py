@@ -159,6 +159,14 @@ class Londiste(skytools.DBScript):
                 help="repair: apply fixes automatically")
         g.add_option("--count-only", action="store_true",
                 help="compare: just count rows, do not compare data")
+        g.add_option("--chunked", action="store_true",
+                help="compare: compare by pkey ranges, write differing ranges to file")
+        g.add_option("--ranges", action="store_true",
+                help="repair: check only ranges found by compare --chunked")
+        g.add_option("--stream", action="store_true",
+                help="repair: merge ordered streams, without dump files")
+        g.add_option("--parallel", metavar = "NUM", type = "int", default = 1,
+                help="compare/repair: process NUM tables in parallel")
         p.add_option_group(g)
 
         return p
@@ -0,0 +1,189 @@
+"""Parallel apply of events over several connections.
+
+Tables are grouped so that tables linked with foreign keys
+stay in same lane:
+
+>>> tables = [('public.a', 'public.a'), ('public.b', 'public.b'),
+...           ('public.c', 'public.c'), ('public.d', 'public.dx')]
+>>> fkeys = [('public.b', 'public.a'), ('public.dx', 'public.c'),
+...          ('public.x', 'public.y')]
+>>> m = assign_lanes(tables, fkeys, 2)
+>>> m['public.a'] == m['public.b'], m['public.c'] == m['public.d']
+(True, True)
+>>> m['public.a'] != m['public.c']
+True
+>>> sorted(assign_lanes(tables, [], 3).values())
+[0, 0, 1, 2]
+>>> assign_lanes(tables, fkeys + [('public.c', 'public.b')], 2).values()
+[0, 0, 0, 0]
+
+Prepared lane transaction is committed on recovery only
+if its tick is completed on main connection:
+
+>>> lane_recover_action('londiste/cons/10/0', 'londiste/cons/', 10)
+'commit'
+>>> lane_recover_action('londiste/cons/11/1', 'londiste/cons/', 10)
+'rollback'
+>>> lane_recover_action('londiste/other/5/0', 'londiste/cons/', 10)
+>>> lane_recover_action(None, 'londiste/cons/', 10)
+"""
+
+import skytools
+
+__all__ = ['ApplyLane', 'SerialApplyNeeded', 'assign_lanes', 'lane_recover_action']
+
+class SerialApplyNeeded(Exception):
+    """Batch cannot be applied in lanes, must be retried serially."""
+
+def assign_lanes(tables, fkeys, nlanes):
+    """Return map of table name to lane number.
+
+    @param tables: list of (table name, fq name of destination table)
+    @param fkeys: list of (table, referenced table) by destination names
+    @param nlanes: number of lanes
+
+    Groups of linked tables are distributed round-robin.
+    """
+    # union-find over destination table names
+    parent = {}
+    def find(x):
+        while parent.get(x, x) != x:
+            x = parent[x]
+        return x
+    for tbl, ref in fkeys:
+        a = find(tbl)
+        b = find(ref)
+        if a != b:
+            parent[max(a, b)] = min(a, b)
+
+    groups = {}
+    for name, dest in tables:
+        groups.setdefault(find(dest), []).append(name)
+
+    res = {}
+    roots = groups.keys()
+    roots.sort()
+    for i, root in enumerate(roots):
+        for name in groups[root]:
+            res[name] = i % nlanes
+    return res
+
+def lane_recover_action(gid, pfx, done_tick):
+    """Return 'commit' or 'rollback' for prepared lane transaction.
+
+    None means transaction does not belong to the consumer.
+    """
+    if not gid or not gid.startswith(pfx):
+        return None
+    tick = int(gid[len(pfx):].split('/')[0])
+    if tick <= done_tick:
+        return 'commit'
+    return 'rollback'
+
+class ApplyLane(object):
+    """Applies events for a group of tables on separate connection.
+
+    All database work happens in worker thread, in event order.
+    Transaction is two-phase, so it can be committed together with
+    tick position on main connection.
+    """
+
+    # how many queries to batch together
+    sql_batch = 200
+
+    def __init__(self, name, log):
+        self.name = name
+        self.log = log
+        self.db = None
+        self.curs = None
+        self.gid = None
+        self.sql_list = []
+        self.used_plugins = {}
+        self.worker = skytools.WorkerThread(name)
+
+    def begin(self, db, gid):
+        """Start two-phase transaction."""
+        self.db = db
+        self.gid = gid
+        self.db.tpc_begin(gid)
+        self.curs = db.cursor()
+        self.sql_list = []
+        self.used_plugins = {}
+
+    def submit_event(self, t, ev, batch_info):
+        self.worker.submit(self._apply_event, t, ev, batch_info)
+
+    def submit_truncate(self, t, ev, batch_info):
+        self.worker.submit(self._apply_truncate, t, ev, batch_info)
+
+    def _get_plugin(self, t, batch_info, prepare = True):
+        try:
+            return self.used_plugins[t.name]
+        except KeyError:
+            p = t.get_plugin()
+            p.reset()
+            self.used_plugins[t.name] = p
+            if prepare:
+                p.prepare_batch(batch_info, self.curs)
+            return p
+
+    def _apply_event(self, t, ev, batch_info):
+        p = self._get_plugin(t, batch_info)
+        p.process_event(ev, self.apply_sql, self.curs)
+
+    def _apply_truncate(self, t, ev, batch_info):
+        p = self._get_plugin(t, batch_info, False)
+        fqname = skytools.quote_fqident(t.dest_table)
+        if p.conf.get('ignore_truncate'):
+            self.log.info("ignoring truncate for %s", fqname)
+            return
+        p.before_truncate(self.curs)
+        self.flush_sql()
+        self.curs.execute("TRUNCATE %s CASCADE;" % fqname)
+
+    def apply_sql(self, sql, curs):
+        self.sql_list.append(sql)
+        if len(self.sql_list) >= self.sql_batch:
+            self.flush_sql()
+
+    def flush_sql(self):
+        if len(self.sql_list) == 0:
+            return
+        buf = "\n".join(self.sql_list)
+        self.sql_list = []
+        self.curs.execute(buf)
+
+    def _finish(self, batch_info):
+        self.flush_sql()
+        for p in self.used_plugins.values():
+            p.finish_batch(batch_info, self.curs)
+        self.used_plugins = {}
+
+    def prepare(self, batch_info):
+        """Finish batch and prepare transaction."""
+        self.worker.submit(self._finish, batch_info)
+        self.worker.wait()
+        self.db.tpc_prepare()
+
+    def commit(self):
+        self.db.tpc_commit()
+        self.db = self.curs = self.gid = None
+
+    def rollback(self):
+        """Drop pending work and transaction."""
+        try:
+            self.worker.wait()
+        except Exception:
+            pass
+        self.sql_list = []
+        self.used_plugins = {}
+        if self.db:
+            try:
+                self.db.tpc_rollback()
+            except Exception:
+                pass
+        self.db = self.curs = self.gid = None
+
+if __name__ == "__main__":
+    import doctest
+    doctest.testmod()
@@ -2,22 +2,32 @@
 
 """Compares tables in replication set.
 
-Currently just does count(1) on both sides.
+Does count(1) and checksum on both sides, either over
+whole table or over primary key ranges.
 """
 
-import sys, skytools
+import sys, os, skytools
 
 __all__ = ['Comparator']
 
 from londiste.syncer import Syncer
+from londiste.util import range_condition, range_split_step
 
 class Comparator(Syncer):
     """Simple checker based on Syncer.
     When tables are in sync runs simple SQL query on them.
+
+    With --chunked, table is split into primary key ranges,
+    mismatching ranges are split further until they contain
+    less than compare_chunk_rows rows.  Resulting ranges are
+    written into ranges.TABLE.sql, that repair --ranges uses.
     """
     def process_sync(self, t1, t2, src_db, dst_db):
         """Actual comparison."""
 
+        if self.options.chunked:
+            return self.chunked_compare(t1, t2, src_db, dst_db)
+
         src_tbl = t1.dest_table
         dst_tbl = t2.dest_table
 
@@ -32,23 +42,7 @@ class Comparator(Syncer):
         # get common cols
         cols = self.calc_cols(src_curs, src_tbl, dst_curs, dst_tbl)
 
-        # get sane query
-        v1 = src_db.server_version
-        v2 = dst_db.server_version
-        if self.options.count_only:
-            q = "select count(1) as cnt from only _TABLE_"
-        elif v1 < 80300 or v2 < 80300:
-            # 8.2- does not have record to text and text to bit casts, so we need to use a bit of evil hackery
-            q = "select count(1) as cnt, sum(bit_in(textout('x'||substr(md5(textin(record_out(_COLS_))),1,16)), 0, 64)::bigint) as chksum from only _TABLE_"
-        elif (v1 < 80400 or v2 < 80400) and v1 != v2:
-            # hashtext changed in 8.4 so we need to use md5 in case there is 8.3 vs 8.4+ comparison
-            q = "select count(1) as cnt, sum(('x'||substr(md5(_COLS_::text),1,16))::bit(64)::bigint) as chksum from only _TABLE_"
-        else:
-            # this way is much faster than the above
-            q = "select count(1) as cnt, sum(hashtext(_COLS_::text)::bigint) as chksum from only _TABLE_"
-
-        q = self.cf.get('compare_sql', q)
-        q = q.replace("_COLS_", cols)
+        q = self.get_compare_query(src_db, dst_db, cols)
         src_q = q.replace('_TABLE_', skytools.quote_fqident(src_tbl))
         if src_where:
             src_q = src_q + " WHERE " + src_where
@@ -56,10 +50,7 @@ class Comparator(Syncer):
         if dst_where:
             dst_q = dst_q + " WHERE " + dst_where
 
-        f = "%(cnt)d rows"
-        if not self.options.count_only:
-            f += ", checksum=%(chksum)s"
-        f = self.cf.get('compare_fmt', f)
+        f = self.get_compare_fmt()
 
         self.log.debug("srcdb: %s", src_q)
         src_curs.execute(src_q)
@@ -80,6 +71,141 @@ class Comparator(Syncer):
             return 1
         return 0
 
+    def get_compare_fmt(self):
+        f = "%(cnt)d rows"
+        if not self.options.count_only:
+            f += ", checksum=%(chksum)s"
+        return self.cf.get('compare_fmt', f)
+
+    def get_compare_query(self, src_db, dst_db, cols):
+        """Return count/checksum query with _TABLE_ placeholder."""
+        # get sane query
+        v1 = src_db.server_version
+        v2 = dst_db.server_version
+        if self.options.count_only:
+            q = "select count(1) as cnt from only _TABLE_"
+        elif v1 < 80300 or v2 < 80300:
+            # 8.2- does not have record to text and text to bit casts, so we need to use a bit of evil hackery
+            q = "select count(1) as cnt, sum(bit_in(textout('x'||substr(md5(textin(record_out(_COLS_))),1,16)), 0, 64)::bigint) as chksum from only _TABLE_"
+        elif (v1 < 80400 or v2 < 80400) and v1 != v2:
+            # hashtext changed in 8.4 so we need to use md5 in case there is 8.3 vs 8.4+ comparison
+            q = "select count(1) as cnt, sum(('x'||substr(md5(_COLS_::text),1,16))::bit(64)::bigint) as chksum from only _TABLE_"
+        else:
+            # this way is much faster than the above
+            q = "select count(1) as cnt, sum(hashtext(_COLS_::text)::bigint) as chksum from only _TABLE_"
+
+        q = self.cf.get('compare_sql', q)
+        return q.replace("_COLS_", cols)
+
+    def chunked_compare(self, t1, t2, src_db, dst_db):
+        """Compare checksums of pkey ranges, split mismatching ones.
+
+        Both sides are queried in parallel, in the transactions
+        prepared by Syncer, so all ranges see same snapshot.
+        """
+        src_tbl = t1.dest_table
+        dst_tbl = t2.dest_table
+
+        src_curs = src_db.cursor()
+        dst_curs = dst_db.cursor()
+
+        where = t2.plugin.get_copy_condition(src_curs, dst_curs)
+
+        pkeys = skytools.get_table_pkeys(src_curs, src_tbl)
+        if not pkeys:
+            raise Exception('chunked compare needs pkey: %s' % src_tbl)
+        if skytools.get_table_pkeys(dst_curs, dst_tbl) != pkeys:
+            raise Exception('pkeys do not match: %s' % dst_tbl)
+        qpkeys = ",".join([skytools.quote_ident(k) for k in pkeys])
+
+        cols = self.calc_cols(src_curs, src_tbl, dst_curs, dst_tbl)
+        q = self.get_compare_query(src_db, dst_db, cols)
+        src_q = q.replace('_TABLE_', skytools.quote_fqident(src_tbl))
+        dst_q = q.replace('_TABLE_', skytools.quote_fqident(dst_tbl))
+        f = self.get_compare_fmt()
+
+        chunk_rows = self.cf.getint('compare_chunk_rows', 10000)
+        fanout = self.cf.getint('compare_chunk_split', 16)
+
+        self.log.info('Comparing %s by pkey ranges', dst_tbl)
+
+        def checksum(curs, q):
+            curs.execute(q)
+            return curs.fetchone()
+
+        diff_list = []
+        nchecked = 0
+        todo = [(None, None)]
+        while todo:
+            rng = todo.pop(0)
+            rwhere = self.range_condition(qpkeys, rng, where)
+            src_row, dst_row = skytools.run_parallel(checksum,
+                    [(src_curs, src_q + " WHERE " + rwhere),
+                     (dst_curs, dst_q + " WHERE " + rwhere)], 2)
+            nchecked += 1
+            if f % src_row == f % dst_row:
+                continue
+
+            self.log.debug("mismatch: %s: src: %s, dst: %s", rwhere, f % src_row, f % dst_row)
+
+            # split on side that has more rows
+            if src_row['cnt'] >= dst_row['cnt']:
+                cnt, curs, tbl = src_row['cnt'], src_curs, src_tbl
+            else:
+                cnt, curs, tbl = dst_row['cnt'], dst_curs, dst_tbl
+            sub = []
+            if cnt > chunk_rows:
+                sub = self.split_range(curs, tbl, pkeys, rng, where, cnt, fanout)
+            if len(sub) > 1:
+                todo.extend(sub)
+            else:
+                diff_list.append(rng)
+
+        src_db.commit()
+        dst_db.commit()
+
+        self.log.info("%s: checked %d ranges, %d differ", dst_tbl, nchecked, len(diff_list))
+
+        fn = "ranges.%s.sql" % dst_tbl
+        if os.path.isfile(fn):
+            os.unlink(fn)
+        if not diff_list:
+            return 0
+
+        f = open(fn, "w")
+        for rng in diff_list:
+            cond = self.range_condition(qpkeys, rng)
+            self.log.warning("%s: range differs: %s", dst_tbl, cond)
+            f.write(cond + "\n")
+        f.close()
+        return 1
+
+    def range_condition(self, qpkeys, rng, where = None):
+        """Return SQL condition for pkey range."""
+        return range_condition(qpkeys, rng, where)
+
+    def split_range(self, curs, tbl, pkeys, rng, where, cnt, fanout):
+        """Split range into about fanout subranges with equal row counts."""
+        step = range_split_step(cnt, fanout)
+        qlist = [skytools.quote_ident(k) for k in pkeys]
+        qpkeys = ",".join(qlist)
+        tcols = ",".join(["%s::text" % k for k in qlist])
+        q = "select %s from (select %s, row_number() over (order by %s) as _rn"\
+            " from only %s where %s) _x where (_rn - 1) %% %d = 0 and _rn > 1 order by _rn" % (
+                    tcols, qpkeys, qpkeys, skytools.quote_fqident(tbl),
+                    self.range_condition(qpkeys, rng, where), step)
+        curs.execute(q)
+        bounds = [tuple(row[:len(pkeys)]) for row in curs.fetchall()]
+        if not bounds:
+            return []
+        lower, upper = rng
+        res = []
+        for b in bounds:
+            res.append((lower, b))
+            lower = b
+        res.append((lower, upper))
+        return res
+
     def calc_cols(self, src_curs, src_tbl, dst_curs, dst_tbl):
         cols1 = self.load_cols(src_curs, src_tbl)
         cols2 = self.load_cols(dst_curs, dst_tbl)
@@ -119,6 +245,7 @@ class Comparator(Syncer):
         """Initialize cmdline switches."""
         p = super(Comparator, self).init_optparse(p)
         p.add_option("--count-only", action="store_true", help="just count rows, do not compare data")
+        p.add_option("--chunked", action="store_true", help="compare by pkey ranges, write differing ranges to file")
         return p
 
 if __name__ == '__main__':
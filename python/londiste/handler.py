@@ -31,6 +31,7 @@ plain londiste:
 
 import sys
 import logging
+import hashlib
 import skytools
 import londiste.handlers
 
@@ -65,6 +66,102 @@ class RowCache:
         fields = self.get_fields()
         skytools.magic_insert(curs, self.table_name, self.rows, fields)
 
+class PreparedCache:
+    """Server-side prepared statements for urlenc events.
+
+    One statement is prepared per operation and column set,
+    rows are applied with EXECUTE, so server does not need
+    to parse and plan each of them.
+
+    Handler objects are recreated for each batch, so names of
+    prepared statements are remembered on connection object,
+    new connection starts with empty set.
+
+    >>> class Conn(object): pass
+    >>> class Curs(object): connection = Conn()
+    >>> curs = Curs()
+    >>> sql = []
+    >>> def queue(q, c): sql.append(q)
+    >>> row = {'id': '1', 'data': 'x'}
+    >>> for batch in (1, 2):
+    ...     pc = PreparedCache('public.t')
+    ...     queue(pc.mk_execute_sql('U', row, ['id'], curs, queue), curs)
+    >>> for q in sql: print q
+    prepare londiste_0671c9ab8d49b087 as update only public.t set data = $1 where id = $2;
+    execute londiste_0671c9ab8d49b087 ('x', '1');
+    execute londiste_0671c9ab8d49b087 ('x', '1');
+    >>> curs.connection = Conn()
+    >>> pc.mk_execute_sql('U', row, ['id'], curs, queue)[:7]
+    'execute'
+    >>> sql[-1][:7]
+    'prepare'
+    """
+    def __init__(self, table_name):
+        self.table_name = table_name
+        self.fq_table_name = skytools.quote_fqident(table_name)
+        self.stmt_map = {}
+
+    def mk_execute_sql(self, op, row, pklist, curs, sql_queue_func):
+        """Return EXECUTE statement for row.
+
+        PREPARE is sent via sql_queue_func when statement
+        is not yet known on curs connection.
+        """
+        if op == 'I':
+            cols = row.keys()
+        elif op == 'U':
+            cols = [c for c in row.keys() if c not in pklist]
+        else:
+            cols = []
+        cols.sort()
+        cols = tuple(cols)
+        if op != 'I':
+            cols = cols + tuple(pklist)
+        key = (op, cols)
+
+        try:
+            name, sql = self.stmt_map[key]
+        except KeyError:
+            name, sql = self.make_statement(key, pklist)
+            self.stmt_map[key] = (name, sql)
+
+        conn = curs.connection
+        known = getattr(conn, 'londiste_prepared', None)
+        if known is None:
+            known = conn.londiste_prepared = set()
+        if name not in known:
+            sql_queue_func("prepare %s as %s;" % (name, sql), curs)
+            known.add(name)
+
+        vals = [row[c] for c in cols]
+        args = ", ".join(map(skytools.quote_literal, vals))
+        return "execute %s (%s);" % (name, args)
+
+    def make_statement(self, key, pklist):
+        """Return name and sql for statement."""
+        op, cols = key
+        qcols = map(skytools.quote_ident, cols)
+        npk = op != 'I' and len(pklist) or 0
+        if op == 'I':
+            params = ["$%d" % (i + 1) for i in range(len(cols))]
+            sql = "insert into %s (%s) values (%s)" % (
+                    self.fq_table_name, ", ".join(qcols), ", ".join(params))
+        else:
+            if not pklist:
+                raise Exception("%s needs pkeys" % (op == 'U' and 'update' or 'delete'))
+            whe_list = ["%s = $%d" % (qcols[i], i + 1)
+                        for i in range(len(cols) - npk, len(cols))]
+            if op == 'U':
+                set_list = ["%s = $%d" % (qcols[i], i + 1)
+                            for i in range(len(cols) - npk)]
+                sql = "update only %s set %s where %s" % (
+                        self.fq_table_name, ", ".join(set_list), " and ".join(whe_list))
+            else:
+                sql = "delete from only %s where %s" % (
+                        self.fq_table_name, " and ".join(whe_list))
+        name = 'londiste_' + hashlib.md5(sql).hexdigest()[:16]
+        return name, sql
+
 class BaseHandler:
     """Defines base API, does nothing.
     """
@@ -79,6 +176,8 @@ class BaseHandler:
         self.args = args
         self._check_args (args)
         self.conf = self.get_config()
+        # key range for parallel copy, set on per-chunk handler instance
+        self.copy_chunk = None
 
     def _parse_args_from_doc (self):
         doc = self.__doc__ or ""
@@ -153,15 +252,52 @@ class BaseHandler:
         """Called when batch finishes."""
         pass
 
+    def before_truncate(self, dst_curs):
+        """Called before TRUNCATE event is applied.
+
+        Should drop pending data for the table.
+        """
+        pass
+
+    def before_execute(self, dst_curs):
+        """Called before EXECUTE event is applied.
+
+        Should apply pending data, so the script sees it.
+        """
+        pass
+
     def get_copy_condition(self, src_curs, dst_curs):
         """ Use if you want to filter data """
         return ''
 
+    def get_event_filter(self, dst_curs):
+        """SQL condition on event columns, evaluated on provider.
+
+        Events for this table that do not match it are not fetched.
+        Handler must still filter them itself, as condition is
+        applied from next batch on.
+        """
+        return None
+
+    def get_chunk_condition(self, src_curs, dst_curs):
+        """Copy condition combined with key range of current chunk.
+
+        real_copy() implementations should use it instead of
+        get_copy_condition(), otherwise parallel copy will
+        copy whole table in each chunk.
+        """
+        cond = self.get_copy_condition(src_curs, dst_curs)
+        if not self.copy_chunk:
+            return cond
+        if cond:
+            return "(%s) and (%s)" % (cond, self.copy_chunk)
+        return self.copy_chunk
+
     def real_copy(self, src_tablename, src_curs, dst_curs, column_list):
         """do actual table copy and return tuple with number of bytes and rows
         copied
         """
-        condition = self.get_copy_condition(src_curs, dst_curs)
+        condition = self.get_chunk_condition(src_curs, dst_curs)
         return skytools.full_copy(src_tablename, src_curs, dst_curs,
                                   column_list, condition,
                                   dst_tablename = self.dest_table)
@@ -177,6 +313,12 @@ class TableHandler(BaseHandler):
       encoding=ENC - Validate and fix incoming data from encoding.
                      Only 'utf8' is supported at the moment.
       ignore_truncate=BOOL - Ignore truncate event. Default: 0; Values: 0,1.
+      prepared=BOOL - Apply urlenc events with server-side prepared statements.
+                      Default: 0; Values: 0,1.
+      bulk_threshold=NUM - When table gets more than NUM urlenc events in batch,
+                      rest of them are collapsed by pkey and applied with
+                      COPY into temp table and set-based statements.
+                      Default: 0 (disabled).
     """
     handler_name = 'londiste'
 
@@ -197,11 +339,57 @@ class TableHandler(BaseHandler):
         else:
             self.encoding_validator = None
 
+        if self.conf.prepared:
+            self.prepared_cache = PreparedCache(self.dest_table)
+        else:
+            self.prepared_cache = None
+
+        self.event_count = 0
+        self.bulk_loader = None
+
     def get_config (self):
         conf = BaseHandler.get_config(self)
         conf.ignore_truncate = self.get_arg('ignore_truncate', [0, 1], 0)
+        conf.prepared = self.get_arg('prepared', [0, 1], 0)
+        conf.bulk_threshold = int(self.args.get('bulk_threshold', 0))
         return conf
 
+    def reset(self):
+        self.event_count = 0
+        self.bulk_loader = None
+        BaseHandler.reset(self)
+
+    def finish_batch(self, batch_info, dst_curs):
+        if self.bulk_loader:
+            self.bulk_loader.flush(dst_curs)
+            self.bulk_loader = None
+        self.event_count = 0
+        BaseHandler.finish_batch(self, batch_info, dst_curs)
+
+    def before_truncate(self, dst_curs):
+        # collected rows are gone after truncate
+        self.bulk_loader = None
+        BaseHandler.before_truncate(self, dst_curs)
+
+    def before_execute(self, dst_curs):
+        if self.bulk_loader:
+            self.bulk_loader.flush(dst_curs)
+            self.bulk_loader = None
+        BaseHandler.before_execute(self, dst_curs)
+
+    def bulk_process(self, op, row, pklist):
+        """Collect event into bulk loader.
+
+        Rows are applied in finish_batch(), after per-row
+        statements queued before threshold was reached.
+        """
+        if not self.bulk_loader:
+            from londiste.handlers.dispatch import BulkLoader, METH_CORRECT
+            conf = skytools.dbdict(method = METH_CORRECT, analyze = 0,
+                                   table_mode = 'direct')
+            self.bulk_loader = BulkLoader(self.dest_table, pklist, self.log, conf)
+        self.bulk_loader.process(op, row)
+
     def process_event(self, ev, sql_queue_func, arg):
         row = self.parse_row_data(ev)
         if len(ev.type) == 1:
@@ -214,7 +402,15 @@ class TableHandler(BaseHandler):
             pklist = ev.type[2:].split(',')
             op = ev.type[0]
             tbl = self.dest_table
-            if op == 'I':
+            # tables without pkey stay on per-row sql
+            if self.conf.bulk_threshold and pklist[0]:
+                self.event_count += 1
+                if self.event_count > self.conf.bulk_threshold:
+                    self.bulk_process(op, row, pklist)
+                    return
+            if self.prepared_cache:
+                sql = self.prepared_cache.mk_execute_sql(op, row, pklist, arg, sql_queue_func)
+            elif op == 'I':
                 sql = skytools.mk_insert_sql(row, tbl, pklist)
             elif op == 'U':
                 sql = skytools.mk_update_sql(row, tbl, pklist)
@@ -251,7 +447,7 @@ class TableHandler(BaseHandler):
                 return self.encoding_validator.validate_copy(data, column_list, src_tablename)
         else:
             _write_hook = None
-        condition = self.get_copy_condition(src_curs, dst_curs)
+        condition = self.get_chunk_condition(src_curs, dst_curs)
         return skytools.full_copy(src_tablename, src_curs, dst_curs,
                                   column_list, condition,
                                   dst_tablename = self.dest_table,
@@ -416,3 +612,7 @@ def show(mods):
             if desc:
                 desc = desc.strip()
             print("%s - %s" % (n, desc))
+
+if __name__ == "__main__":
+    import doctest
+    doctest.testmod()
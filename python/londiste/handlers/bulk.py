@@ -11,6 +11,9 @@ then add table with:
 or:
   londiste3 add-table xx --handler="bulk(method=X)"
 
+To limit memory used for large batches:
+  londiste3 add-table xx --handler="bulk(max_buffer=64M)"
+
 Methods:
 
   0 (correct) - inserts as COPY into table,
@@ -42,14 +45,6 @@ USE_LONGLIVED_TEMP_TABLES = True
 
 USE_REAL_TABLE = False
 
-class BulkEvent(object):
-    """Helper class for BulkLoader to store relevant data."""
-    __slots__ = ('op', 'data', 'pk_data')
-    def __init__(self, op, data, pk_data):
-        self.op = op
-        self.data = data
-        self.pk_data = pk_data
-
 class BulkLoader(BaseHandler):
     """Bulk loading into OLAP database.
     Instead of statement-per-event, load all data with one big COPY, UPDATE
@@ -57,6 +52,8 @@ class BulkLoader(BaseHandler):
 
     Parameters:
       method=TYPE - method to use for copying [0..2] (default: 0)
+      max_buffer=SIZE - apply collected events when their size exceeds
+                        SIZE, without waiting for end of batch (default: 0)
 
     Methods:
       0 (correct) - inserts as COPY into table,
@@ -77,109 +74,189 @@ class BulkLoader(BaseHandler):
         self.dist_fields = None
         self.col_list = None
 
-        self.pkey_ev_map = {}
+        # raw events, decoded together on flush
+        self.op_list = []
+        self.data_list = []
         self.method = int(args.get('method', DEFAULT_METHOD))
         if not self.method in (0,1,2):
             raise Exception('unknown method: %s' % self.method)
 
+        # flush collected events early when they take too much memory
+        self.max_buffer = skytools.hsize_to_bytes(args.get('max_buffer', '0'))
+        self.buffer_size = 0
+        self.dst_curs = None
+
         self.log.debug('bulk_init(%r), method=%d', args, self.method)
 
     def reset(self):
-        self.pkey_ev_map = {}
+        self.op_list = []
+        self.data_list = []
+        self.buffer_size = 0
         BaseHandler.reset(self)
 
+    def prepare_batch(self, batch_info, dst_curs):
+        self.dst_curs = dst_curs
+
     def finish_batch(self, batch_info, dst_curs):
         self.bulk_flush(dst_curs)
+        self.dst_curs = None
+
+    def before_execute(self, dst_curs):
+        if self.op_list:
+            self.bulk_flush(dst_curs)
+        BaseHandler.before_execute(self, dst_curs)
 
     def process_event(self, ev, sql_queue_func, arg):
+        """Collect event, apply collected ones when over max_buffer.
+
+        Flushing in the middle of batch gives same result as single
+        flush at the end, wherever the buffer boundary falls:
+
+        >>> class MemLoader(BulkLoader):
+        ...     __doc__ = BulkLoader.__doc__  # for handler args
+        ...     def bulk_flush(self, tbl):
+        ...         cols, ins, upd, dels = self.prepare_data()
+        ...         for row in dels:
+        ...             del tbl[row[0]]
+        ...         for row in upd:
+        ...             assert row[0] in tbl
+        ...             tbl[row[0]] = row
+        ...         for row in ins:
+        ...             assert row[0] not in tbl
+        ...             tbl[row[0]] = row
+        ...         self.reset()
+        >>> evs = [('I', 'id=1&v=a'), ('U', 'id=1&v=b'), ('U', 'id=9&v=y'),
+        ...        ('I', 'id=2&v=c'), ('D', 'id=1&v=b'), ('I', 'id=1&v=d'),
+        ...        ('U', 'id=2&v=e'), ('D', 'id=2&v=e'), ('D', 'id=9&v=y'),
+        ...        ('I', 'id=9&v=z'), ('I', 'id=3&v=f'), ('U', 'id=3&v=g')]
+        >>> def replay(max_buffer):
+        ...     tbl = {'9': ('9', 'x')}
+        ...     h = MemLoader('public.t', {'max_buffer': str(max_buffer)}, None)
+        ...     h.reset()
+        ...     h.prepare_batch(None, tbl)
+        ...     for op, data in evs:
+        ...         ev = skytools.dbdict(ev_type = op + ':id', ev_data = data)
+        ...         h.process_event(ev, None, None)
+        ...     h.finish_batch(None, tbl)
+        ...     return sorted(tbl.values())
+        >>> replay(0)
+        [('1', 'd'), ('3', 'g'), ('9', 'z')]
+        >>> [n for n in range(1, 100) if replay(n) != replay(0)]
+        []
+        """
         if len(ev.ev_type) < 2 or ev.ev_type[1] != ':':
             raise Exception('Unsupported event type: %s/extra1=%s/data=%s' % (
                             ev.ev_type, ev.ev_extra1, ev.ev_data))
         op = ev.ev_type[0]
         if op not in 'IUD':
             raise Exception('Unknown event type: '+ev.ev_type)
-        # pkey_list = ev.ev_type[2:].split(',')
-        data = skytools.db_urldecode(ev.ev_data)
 
-        # get pkey value
         if self.pkey_list is None:
-            #self.pkey_list = pkey_list
             self.pkey_list = ev.ev_type[2:].split(',')
-        if len(self.pkey_list) > 0:
-            pk_data = tuple(data[k] for k in self.pkey_list)
-        elif op == 'I':
-            # fake pkey, just to get them spread out
-            pk_data = self.fake_seq
-            self.fake_seq += 1
-        else:
+        if not self.pkey_list and op != 'I':
             raise Exception('non-pk tables not supported: %s' % self.table_name)
 
-        # get full column list, detect added columns
-        if not self.col_list:
-            self.col_list = data.keys()
-        elif self.col_list != data.keys():
-            # ^ supposedly python guarantees same order in keys()
-            self.col_list = data.keys()
-
         # keep all versions of row data
-        ev = BulkEvent(op, data, pk_data)
-        if ev.pk_data in self.pkey_ev_map:
-            self.pkey_ev_map[ev.pk_data].append(ev)
-        else:
-            self.pkey_ev_map[ev.pk_data] = [ev]
+        self.op_list.append(op)
+        self.data_list.append(ev.ev_data)
+
+        # Apply collected events in the middle of batch.  As this happens
+        # in same transaction and in event order, result is same as with
+        # one flush at the end, later events just see applied rows.
+        if self.max_buffer and self.dst_curs:
+            self.buffer_size += len(ev.ev_data)
+            if self.buffer_size > self.max_buffer:
+                self.log.debug('bulk: %s: buffer full (%d bytes), flushing',
+                               self.table_name, self.buffer_size)
+                self.bulk_flush(self.dst_curs)
 
     def prepare_data(self):
-        """Got all data, prepare for insertion."""
+        """Got all data, prepare for insertion.
+
+        Returns column list with pkeys first and lists of
+        row tuples for insert, update and delete.
+        """
+
+        if not self.data_list:
+            return [], [], [], []
+
+        names, cols = skytools.decode_urlenc_batch(self.data_list)
+        colmap = dict(zip(names, cols))
 
+        # take column list from last event, to detect added/dropped columns
+        last_keys = skytools.db_urldecode(self.data_list[-1])
+        self.col_list = [k for k in names if k in last_keys]
+
+        # reorder cols, put pks first
+        col_list = self.pkey_list[:]
+        for k in self.col_list:
+            if k not in self.pkey_list:
+                col_list.append(k)
+
+        # row tuples, straight from columns
+        rows = zip(*[colmap.get(k, [None] * len(self.data_list)) for k in col_list])
+
+        # get pkey values
+        if self.pkey_list:
+            pk_iter = zip(*[colmap[k] for k in self.pkey_list])
+        else:
+            # fake pkey, just to get them spread out
+            pk_iter = xrange(self.fake_seq, self.fake_seq + len(rows))
+            self.fake_seq += len(rows)
+
+        # group row positions by pkey, in event order
+        pkey_ev_map = {}
+        for pos, pk_data in enumerate(pk_iter):
+            if pk_data in pkey_ev_map:
+                pkey_ev_map[pk_data].append(pos)
+            else:
+                pkey_ev_map[pk_data] = [pos]
+
+        op_list = self.op_list
         del_list = []
         ins_list = []
         upd_list = []
-        for ev_list in self.pkey_ev_map.itervalues():
+        for pos_list in pkey_ev_map.itervalues():
             # rewrite list of I/U/D events to
             # optional DELETE and optional INSERT/COPY command
             exists_before = -1
             exists_after = 1
-            for ev in ev_list:
-                if ev.op == "I":
+            for pos in pos_list:
+                op = op_list[pos]
+                if op == "I":
                     if exists_before < 0:
                         exists_before = 0
                     exists_after = 1
-                elif ev.op == "U":
+                elif op == "U":
                     if exists_before < 0:
                         exists_before = 1
                     #exists_after = 1 # this shouldnt be needed
-                elif ev.op == "D":
+                elif op == "D":
                     if exists_before < 0:
                         exists_before = 1
                     exists_after = 0
                 else:
-                    raise Exception('unknown event type: %s' % ev.op)
+                    raise Exception('unknown event type: %s' % op)
 
             # skip short-lived rows
             if exists_before == 0 and exists_after == 0:
                 continue
 
             # take last event
-            ev = ev_list[-1]
+            row = rows[pos_list[-1]]
 
             # generate needed commands
             if exists_before and exists_after:
-                upd_list.append(ev.data)
+                upd_list.append(row)
             elif exists_before:
-                del_list.append(ev.data)
+                del_list.append(row)
             elif exists_after:
-                ins_list.append(ev.data)
+                ins_list.append(row)
 
-        return ins_list, upd_list, del_list
+        return col_list, ins_list, upd_list, del_list
 
     def bulk_flush(self, curs):
-        ins_list, upd_list, del_list = self.prepare_data()
-
-        # reorder cols, put pks first
-        col_list = self.pkey_list[:]
-        for k in self.col_list:
-            if k not in self.pkey_list:
-                col_list.append(k)
+        col_list, ins_list, upd_list, del_list = self.prepare_data()
 
         real_update_count = len(upd_list)
 
@@ -371,3 +448,7 @@ class BulkLoader(BaseHandler):
 
 # register handler class
 __londiste_handlers__ = [BulkLoader]
+
+if __name__ == '__main__':
+    import doctest
+    doctest.testmod()
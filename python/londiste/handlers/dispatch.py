@@ -154,6 +154,11 @@ analyze:
     * 0 - do not run analyze on temp tables (default)
     * 1 - run analyze on temp tables
 
+max_buffer:
+    approximate size of event data to collect in memory, eg. 64M.
+    when exceeded, collected rows are applied to destination before
+    the batch ends, in the same transaction. default 0 - no limit
+
 == NOTES ==
 
 NB! londiste3 does not currently support table renaming and field mapping when
@@ -242,6 +247,7 @@ class DirectLoader(BaseLoader):
         if self.data:
             curs.execute("\n".join(mk_sql[op](row, self.table, self.pkeys)
                                    for op, row in self.data))
+        self.data = []
 
 
 class BaseBulkCollectingLoader(BaseLoader):
@@ -294,8 +300,42 @@ class BaseBulkCollectingLoader(BaseLoader):
         return op_map
 
     def flush(self, curs):
+        """Apply collected rows.
+
+        Can be called in the middle of batch, result is same as with
+        single flush at the end, wherever the boundary falls:
+
+        >>> class MemLoader(BaseBulkCollectingLoader):
+        ...     def bulk_flush(self, tbl, op_map):
+        ...         for row in op_map['D']:
+        ...             del tbl[row['id']]
+        ...         for row in op_map['U']:
+        ...             assert row['id'] in tbl
+        ...             tbl[row['id']] = row['v']
+        ...         for row in op_map['I']:
+        ...             assert row['id'] not in tbl
+        ...             tbl[row['id']] = row['v']
+        >>> evs = [('I', 1, 'a'), ('U', 1, 'b'), ('U', 9, 'y'), ('I', 2, 'c'),
+        ...        ('D', 1, 'b'), ('I', 1, 'd'), ('U', 2, 'e'), ('D', 2, 'e'),
+        ...        ('D', 9, 'y'), ('I', 9, 'z'), ('I', 3, 'f'), ('U', 3, 'g')]
+        >>> def replay(flush_every):
+        ...     tbl = {9: 'x'}
+        ...     ldr = MemLoader('public.t', ['id'], None, None)
+        ...     for n, (op, id, v) in enumerate(evs):
+        ...         ldr.process(op, {'id': id, 'v': v})
+        ...         if flush_every and (n + 1) % flush_every == 0:
+        ...             ldr.flush(tbl)
+        ...     ldr.flush(tbl)
+        ...     return sorted(tbl.items())
+        >>> replay(0)
+        [(1, 'd'), (3, 'g'), (9, 'z')]
+        >>> [n for n in range(1, len(evs)) if replay(n) != replay(0)]
+        []
+        """
         op_map = self.collect_data()
         self.bulk_flush(curs, op_map)
+        # later events for same pk start from applied state
+        self.pkey_ev_map = {}
 
     def bulk_flush(self, curs, op_map):
         pass
@@ -649,6 +689,8 @@ class Dispatcher (ShardHandler):
         self.batch_info = None
         self.dst_curs = None
         self.pkeys = None
+        # size of event data collected in loaders
+        self.buffer_size = 0
         # config
         hdlr_cls = ROW_HANDLERS[self.conf.row_mode]
         self.row_handler = hdlr_cls(self.log)
@@ -682,6 +724,7 @@ class Dispatcher (ShardHandler):
         # set table mode
         conf.table_mode = self.get_arg('table_mode', TABLE_MODES)
         conf.analyze = self.get_arg('analyze', [0, 1])
+        conf.max_buffer = skytools.hsize_to_bytes(self.args.get('max_buffer', '0'))
         if conf.table_mode == 'part':
             conf.part_mode = self.get_arg('part_mode', PART_MODES)
             conf.part_field = self.args.get('part_field')
@@ -804,12 +847,28 @@ class Dispatcher (ShardHandler):
                                        self.pkeys, self.conf)
         self.row_handler.process(dst, op, data)
 
+        if self.conf.max_buffer and self.dst_curs:
+            self.buffer_size += len(ev.data)
+            if self.buffer_size > self.conf.max_buffer:
+                self.log.debug('dispatch: %s: buffer full (%d bytes), flushing',
+                               self.table_name, self.buffer_size)
+                self.row_handler.flush(self.dst_curs)
+                self.buffer_size = 0
+
     def finish_batch(self, batch_info, dst_curs):
         """Called when batch finishes."""
         if self.conf.table_mode != 'ignore':
             self.row_handler.flush(dst_curs)
+        self.buffer_size = 0
         #ShardHandler.finish_batch(self, batch_info, dst_curs)
 
+    def before_execute(self, dst_curs):
+        """Called before EXECUTE event is applied."""
+        if self.conf.table_mode != 'ignore':
+            self.row_handler.flush(dst_curs)
+        self.buffer_size = 0
+        ShardHandler.before_execute(self, dst_curs)
+
     def get_part_name(self):
         # if custom part name template given, use it
         if self.conf.part_name:
@@ -955,7 +1014,7 @@ class Dispatcher (ShardHandler):
         copied
         """
         _src_cols = _dst_cols = column_list
-        condition = self.get_copy_condition (src_curs, dst_curs)
+        condition = self.get_chunk_condition(src_curs, dst_curs)
 
         if self.conf.skip_fields:
             _src_cols = [col for col in column_list
@@ -1058,3 +1117,7 @@ set_handler_doc (__londiste_handlers__[-1], {'load_mode': 'bulk', 'table_mode':
 def direct_handler(args):
     return update(args, {'load_mode': 'direct', 'table_mode': 'direct'})
 set_handler_doc (__londiste_handlers__[-1], {'load_mode': 'direct', 'table_mode': 'direct'})
+
+if __name__ == '__main__':
+    import doctest
+    doctest.testmod()
@@ -16,6 +16,9 @@ On root node:
 On branch/leaf node:
 * On COPY time, the SELECT on provider side gets filtered by hash.
 * On replay time, the events gets filtered by looking at hash in ev_extra3.
+* If provider has londiste.get_shard_hash(), events of other shards
+  are filtered out already when fetching batch.  Not done on nodes
+  that copy events into local queue, as downstream may need them.
 
 Local config:
 * Local hash value and mask are loaded from partconf.conf table.
@@ -97,6 +100,15 @@ class ShardHandler (TableHandler):
         self.log.debug('shard: copy_condition=%r', w)
         return w
 
+    def get_event_filter(self, dst_curs):
+        """Fetch only events for local shard."""
+        if self.hash_key is None:
+            return None
+        if not self.hash_mask:
+            self.load_shard_info(dst_curs)
+        h = "londiste.get_shard_hash(ev_extra3)"
+        return "(%s is null or (%s & %d) = %d)" % (h, h, self.hash_mask, self.shard_nr)
+
     def load_shard_info(self, curs):
         """Load part/slot info from database."""
         q = "select part_nr, max_part from partconf.conf"
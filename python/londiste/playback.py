@@ -2,13 +2,15 @@
 
 """Basic replication core."""
 
-import sys, os, time
+import sys, os, time, datetime
 import skytools
 
 from pgq.cascade.worker import CascadedWorker
 
 from londiste.handler import *
 from londiste.exec_attrs import ExecAttrs
+from londiste.applylane import *
+from londiste.util import catchup_switch
 
 __all__ = ['Replicator', 'TableState',
     'TABLE_MISSING', 'TABLE_IN_COPY', 'TABLE_CATCHING_UP',
@@ -69,6 +71,8 @@ class TableState(object):
         self.last_snapshot_tick = None
         self.str_snapshot = None
         self.from_snapshot = None
+        # txid -> visibility in from_snapshot, for current event block
+        self.snapshot_cache = None
         self.sync_tick_id = None
         self.ok_batch_count = 0
         self.last_tick = 0
@@ -89,6 +93,7 @@ class TableState(object):
         self.last_snapshot_tick = None
         self.str_snapshot = None
         self.from_snapshot = None
+        self.snapshot_cache = None
         self.sync_tick_id = None
         self.ok_batch_count = 0
         self.last_tick = 0
@@ -108,6 +113,7 @@ class TableState(object):
             self.from_snapshot = skytools.Snapshot(str_snapshot)
         else:
             self.from_snapshot = None
+        self.snapshot_cache = None
 
         if tag_changed:
             self.ok_batch_count = 0
@@ -193,9 +199,13 @@ class TableState(object):
         else:
             self.dest_table = self.name
 
+        self.plugin = self.build_plugin()
+
+    def build_plugin(self):
+        """Create new handler instance for table."""
         hstr = self.table_attrs.get('handlers', '') # compat
         hstr = self.table_attrs.get('handler', hstr)
-        self.plugin = build_handler(self.name, hstr, self.dest_table)
+        return build_handler(self.name, hstr, self.dest_table)
 
     def max_parallel_copies_reached(self):
         return self.max_parallel_copy and\
@@ -218,7 +228,12 @@ class TableState(object):
             return True
 
         # uninteresting?
-        if self.from_snapshot.contains(ev.txid):
+        visible = None
+        if self.snapshot_cache is not None:
+            visible = self.snapshot_cache.get(ev.txid)
+        if visible is None:
+            visible = self.from_snapshot.contains(ev.txid)
+        if visible:
             return False
 
         # after couple interesting batches there no need to check snapshot
@@ -232,6 +247,13 @@ class TableState(object):
                 self.change_snapshot(None)
         return True
 
+    def filter_txids(self, txid_list):
+        """Check visibility of txids in event block at once."""
+        if not self.from_snapshot:
+            return
+        res = self.from_snapshot.contains_many(txid_list)
+        self.snapshot_cache = dict(zip(txid_list, res))
+
     def gc_snapshot(self, copy_thread, prev_tick, cur_tick, no_lag):
         """Remove attached snapshot if possible.
 
@@ -285,9 +307,28 @@ class Replicator(CascadedWorker):
         # how many tables can be copied in parallel
         #parallel_copies = 1
 
+        # how many connections to use for copying one table,
+        # needs PostgreSQL 9.2+ on provider
+        #copy_table_workers = 1
+
         # accept only events for locally present tables
         #local_only = true
 
+        # apply events of independent tables in parallel, over that many
+        # extra connections.  Needs max_prepared_transactions on target.
+        # Tables linked with foreign keys stay in same connection,
+        # batches with EXECUTE events are applied serially.
+        #parallel_apply = 0
+
+        # when lag is over that many seconds, merge ticks into batches
+        # covering catchup_batch_interval seconds, so they are applied
+        # in one transaction.  Lag must be over the interval too.
+        # Normal batches are used again when lag drops under half of it
+        # or no merged batch is available.  Not used during table copy.
+        # (0 disables)
+        #catchup_lag = 0
+        #catchup_batch_interval = 300
+
         ## compare/repair
         # max amount of time table can be locked
         #lock_timeout = 10
@@ -296,6 +337,9 @@ class Replicator(CascadedWorker):
         # workaround for hashtext change between 8.3 and 8.4
         #compare_sql = select count(1) as cnt, sum(('x'||substr(md5(t.*::text),1,16))::bit(64)::bigint) as chksum from only _TABLE_ t
         #compare_fmt = %(cnt)d rows, checksum=%(chksum)s
+        # compare --chunked: max rows in reported range, subranges per split
+        #compare_chunk_rows = 10000
+        #compare_chunk_split = 16
 
         ## Parameters for initial node creation: create-root/branch/leaf ##
 
@@ -338,11 +382,25 @@ class Replicator(CascadedWorker):
             raise Exception('Bad value for parallel_copies: %d' % self.parallel_copies)
 
         self.consumer_filter = None
+        # does provider have londiste.get_shard_hash()
+        self.provider_has_shard_hash = None
+
+        self.parallel_apply = self.cf.getint('parallel_apply', 0)
+        self.apply_lanes = []
+        self.batch_lanes = []
+        self.use_lanes = False
+        self.lanes_recovered = False
+        self.lane_map = {}
+        self.lane_map_key = None
+        # tick that needs serial apply
+        self.serial_tick = None
 
         load_handler_modules(self.cf)
 
     def connection_hook(self, dbname, db):
-        if dbname == 'db' and db.server_version >= 80300:
+        if dbname == 'db' or dbname.startswith(('db_apply_', 'db_copy_')):
+            if db.server_version < 80300:
+                return
             curs = db.cursor()
             curs.execute("set session_replication_role = 'replica'")
             db.commit()
@@ -367,6 +425,11 @@ class Replicator(CascadedWorker):
             self.check_code(dst_db)
             self.code_check_done = 1
 
+        # leftover lane transactions may keep locks on rows
+        if not self.lanes_recovered:
+            self.recover_apply_lanes(dst_db)
+            self.lanes_recovered = True
+
         self.sync_database_encodings(src_db, dst_db)
 
         self.cur_tick = self.batch_info['tick_id']
@@ -386,23 +449,39 @@ class Replicator(CascadedWorker):
             p.reset()
         self.used_plugins = {}
 
+        self.use_lanes = self.check_apply_lanes(src_db, dst_db)
+
         # now the actual event processing happens.
         # they must be done all in one tx in dst side
         # and the transaction must be kept open so that
         # the cascade-consumer can save last tick and commit.
 
         self.sql_list = []
-        CascadedWorker.process_remote_batch(self, src_db, tick_id, ev_list, dst_db)
-        self.flush_sql(dst_curs)
+        try:
+            CascadedWorker.process_remote_batch(self, src_db, tick_id, ev_list, dst_db)
+            self.flush_sql(dst_curs)
 
-        for p in self.used_plugins.values():
-            p.finish_batch(self.batch_info, dst_curs)
-        self.used_plugins = {}
+            for p in self.used_plugins.values():
+                p.finish_batch(self.batch_info, dst_curs)
+            self.used_plugins = {}
+
+            # lanes are committed after tick position
+            for lane in self.batch_lanes:
+                lane.prepare(self.batch_info)
+        except:
+            self.rollback_apply_lanes()
+            raise
 
         # finalize table changes
         self.save_table_state(dst_curs)
 
         # store event filter
+        self.consumer_filter = self.build_consumer_filter(src_db, dst_curs)
+
+    def build_consumer_filter(self, src_db, dst_curs):
+        """Build filter for next batch from local_only and handler filters."""
+
+        filters = []
         if self.cf.getboolean('local_only', False):
             # create list of tables
             if self.copy_thread:
@@ -413,12 +492,222 @@ class Replicator(CascadedWorker):
             # build filter
             meta = "(ev_type like 'pgq.%' or ev_type like 'londiste.%')"
             if _filterlist:
-                self.consumer_filter = "(%s or (ev_extra1 in (%s)))" % (meta, _filterlist)
+                filters.append("(%s or (ev_extra1 in (%s)))" % (meta, _filterlist))
             else:
-                self.consumer_filter = meta
-        else:
+                filters.append(meta)
+
+        # handler filters, tables with same condition are grouped.
+        # nodes that copy events to local queue must get all of them,
+        # as downstream nodes may serve other shards.
+        if not self._worker_state.copy_events:
+            filters.extend(self.build_handler_filters(src_db, dst_curs))
+
+        if not filters:
             # no filter
-            self.consumer_filter = None
+            return None
+        return " and ".join(filters)
+
+    def build_handler_filters(self, src_db, dst_curs):
+        """Return provider-side event conditions from table handlers."""
+        if self.provider_has_shard_hash is None:
+            self.provider_has_shard_hash = skytools.exists_function(
+                    src_db.cursor(), 'londiste.get_shard_hash', 1)
+            if not self.provider_has_shard_hash:
+                self.log.info('Provider does not have londiste.get_shard_hash(), not filtering shards there')
+        if not self.provider_has_shard_hash:
+            return []
+
+        groups = {}
+        for t in self.table_list:
+            p = t.get_plugin()
+            if not p:
+                continue
+            cond = p.get_event_filter(dst_curs)
+            if cond:
+                groups.setdefault(cond, []).append(skytools.quote_literal(t.name))
+        filters = []
+        for cond, names in groups.items():
+            filters.append("(ev_extra1 is null or ev_extra1 not in (%s) or %s)" % (
+                           ','.join(names), cond))
+        return filters
+
+    def finish_remote_batch(self, src_db, dst_db, tick_id):
+        """Commit tick position, then prepared lane transactions."""
+        CascadedWorker.finish_remote_batch(self, src_db, dst_db, tick_id)
+        for lane in self.batch_lanes:
+            lane.commit()
+        self.batch_lanes = []
+        self.check_catchup()
+
+    def reload(self):
+        CascadedWorker.reload(self)
+
+        self.catchup_lag = self.cf.getfloat('catchup_lag', 0)
+        self.catchup_interval = self.cf.getfloat('catchup_batch_interval', 300)
+        if self.catchup_lag and self.catchup_lag < self.catchup_interval:
+            self.log.warning('catchup_lag is under catchup_batch_interval, using %d secs',
+                             self.catchup_interval)
+        # reload resets batch params
+        self.catchup_active = False
+        self.catchup_last_end = None
+
+    def work(self):
+        try:
+            res = CascadedWorker.work(self)
+        except SerialApplyNeeded:
+            self.log.info("EXECUTE event in batch, retrying tick %d serially", self.cur_tick)
+            self.reset()
+            return 1
+        if not res and self.catchup_active:
+            # no merged batch, off if it is because we are close to real-time
+            lag = self.get_catchup_lag(self.catchup_last_end)
+            self.check_catchup_switch(lag, idle = True)
+        return res
+
+    def get_catchup_lag(self, end):
+        """Return seconds since batch end."""
+        lag = datetime.datetime.now(end.tzinfo) - end
+        return lag.days * 86400 + lag.seconds
+
+    def check_catchup_switch(self, lag, busy = False, idle = False):
+        reason = catchup_switch(self.catchup_active, lag, self.catchup_lag,
+                                self.catchup_interval, busy, idle)
+        if reason:
+            self.set_catchup(not self.catchup_active, reason)
+
+    def check_catchup(self):
+        """Merge batches when lagging, switch back near real-time."""
+        if not self.catchup_lag or self.copy_thread:
+            return
+
+        self.catchup_last_end = self.batch_info['batch_end']
+        lag = self.get_catchup_lag(self.catchup_last_end)
+
+        # table copy coordinates with main thread by ticks
+        busy = False
+        for t in self.table_list:
+            if t.state != TABLE_OK:
+                busy = True
+                break
+
+        self.check_catchup_switch(lag, busy)
+
+    def set_catchup(self, active, reason):
+        """Switch catch-up mode on/off."""
+        if active:
+            self.log.info('Catch-up mode on (%s), merging batches up to %d secs',
+                          reason, self.catchup_interval)
+            self.pgq_min_interval = '%d seconds' % self.catchup_interval
+        else:
+            self.log.info('Catch-up mode off (%s)', reason)
+            self.pgq_min_interval = self.cf.get("pgq_batch_collect_interval", '') or None
+        self.catchup_active = active
+
+    def check_apply_lanes(self, src_db, dst_db):
+        """Decide if current batch can be applied in parallel."""
+        if self.parallel_apply <= 0 or self.copy_thread:
+            return False
+        if self.work_state < 0 or self._worker_state.wait_behind:
+            return False
+
+        if not self.apply_lanes:
+            curs = dst_db.cursor()
+            curs.execute("show max_prepared_transactions")
+            if int(curs.fetchone()[0]) < self.parallel_apply:
+                self.log.warning("max_prepared_transactions too low, disabling parallel_apply")
+                self.parallel_apply = 0
+                return False
+            for i in range(self.parallel_apply):
+                self.apply_lanes.append(ApplyLane('apply_%d' % i, self.log))
+
+        # EXECUTE was found in previous attempt
+        if self.cur_tick == self.serial_tick:
+            self.log.info("batch contains EXECUTE events, applying serially")
+            return False
+
+        self.load_lane_map(dst_db.cursor())
+        return True
+
+    def get_lane_db(self, idx):
+        return self.get_database('db', cache = 'db_apply_%d' % idx)
+
+    def lane_gid_prefix(self):
+        return 'londiste/%s/' % self.consumer_name
+
+    def recover_apply_lanes(self, dst_db):
+        """Finish lane transactions left prepared by crash or failed batch.
+
+        If tick is completed on main connection, transaction is committed,
+        otherwise rolled back.  Runs after each (re)connect, also when
+        parallel_apply is off now.
+        """
+        pfx = self.lane_gid_prefix()
+        q = """select current_database(), count(*) from pg_catalog.pg_prepared_xacts
+                where database = current_database()
+                  and substr(gid, 1, length(%s)) = %s"""
+        curs = dst_db.cursor()
+        curs.execute(q, [pfx, pfx])
+        dbname, cnt = curs.fetchone()
+        if not cnt:
+            return
+
+        db = self.get_lane_db(0)
+        done_tick = self._consumer_state['completed_tick']
+        for xid in db.tpc_recover():
+            gid = xid.gtrid
+            if xid.database != dbname or not lane_recover_action(gid, pfx, done_tick):
+                continue
+            if lane_recover_action(gid, pfx, done_tick) == 'commit':
+                self.log.info("committing prepared transaction %s", gid)
+                db.tpc_commit(xid)
+            else:
+                self.log.info("rolling back prepared transaction %s", gid)
+                db.tpc_rollback(xid)
+        if self.parallel_apply <= 0:
+            self.close_database('db_apply_0')
+
+    def rollback_apply_lanes(self):
+        for lane in self.batch_lanes:
+            lane.rollback()
+        self.batch_lanes = []
+
+    def load_lane_map(self, dst_curs):
+        """Assign tables to lanes.
+
+        Tables linked with foreign keys are kept in same lane,
+        groups are distributed round-robin.
+        """
+        key = [(t.name, t.state) for t in self.table_list]
+        key.sort()
+        if key == self.lane_map_key:
+            return
+
+        q = "select n1.nspname || '.' || c1.relname as tbl,"\
+            "       n2.nspname || '.' || c2.relname as ref"\
+            "  from pg_constraint k"\
+            "  join pg_class c1 on (c1.oid = k.conrelid)"\
+            "  join pg_namespace n1 on (n1.oid = c1.relnamespace)"\
+            "  join pg_class c2 on (c2.oid = k.confrelid)"\
+            "  join pg_namespace n2 on (n2.oid = c2.relnamespace)"\
+            " where k.contype = 'f'"
+        dst_curs.execute(q)
+
+        fkeys = [(row['tbl'], row['ref']) for row in dst_curs.fetchall()]
+        tables = [(t.name, skytools.fq_name(t.dest_table)) for t in self.table_list]
+        self.lane_map = assign_lanes(tables, fkeys, self.parallel_apply)
+        self.lane_map_key = key
+
+    def get_apply_lane(self, t):
+        """Return lane for table, start transaction in it if needed."""
+        if not self.use_lanes or t.name not in self.lane_map:
+            return None
+        idx = self.lane_map[t.name]
+        lane = self.apply_lanes[idx]
+        if lane not in self.batch_lanes:
+            gid = '%s%d/%d' % (self.lane_gid_prefix(), self.cur_tick, idx)
+            lane.begin(self.get_lane_db(idx), gid)
+            self.batch_lanes.append(lane)
+        return lane
 
     def sync_tables(self, src_db, dst_db):
         """Table sync loop.
@@ -631,6 +920,9 @@ class Replicator(CascadedWorker):
             self.handle_truncate_event(ev, dst_curs)
         elif ev.type == 'EXECUTE':
             self.flush_sql(dst_curs)
+            # script must see rows collected by bulk loaders
+            for p in self.used_plugins.values():
+                p.before_execute(dst_curs)
             self.handle_execute_event(ev, dst_curs)
         elif ev.type == 'londiste.add-table':
             self.flush_sql(dst_curs)
@@ -650,6 +942,25 @@ class Replicator(CascadedWorker):
         # no point keeping it around longer
         self.current_event = None
 
+    def _load_batch_events(self, curs, batch_id):
+        ev_list = CascadedWorker._load_batch_events(self, curs, batch_id)
+        if self.pgq_lazy_fetch:
+            ev_list.block_hook = self.prefilter_events
+        return ev_list
+
+    def prefilter_events(self, ev_list):
+        """Check fetched block of events against table snapshots.
+
+        Each distinct txid is looked up once per block,
+        instead of once per event in interesting().
+        """
+        tables = [t for t in self.table_list if t.from_snapshot]
+        if not tables:
+            return
+        txids = list(set([ev.txid for ev in ev_list]))
+        for t in tables:
+            t.filter_txids(txids)
+
     def handle_data_event(self, ev, dst_curs):
         """handle one data event"""
         t = self.get_table_by_name(ev.extra1)
@@ -657,6 +968,11 @@ class Replicator(CascadedWorker):
             self.stat_increase('ignored_events')
             return
 
+        lane = self.get_apply_lane(t)
+        if lane:
+            lane.submit_event(t, ev, self.batch_info)
+            return
+
         try:
             p = self.used_plugins[ev.extra1]
         except KeyError:
@@ -673,6 +989,11 @@ class Replicator(CascadedWorker):
             self.stat_increase('ignored_events')
             return
 
+        lane = self.get_apply_lane(t)
+        if lane:
+            lane.submit_truncate(t, ev, self.batch_info)
+            return
+
         fqname = skytools.quote_fqident(t.dest_table)
 
         try:
@@ -692,6 +1013,7 @@ class Replicator(CascadedWorker):
         #
         sql = "TRUNCATE %s CASCADE;" % fqname
 
+        p.before_truncate(dst_curs)
         self.flush_sql(dst_curs)
         dst_curs.execute(sql)
 
@@ -701,6 +1023,14 @@ class Replicator(CascadedWorker):
         if self.copy_thread:
             return
 
+        # EXECUTE needs to see all earlier changes and lanes
+        # must not work on tables after it, so lane work so far
+        # is thrown away and batch is retried serially.
+        if self.batch_lanes:
+            self.serial_tick = self.cur_tick
+            raise SerialApplyNeeded('EXECUTE event in parallel apply')
+        self.use_lanes = False
+
         # parse event
         fname = ev.extra1
         s_attrs = ev.extra2
@@ -986,6 +1316,19 @@ class Replicator(CascadedWorker):
                 return
         CascadedWorker.copy_event(self, dst_curs, ev, filtered_copy)
 
+    def get_copy_filter(self, filtered_copy):
+        cond = CascadedWorker.get_copy_filter(self, filtered_copy)
+        if filtered_copy:
+            cond = "%s and ev_type not like 'londiste.%%'" % cond
+        return cond
+
+    def reset(self):
+        """Drop lane state, connections are closed by DBScript."""
+        self.batch_lanes = []
+        self.lanes_recovered = False
+        self.provider_has_shard_hash = None
+        super(Replicator, self).reset()
+
     def exception_hook(self, det, emsg):
         # add event info to error message
         if self.current_event:
@@ -4,7 +4,7 @@
 Walks tables by primary key and searches for missing inserts/updates/deletes.
 """
 
-import sys, os, skytools, subprocess
+import sys, os, skytools, subprocess, threading, Queue
 
 from londiste.syncer import Syncer
 
@@ -14,6 +14,93 @@ def unescape(s):
     """Remove copy escapes."""
     return skytools.unescape_copy(s)
 
+# pkey types that are compared as integers in stream mode
+INT_TYPES = ('smallint', 'integer', 'bigint')
+
+class CopyStream(object):
+    """Reads ordered COPY output in separate thread.
+
+    Lines are passed to reader in batches via bounded queue,
+    so only few batches are kept in memory.
+    """
+
+    def __init__(self, curs, q, batch_lines = 1000, max_batches = 16):
+        self.curs = curs
+        self.q = q
+        self.batch_lines = batch_lines
+        self.queue = Queue.Queue(max_batches)
+        self.frag = ''
+        self.lines = []
+        self.cur = []
+        self.pos = 0
+        self.done = False
+        self.closing = False
+        self.error = None
+        self.total_bytes = 0
+        self.thread = threading.Thread(target = self._run)
+        self.thread.setDaemon(True)
+        self.thread.start()
+
+    def _run(self):
+        try:
+            try:
+                self.curs.copy_expert(self.q, self)
+                if self.frag:
+                    self.lines.append(self.frag)
+                self.queue.put(self.lines)
+            except:
+                self.error = sys.exc_info()
+        finally:
+            self.queue.put(None)
+
+    def write(self, data):
+        "New data from psycopg"
+        if self.closing:
+            return
+        self.total_bytes += len(data)
+        parts = (self.frag + data).split('\n')
+        self.frag = parts.pop()
+        for ln in parts:
+            self.lines.append(ln + '\n')
+        if len(self.lines) >= self.batch_lines:
+            self.queue.put(self.lines)
+            self.lines = []
+
+    def readline(self):
+        """Return next line, empty string at the end."""
+        while self.pos >= len(self.cur):
+            if self.done:
+                return ''
+            batch = self.queue.get()
+            if batch is None:
+                self.done = True
+                self.thread.join()
+                if self.error:
+                    err = self.error
+                    raise err[0], err[1], err[2]
+                return ''
+            self.cur = batch
+            self.pos = 0
+        ln = self.cur[self.pos]
+        self.pos += 1
+        return ln
+
+    def close(self):
+        """Stop unfinished COPY and wait for reader thread.
+
+        Query is cancelled, pending batches are drained so
+        thread blocked on full queue can finish.
+        """
+        if not self.done:
+            self.closing = True
+            cancel = getattr(self.curs.connection, 'cancel', None)
+            if cancel:
+                cancel()
+            while not self.done:
+                if self.queue.get() is None:
+                    self.done = True
+        self.thread.join()
+
 class Repairer(Syncer):
     """Walks tables in primary key order and checks if data matches."""
 
@@ -23,22 +110,36 @@ class Repairer(Syncer):
     total_src = 0
     total_dst = 0
     pkey_list = []
+    pkey_types = []
     common_fields = []
     apply_curs = None
+    # per-pkey functions to get comparable value
+    key_funcs = []
 
     def init_optparse(self, p=None):
         """Initialize cmdline switches."""
         p = super(Repairer, self).init_optparse(p)
         p.add_option("--apply", action="store_true", help="apply fixes")
+        p.add_option("--ranges", action="store_true", help="check only ranges found by compare --chunked")
+        p.add_option("--stream", action="store_true", help="merge ordered streams from both databases, without dump files")
         return p
 
+    def close_slot(self, slot):
+        """Close apply connection of parallel slot too."""
+        if slot > 0:
+            self.close_database('applydb_%d' % slot)
+        super(Repairer, self).close_slot(slot)
+
     def process_sync(self, t1, t2, src_db, dst_db):
         """Actual comparison."""
 
         apply_db = None
 
         if self.options.apply:
-            apply_db = self.get_database('db', cache='applydb', autocommit=1)
+            cache = 'applydb'
+            if self.sync_slot:
+                cache = 'applydb_%d' % self.sync_slot
+            apply_db = self.get_database('db', cache=cache, autocommit=1)
             self.apply_curs = apply_db.cursor()
             self.apply_curs.execute("set session_replication_role = 'replica'")
 
@@ -61,8 +162,25 @@ class Repairer(Syncer):
         dump_dst_sorted = dump_dst + ".sorted"
 
         dst_where = t2.plugin.get_copy_condition(src_curs, dst_curs)
+        if self.options.ranges:
+            rcond = self.load_ranges(dst_tbl)
+            if not rcond:
+                self.log.info("%s: no differing ranges, skipping", dst_tbl)
+                return
+            if dst_where:
+                dst_where = "(%s) and (%s)" % (dst_where, rcond)
+            else:
+                dst_where = rcond
         src_where = dst_where
 
+        if self.options.stream:
+            if self.can_stream(src_curs, dst_curs):
+                return self.stream_compare(src_tbl, dst_tbl, src_curs, dst_curs,
+                                           src_where, dst_where)
+            self.log.warning("%s: stream mode needs 9.1+ for non-integer pkeys, using dumps", dst_tbl)
+
+        self.key_funcs = [str] * len(self.pkey_list)
+
         self.log.info("Dumping src table: %s", src_tbl)
         self.dump_table(src_tbl, src_curs, dump_src, src_where)
         src_db.commit()
@@ -82,6 +200,64 @@ class Repairer(Syncer):
         os.unlink(dump_src_sorted)
         os.unlink(dump_dst_sorted)
 
+    def load_ranges(self, tbl):
+        """Load pkey ranges written by compare --chunked.
+
+        Returns SQL condition or None if there are no ranges.
+        """
+        fn = "ranges.%s.sql" % tbl
+        if not os.path.isfile(fn):
+            return None
+        rlist = []
+        for ln in open(fn):
+            ln = ln.strip()
+            if ln:
+                rlist.append("(%s)" % ln)
+        if not rlist:
+            return None
+        self.log.info("%s: using %d ranges from %s", tbl, len(rlist), fn)
+        return " or ".join(rlist)
+
+    def can_stream(self, src_curs, dst_curs):
+        """Check if server can order rows as stream_compare needs."""
+        for t in self.pkey_types:
+            if t not in INT_TYPES:
+                v1 = src_curs.connection.server_version
+                v2 = dst_curs.connection.server_version
+                return v1 >= 90100 and v2 >= 90100
+        return True
+
+    def stream_compare(self, src_tbl, dst_tbl, src_curs, dst_curs, src_where, dst_where):
+        """Compare tables by reading both in pkey order.
+
+        Integer pkeys are ordered natively and compared as numbers,
+        others are ordered as text in "C" collation and compared
+        as unescaped strings.
+        """
+        order = []
+        self.key_funcs = []
+        for k, t in zip(self.pkey_list, self.pkey_types):
+            qk = skytools.quote_ident(k)
+            if t in INT_TYPES:
+                order.append(qk)
+                self.key_funcs.append(int)
+            else:
+                order.append('%s::text collate "C"' % qk)
+                self.key_funcs.append(unescape)
+
+        self.log.info("Streaming %s and %s", src_tbl, dst_tbl)
+        f1 = CopyStream(src_curs, self.get_dump_query(src_tbl, src_where, order))
+        try:
+            f2 = CopyStream(dst_curs, self.get_dump_query(dst_tbl, dst_where, order))
+            try:
+                self.compare_streams(dst_tbl, f1, f2)
+            finally:
+                f2.close()
+        finally:
+            f1.close()
+        self.log.info('%s: Got %d bytes from src, %d bytes from dst',
+                      dst_tbl, f1.total_bytes, f2.total_bytes)
+
     def do_sort(self, src, dst):
         """ Sort contents of src file, write them to dst file. """
 
@@ -113,6 +289,13 @@ class Repairer(Syncer):
             self.log.error('pkeys do not match')
             sys.exit(1)
 
+        q = "select format_type(atttypid, atttypmod) from pg_attribute"\
+            " where attrelid = %s::regclass and attname = %s"
+        self.pkey_types = []
+        for k in self.pkey_list:
+            src_curs.execute(q, [skytools.quote_fqident(src_tbl), k])
+            self.pkey_types.append(src_curs.fetchone()[0])
+
         src_cols = skytools.get_table_columns(src_curs, src_tbl)
         dst_cols = skytools.get_table_columns(dst_curs, dst_tbl)
         field_list = []
@@ -132,13 +315,20 @@ class Repairer(Syncer):
         cols = ",".join(fqlist)
         self.log.debug("using columns: %s", cols)
 
-    def dump_table(self, tbl, curs, fn, whr):
-        """Dump table to disk."""
+    def get_dump_query(self, tbl, whr, order = None):
         cols = ','.join(self.fq_common_fields)
         if len(whr) == 0:
             whr = 'true'
-        q = "copy (SELECT %s FROM %s WHERE %s) to stdout" % (cols, skytools.quote_fqident(tbl), whr)
+        q = "SELECT %s FROM %s WHERE %s" % (cols, skytools.quote_fqident(tbl), whr)
+        if order:
+            q += " ORDER BY " + ", ".join(order)
+        q = "copy (%s) to stdout" % q
         self.log.debug("Query: %s", q)
+        return q
+
+    def dump_table(self, tbl, curs, fn, whr):
+        """Dump table to disk."""
+        q = self.get_dump_query(tbl, whr)
         f = open(fn, "w", 64*1024)
         curs.copy_expert(q, f)
         size = f.tell()
@@ -160,13 +350,19 @@ class Repairer(Syncer):
             or apply changes to target table directly.
         """
         self.log.info("Comparing dumps: %s", tbl)
+        f1 = open(src_fn, "r", 64*1024)
+        f2 = open(dst_fn, "r", 64*1024)
+        self.compare_streams(tbl, f1, f2)
+        f1.close()
+        f2.close()
+
+    def compare_streams(self, tbl, f1, f2):
+        """Merge-join two line streams ordered by pkey."""
         self.cnt_insert = 0
         self.cnt_update = 0
         self.cnt_delete = 0
         self.total_src = 0
         self.total_dst = 0
-        f1 = open(src_fn, "r", 64*1024)
-        f2 = open(dst_fn, "r", 64*1024)
         src_ln = f1.readline()
         dst_ln = f2.readline()
         if src_ln: self.total_src += 1
@@ -316,9 +512,9 @@ class Repairer(Syncer):
         elif dst_row is None:
             return -1
 
-        for k in self.pkey_list:
-            v1 = src_row[k]
-            v2 = dst_row[k]
+        for k, fn in zip(self.pkey_list, self.key_funcs):
+            v1 = fn(src_row[k])
+            v2 = fn(dst_row[k])
             if v1 < v2:
                 return -1
             elif v1 > v2:
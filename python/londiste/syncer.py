@@ -2,7 +2,7 @@
 """Catch moment when tables are in sync on master and slave.
 """
 
-import sys, time, skytools
+import sys, time, copy, skytools
 from londiste.handler import build_handler, load_handler_modules
 
 from londiste.util import find_copy_source
@@ -24,6 +24,9 @@ class Syncer(skytools.DBScript):
 
     provider_info = None
 
+    # connection slot in parallel mode
+    sync_slot = 0
+
     def __init__(self, args):
         """Syncer init."""
         skytools.DBScript.__init__(self, 'londiste3', args)
@@ -57,6 +60,8 @@ class Syncer(skytools.DBScript):
         """Initialize cmdline switches."""
         p = skytools.DBScript.init_optparse(self, p)
         p.add_option("--force", action="store_true", help="ignore lag")
+        p.add_option("--parallel", type="int", default=1,
+                     help="number of tables to process in parallel")
         return p
 
     def get_provider_info(self, setup_curs):
@@ -142,6 +147,7 @@ class Syncer(skytools.DBScript):
         else:
             tlist = names
 
+        jobs = []
         for tbl in tlist:
             tbl = skytools.fq_name(tbl)
             if not tbl in dst_tables:
@@ -157,13 +163,154 @@ class Syncer(skytools.DBScript):
 
             if wname is None:
                 wname = self.consumer_name
-            self.downstream_worker_name = wname
 
+            if self.options.parallel > 1:
+                jobs.append((tbl, t2, pnode, ploc, wname))
+                continue
+
+            self.downstream_worker_name = wname
             self.process_one_table(tbl, t2, dst_db, pnode, ploc)
 
+        if jobs:
+            self.process_parallel(jobs, dst_db)
+
         # signal caller about bad tables
         sys.exit(self.bad_tables)
 
+    def process_parallel(self, jobs, dst_db):
+        """Process tables in groups of --parallel tables.
+
+        Tables are ordered largest first, each group shares
+        one lock/tick window on provider and tables in it
+        are processed concurrently on separate connections.
+        """
+        nparallel = self.options.parallel
+
+        dst_curs = dst_db.cursor()
+        q = "select pg_total_relation_size(%s::regclass)"
+        sized = []
+        for job in jobs:
+            dst_curs.execute(q, [skytools.quote_fqident(job[1].dest_table)])
+            sized.append((dst_curs.fetchone()[0], job))
+        dst_db.commit()
+        sized.sort(key = lambda x: x[0], reverse = True)
+
+        # tables from same provider can share lock window
+        groups = {}
+        order = []
+        for size, job in sized:
+            key = job[2:]
+            if key not in groups:
+                groups[key] = []
+                order.append(key)
+            groups[key].append(job[:2])
+
+        for key in order:
+            pnode, ploc, wname = key
+            tables = groups[key]
+            self.downstream_worker_name = wname
+            for i in range(0, len(tables), nparallel):
+                self.process_table_group(tables[i : i + nparallel], dst_db, pnode, ploc)
+
+    def process_table_group(self, tables, dst_db, provider_node, provider_loc):
+        """Sync tables in one lock window, then process them in parallel."""
+
+        lock_db = self.get_database('lock_db', connstr = provider_loc, profile = 'remote')
+        setup_db = self.get_database('setup_db', autocommit = 1, connstr = provider_loc, profile = 'remote')
+        src_db = self.get_database('provider_db', connstr = provider_loc, profile = 'remote',
+                                   isolation_level = skytools.I_REPEATABLE_READ)
+
+        self.provider_info = self.get_provider_info(setup_db.cursor())
+
+        src_tables, ignore = self.get_tables(src_db)
+
+        slots = []
+        for tbl, t2 in tables:
+            if not tbl in src_tables:
+                self.log.warning('Table not available on provider: %s', tbl)
+                continue
+            t1 = src_tables[tbl]
+            if t1.merge_state != 'ok':
+                self.log.warning('Table %s not ready yet on provider', tbl)
+                continue
+
+            i = len(slots)
+            s_db = self.get_database('provider_db', cache = 'provider_db_%d' % i,
+                                     connstr = provider_loc, profile = 'remote',
+                                     isolation_level = skytools.I_REPEATABLE_READ)
+            d_db = self.get_database('db', cache = 'db_sync_%d' % i,
+                                     isolation_level = skytools.I_REPEATABLE_READ)
+            if not skytools.exists_table(s_db.cursor(), t1.dest_table):
+                self.log.warning("Table %s does not exist on provider side", t1.dest_table)
+                continue
+            if not skytools.exists_table(d_db.cursor(), t2.dest_table):
+                self.log.warning("Table %s does not exist on subscriber side", t2.dest_table)
+                continue
+            slots.append((t1, t2, s_db, d_db, i))
+
+        if slots:
+            src_list = [t1.dest_table for t1, t2, s_db, d_db, i in slots]
+            dst_list = [t2.dest_table for t1, t2, s_db, d_db, i in slots]
+            try:
+                if self.provider_info['node_type'] == 'root':
+                    self.lock_tables_root(lock_db, setup_db, dst_db, src_list, dst_list)
+                else:
+                    self.lock_table_branch(lock_db, setup_db, dst_db, None, ", ".join(dst_list))
+
+                # take snapshots on both sides
+                for t1, t2, s_db, d_db, i in slots:
+                    s_db.commit()
+                    s_db.cursor().execute("SELECT 1")
+                    d_db.commit()
+                    d_db.cursor().execute("SELECT 1")
+            finally:
+                # release lock
+                if self.provider_info['node_type'] == 'root':
+                    self.unlock_table_root(lock_db, setup_db)
+                else:
+                    self.unlock_table_branch(lock_db, setup_db)
+
+            res = skytools.run_parallel(self.run_sync, slots, len(slots))
+            self.bad_tables += len(filter(None, res))
+
+        lock_db.commit()
+        src_db.commit()
+        for i in range(len(tables)):
+            self.close_slot(i)
+        self.close_database('setup_db')
+        self.close_database('lock_db')
+        self.close_database('provider_db')
+
+    def run_sync(self, t1, t2, src_db, dst_db, slot = 0):
+        """Run process_sync() and report throughput.
+
+        Runs on copy of script object, so subclasses can keep
+        per-table state in attributes when tables are processed
+        in parallel.  Extra connections should be cached per
+        self.sync_slot and closed in close_slot().
+        """
+        dst_curs = dst_db.cursor()
+        q = "select pg_total_relation_size(%s::regclass)"
+        dst_curs.execute(q, [skytools.quote_fqident(t2.dest_table)])
+        size = dst_curs.fetchone()[0]
+
+        start = time.time()
+        worker = copy.copy(self)
+        worker.sync_slot = slot
+        bad = worker.process_sync(t1, t2, src_db, dst_db)
+        src_db.commit()
+        dst_db.commit()
+        dur = max(time.time() - start, 0.001)
+
+        self.log.info("%s: processed %d MB in %.1f secs, %.1f MB/s",
+                      t2.dest_table, size / (1024*1024), dur, size / dur / (1024*1024))
+        return bad
+
+    def close_slot(self, slot):
+        """Close connections used by parallel sync slot."""
+        self.close_database('provider_db_%d' % slot)
+        self.close_database('db_sync_%d' % slot)
+
     def process_one_table(self, tbl, t2, dst_db, provider_node, provider_loc):
 
         lock_db = self.get_database('lock_db', connstr = provider_loc, profile = 'remote')
@@ -259,7 +406,7 @@ class Syncer(skytools.DBScript):
                 self.unlock_table_branch(lock_db, setup_db)
 
         # do work
-        bad = self.process_sync(t1, t2, src_db, dst_db)
+        bad = self.run_sync(t1, t2, src_db, dst_db)
         if bad:
             self.bad_tables += 1
 
@@ -268,19 +415,23 @@ class Syncer(skytools.DBScript):
         dst_db.commit()
 
     def lock_table_root(self, lock_db, setup_db, dst_db, src_tbl, dst_tbl):
+        self.lock_tables_root(lock_db, setup_db, dst_db, [src_tbl], [dst_tbl])
+
+    def lock_tables_root(self, lock_db, setup_db, dst_db, src_list, dst_list):
 
         setup_curs = setup_db.cursor()
         lock_curs = lock_db.cursor()
 
         # lock table in separate connection
-        self.log.info('Locking %s', src_tbl)
+        self.log.info('Locking %s', ", ".join(src_list))
         lock_db.commit()
         self.set_lock_timeout(lock_curs)
         lock_time = time.time()
-        lock_curs.execute("LOCK TABLE %s IN SHARE MODE" % skytools.quote_fqident(src_tbl))
+        qtables = ", ".join([skytools.quote_fqident(t) for t in src_list])
+        lock_curs.execute("LOCK TABLE %s IN SHARE MODE" % qtables)
 
         # now wait until consumer has updated target table until locking
-        self.log.info('Syncing %s', dst_tbl)
+        self.log.info('Syncing %s', ", ".join(dst_list))
 
         # consumer must get futher than this tick
         tick_id = self.force_tick(setup_curs)
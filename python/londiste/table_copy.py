@@ -5,14 +5,18 @@
 For internal usage.
 """
 
-import sys, time, skytools
+import sys, time, Queue, skytools
 
 from londiste.util import find_copy_source
 from skytools.dbstruct import *
 from londiste.playback import *
+from pgq.cascade.consumer import PDB
 
 __all__ = ['CopyTable']
 
+# table size in pages per one parallel copy chunk
+COPY_CHUNK_PAGES = 1024
+
 class CopyTable(Replicator):
     """Table copy thread implementation."""
 
@@ -86,6 +90,11 @@ class CopyTable(Replicator):
 
         src_real_table = pt.dest_table
 
+        nworkers = self.cf.getint('copy_table_workers', 1)
+        if nworkers > 1 and src_db.server_version < 90200:
+            self.log.warning("copy_table_workers needs PostgreSQL 9.2+ on provider")
+            nworkers = 1
+
         # 0 - dont touch
         # 1 - single tx
         # 2 - multi tx
@@ -133,6 +142,13 @@ class CopyTable(Replicator):
                 self.log.warning("Table %s column %s does not exist on provider",
                                  tbl_stat.name, c)
 
+        # parallel copy needs committed truncate, so other
+        # connections can write into table
+        chunks = []
+        if nworkers > 1:
+            chunks = self.get_copy_chunks(src_curs, src_real_table, nworkers * 4)
+        parallel = len(chunks) > 1
+
         # drop unnecessary stuff
         if cmode > 0:
             objs = T_CONSTRAINT | T_INDEX | T_RULE | T_PARENT # | T_TRIGGER
@@ -149,7 +165,7 @@ class CopyTable(Replicator):
                 q += skytools.quote_fqident(tbl_stat.dest_table)
                 dst_curs.execute(q)
 
-            if cmode == 2 and tbl_stat.dropped_ddl is None:
+            if (cmode == 2 or parallel) and tbl_stat.dropped_ddl is None:
                 ddl = dst_struct.get_create_sql(objs)
                 if ddl:
                     q = "select * from londiste.local_set_table_struct(%s, %s, %s)"
@@ -161,8 +177,13 @@ class CopyTable(Replicator):
 
         # do truncate & copy
         self.log.info("%s: start copy", tbl_stat.name)
-        p = tbl_stat.get_plugin()
-        stats = p.real_copy(src_real_table, src_curs, dst_curs, common_cols)
+        if parallel:
+            dst_db.commit()
+            stats = self.parallel_copy(tbl_stat, src_db, src_real_table,
+                                       common_cols, chunks, nworkers)
+        else:
+            p = tbl_stat.get_plugin()
+            stats = p.real_copy(src_real_table, src_curs, dst_curs, common_cols)
         if stats:
             self.log.info("%s: copy finished: %d bytes, %d rows",
                           tbl_stat.name, stats[0], stats[1])
@@ -181,9 +202,9 @@ class CopyTable(Replicator):
         self.save_table_state(dst_curs)
 
         # create previously dropped objects
-        if cmode == 1:
+        if cmode == 1 and not parallel:
             dst_struct.create(dst_curs, objs, log = self.log)
-        elif cmode == 2:
+        elif cmode > 0:
             dst_db.commit()
 
             # start waiting for other copy processes to finish
@@ -221,6 +242,110 @@ class CopyTable(Replicator):
         src_curs.execute(q, [self.queue_name])
         src_db.commit()
 
+    def get_copy_chunks(self, src_curs, src_table, max_chunks):
+        """Split table into key ranges for parallel copy.
+
+        Uses ctid ranges on 14+, otherwise ranges of single-column
+        integer pkey.  Returns list of sql conditions, empty list if
+        table is small or cannot be split.
+        """
+        q = "select relpages from pg_class where oid = %s::regclass"
+        src_curs.execute(q, [skytools.quote_fqident(src_table)])
+        npages = src_curs.fetchone()[0]
+        nchunks = min(max_chunks, npages / COPY_CHUNK_PAGES)
+        if nchunks < 2:
+            return []
+
+        if src_curs.connection.server_version >= 140000:
+            q = "select pg_relation_size(%s::regclass) / current_setting('block_size')::int8"
+            src_curs.execute(q, [skytools.quote_fqident(src_table)])
+            npages = src_curs.fetchone()[0]
+            bounds = [npages * i / nchunks for i in range(1, nchunks)]
+            bounds = [("ctid < '(%d,0)'::tid" % b, "ctid >= '(%d,0)'::tid" % b)
+                      for b in bounds]
+        else:
+            pkeys = skytools.get_table_pkeys(src_curs, src_table)
+            if len(pkeys) != 1:
+                return []
+            q = "select format_type(atttypid, atttypmod) from pg_attribute"\
+                " where attrelid = %s::regclass and attname = %s"
+            src_curs.execute(q, [skytools.quote_fqident(src_table), pkeys[0]])
+            if src_curs.fetchone()[0] not in ('smallint', 'integer', 'bigint'):
+                return []
+            col = skytools.quote_ident(pkeys[0])
+            q = "select min(%s), max(%s) from only %s" % (col, col,
+                    skytools.quote_fqident(src_table))
+            src_curs.execute(q)
+            kmin, kmax = src_curs.fetchone()
+            if kmin is None or kmax - kmin < nchunks:
+                return []
+            bounds = [kmin + (kmax - kmin) * i / nchunks for i in range(1, nchunks)]
+            bounds = [("%s < %d" % (col, b), "%s >= %d" % (col, b))
+                      for b in bounds]
+
+        # first and last chunk are open-ended
+        res = []
+        lower = None
+        for upper, next_lower in bounds:
+            if lower:
+                res.append("%s and %s" % (lower, upper))
+            else:
+                res.append(upper)
+            lower = next_lower
+        res.append(lower)
+        return res
+
+    def parallel_copy(self, tbl_stat, src_db, src_table, column_list, chunks, nworkers):
+        """Copy table chunks over several connections.
+
+        Workers read with snapshot exported from src_db transaction,
+        so result matches single COPY and txid_current_snapshot()
+        from src_db stays valid for catch-up.
+        """
+        src_curs = src_db.cursor()
+        src_curs.execute("select pg_export_snapshot()")
+        snapshot_id = src_curs.fetchone()[0]
+
+        self.log.info("%s: copying %d chunks with %d connections",
+                      tbl_stat.name, len(chunks), nworkers)
+
+        pool = Queue.Queue()
+        for i in range(nworkers):
+            wsrc = self.get_database(PDB, cache = 'copy_src_%d' % i,
+                                     connstr = self.provider_connstr, profile = 'remote',
+                                     isolation_level = skytools.I_REPEATABLE_READ)
+            wdst = self.get_database('db', cache = 'db_copy_%d' % i)
+            self.sync_database_encodings(wsrc, wdst)
+            pool.put((wsrc, wdst))
+
+        def copy_chunk(cond):
+            wsrc, wdst = pool.get()
+            try:
+                curs = wsrc.cursor()
+                curs.execute("set transaction snapshot %s", [snapshot_id])
+                p = tbl_stat.build_plugin()
+                p.copy_chunk = cond
+                res = p.real_copy(src_table, curs, wdst.cursor(), column_list)
+                wsrc.commit()
+                wdst.commit()
+                self.log.debug("%s: chunk copied: %s", tbl_stat.name, cond)
+                return res
+            finally:
+                pool.put((wsrc, wdst))
+
+        results = skytools.run_parallel(copy_chunk, [(c,) for c in chunks], nworkers)
+
+        for i in range(nworkers):
+            self.close_database('copy_src_%d' % i)
+            self.close_database('db_copy_%d' % i)
+
+        nbytes = nrows = 0
+        for res in results:
+            if res:
+                nbytes += res[0]
+                nrows += res[1]
+        return (nbytes, nrows)
+
     def work(self):
         if not self.reg_ok:
             # check if needed? (table, not existing reg)
@@ -2,7 +2,8 @@
 import skytools
 import londiste.handler
 
-__all__ = ['handler_allows_copy', 'find_copy_source']
+__all__ = ['handler_allows_copy', 'find_copy_source',
+           'range_condition', 'range_split_step', 'catchup_switch']
 
 def handler_allows_copy(table_attrs):
     """Decide if table is copyable based on attrs."""
@@ -75,3 +76,87 @@ def find_copy_source(script, queue_name, copy_table_name, node_name, node_locati
         node_name = info['provider_node']
         node_location = info['provider_location']
         worker_name = info['worker_name']
+
+def range_condition(qpkeys, rng, where = None):
+    """Return SQL condition for pkey range.
+
+    Range is tuple of (lower, upper) key value tuples, lower is
+    inclusive, upper exclusive, None means unlimited.
+
+    >>> range_condition('id', (None, None))
+    'true'
+    >>> range_condition('id', (('10',), None), 'id > 0')
+    "(id > 0) and (id) >= ('10')"
+    >>> range_condition('a,b', (('1', 'x'), ('2', "y'z")))
+    "(a,b) >= ('1','x') and (a,b) < ('2','y''z')"
+    >>> range_condition('a,b', (None, ('5', None)))
+    "(a,b) < ('5',null)"
+    """
+    lower, upper = rng
+    cond = []
+    if where:
+        cond.append("(%s)" % where)
+    if lower is not None:
+        cond.append("(%s) >= (%s)" % (qpkeys, ",".join(map(skytools.quote_literal, lower))))
+    if upper is not None:
+        cond.append("(%s) < (%s)" % (qpkeys, ",".join(map(skytools.quote_literal, upper))))
+    if not cond:
+        return "true"
+    return " and ".join(cond)
+
+def range_split_step(cnt, fanout):
+    """Return row step for splitting cnt rows into about fanout ranges.
+
+    >>> range_split_step(10000, 16)
+    625
+    >>> range_split_step(10001, 16)
+    626
+    >>> range_split_step(5, 16)
+    1
+    >>> range_split_step(0, 16)
+    1
+    """
+    step = (cnt + fanout - 1) / fanout
+    return max(step, 1)
+
+def catchup_switch(active, lag, catchup_lag, interval, busy = False, idle = False):
+    """Decide if catch-up mode should be toggled.
+
+    Mode is enabled only when lag is over both catchup_lag and
+    merge interval, otherwise there would be no merged batch
+    available and mode would flap.  Returns reason for change
+    or None if mode should stay as it is.
+
+    >>> catchup_switch(False, 100, 60, 300)
+    >>> catchup_switch(False, 400, 60, 300)
+    'lag 400 secs'
+    >>> catchup_switch(False, 400, 60, 300, busy = True)
+    >>> catchup_switch(True, 200, 60, 300)
+    >>> catchup_switch(True, 100, 60, 300)
+    'lag 100 secs'
+    >>> catchup_switch(True, 400, 60, 300, busy = True)
+    'table copy in progress'
+
+    Empty work() cycle switches mode off only when close to real-time:
+
+    >>> catchup_switch(True, 400, 60, 300, idle = True)
+    >>> catchup_switch(True, 250, 60, 300, idle = True)
+    'no merged batch available'
+    >>> catchup_switch(False, 400, 60, 300, idle = True)
+    """
+    start = max(catchup_lag, interval)
+    if not active:
+        if not busy and not idle and lag > start:
+            return 'lag %d secs' % lag
+    elif busy:
+        return 'table copy in progress'
+    elif idle:
+        if lag < interval:
+            return 'no merged batch available'
+    elif lag < start / 2:
+        return 'lag %d secs' % lag
+    return None
+
+if __name__ == '__main__':
+    import doctest
+    doctest.testmod()
@@ -660,7 +660,8 @@ static inline int gethex(unsigned char c)
 	return -1;
 }
 
-static PyObject *get_elem(unsigned char *buf, unsigned char **src_p, unsigned char *src_end)
+/* decode one key or value into buf, return length */
+static Py_ssize_t decode_elem(unsigned char *buf, unsigned char **src_p, unsigned char *src_end)
 {
 	int c1, c2;
 	unsigned char *src = *src_p;
@@ -689,14 +690,22 @@ static PyObject *get_elem(unsigned char *buf, unsigned char **src_p, unsigned ch
 	}
 gotit:
 	*src_p = src;
-	return PyString_FromStringAndSize((char *)buf, dst - buf);
+	return dst - buf;
 
 hex_incomplete:
 	PyErr_Format(PyExc_ValueError, "Incomplete hex code");
-	return NULL;
+	return -1;
 hex_invalid:
 	PyErr_Format(PyExc_ValueError, "Invalid hex code");
-	return NULL;
+	return -1;
+}
+
+static PyObject *get_elem(unsigned char *buf, unsigned char **src_p, unsigned char *src_end)
+{
+	Py_ssize_t len = decode_elem(buf, src_p, src_end);
+	if (len < 0)
+		return NULL;
+	return PyString_FromStringAndSize((char *)buf, len);
 }
 
 static const char doc_db_urldecode[] =
@@ -763,6 +772,161 @@ failed:
 	return NULL;
 }
 
+/*
+ * urldecode list of strings to columns
+ */
+
+static const char doc_decode_urlenc_batch[] =
+"Urldecode list of strings to columns.\n"
+"Returns tuple of column names, in order of first appearance,\n"
+"and list of value lists, one list per column.\n"
+"Keys without '=' and keys missing from string give None.\n"
+"None in input list gives row of NULLs.\n"
+"Duplicate keys are ignored - only latest is kept.\n"
+"\n"
+"C implementation.";
+
+/* add new column that has NULLs for rows before current one */
+static Py_ssize_t add_column(PyObject *names, PyObject *cols, PyObject *colmap,
+			     PyObject *key, Py_ssize_t nrows)
+{
+	PyObject *col, *idx;
+	Py_ssize_t i, ncol = PyList_GET_SIZE(cols);
+
+	col = PyList_New(nrows);
+	if (!col)
+		return -1;
+	for (i = 0; i < nrows; i++) {
+		Py_INCREF(Py_None);
+		PyList_SET_ITEM(col, i, Py_None);
+	}
+	if (PyList_Append(cols, col) < 0) {
+		Py_DECREF(col);
+		return -1;
+	}
+	Py_DECREF(col);
+	if (PyList_Append(names, key) < 0)
+		return -1;
+	idx = PyInt_FromSsize_t(ncol);
+	if (!idx)
+		return -1;
+	if (PyDict_SetItem(colmap, key, idx) < 0) {
+		Py_DECREF(idx);
+		return -1;
+	}
+	Py_DECREF(idx);
+	return ncol;
+}
+
+static PyObject *decode_urlenc_batch(PyObject *self, PyObject *args)
+{
+	PyObject *arg, *seq = NULL, *item, *tmp_obj = NULL;
+	PyObject *names = NULL, *cols = NULL, *colmap = NULL, *res = NULL;
+	PyObject *key = NULL, *value = NULL, *name, *idx;
+	Py_ssize_t nrows, row, ncols, pos, col, i, len, src_len;
+	unsigned char *src, *src_end;
+	struct Buf buf;
+
+	if (!PyArg_ParseTuple(args, "O", &arg))
+		return NULL;
+	seq = PySequence_Fast(arg, "decode_urlenc_batch() needs sequence of strings");
+	if (!seq)
+		return NULL;
+	if (!buf_init(&buf, 256)) {
+		Py_DECREF(seq);
+		return PyErr_NoMemory();
+	}
+
+	names = PyList_New(0);
+	cols = PyList_New(0);
+	colmap = PyDict_New();
+	if (!names || !cols || !colmap)
+		goto failed;
+
+	nrows = PySequence_Fast_GET_SIZE(seq);
+	for (row = 0; row < nrows; row++) {
+		/* row starts as NULLs */
+		ncols = PyList_GET_SIZE(cols);
+		for (i = 0; i < ncols; i++) {
+			if (PyList_Append(PyList_GET_ITEM(cols, i), Py_None) < 0)
+				goto failed;
+		}
+
+		item = PySequence_Fast_GET_ITEM(seq, row);
+		if (item == Py_None)
+			continue;
+		src_len = get_buffer(item, &src, &tmp_obj);
+		if (src_len < 0)
+			goto failed;
+		if ((unsigned long)src_len >= buf.alloc && !buf_enlarge(&buf, src_len)) {
+			PyErr_NoMemory();
+			goto failed;
+		}
+
+		/* rows usually have keys in same order, remember expected position */
+		pos = 0;
+		src_end = src + src_len;
+		while (src < src_end) {
+			if (*src == '&') {
+				src++;
+				continue;
+			}
+
+			len = decode_elem(buf.ptr, &src, src_end);
+			if (len < 0)
+				goto failed;
+
+			col = -1;
+			if (pos < PyList_GET_SIZE(names)) {
+				name = PyList_GET_ITEM(names, pos);
+				if (PyString_GET_SIZE(name) == len
+				    && memcmp(PyString_AS_STRING(name), buf.ptr, len) == 0)
+					col = pos;
+			}
+			if (col < 0) {
+				key = PyString_FromStringAndSize((char *)buf.ptr, len);
+				if (!key)
+					goto failed;
+				PyString_InternInPlace(&key);
+				idx = PyDict_GetItem(colmap, key);
+				if (idx)
+					col = PyInt_AS_LONG(idx);
+				else
+					col = add_column(names, cols, colmap, key, row + 1);
+				Py_CLEAR(key);
+				if (col < 0)
+					goto failed;
+			}
+			pos = col + 1;
+
+			if (src < src_end && *src == '=') {
+				src++;
+				value = get_elem(buf.ptr, &src, src_end);
+				if (value == NULL)
+					goto failed;
+				/* steals reference */
+				PyList_SetItem(PyList_GET_ITEM(cols, col), row, value);
+				value = NULL;
+			} else {
+				Py_INCREF(Py_None);
+				PyList_SetItem(PyList_GET_ITEM(cols, col), row, Py_None);
+			}
+		}
+		Py_CLEAR(tmp_obj);
+	}
+
+	res = Py_BuildValue("(NO)", PyList_AsTuple(names), cols);
+failed:
+	buf_free(&buf);
+	Py_CLEAR(tmp_obj);
+	Py_CLEAR(key);
+	Py_CLEAR(seq);
+	Py_CLEAR(names);
+	Py_CLEAR(cols);
+	Py_CLEAR(colmap);
+	return res;
+}
+
 /*
  * Module initialization
  */
@@ -775,6 +939,7 @@ cquoting_methods[] = {
 	{ "unescape", unescape, METH_VARARGS, doc_unescape },
 	{ "db_urlencode", db_urlencode, METH_VARARGS, doc_db_urlencode },
 	{ "db_urldecode", db_urldecode, METH_VARARGS, doc_db_urldecode },
+	{ "decode_urlenc_batch", decode_urlenc_batch, METH_VARARGS, doc_decode_urlenc_batch },
 	{ "unquote_literal", unquote_literal, METH_VARARGS, doc_unquote_literal },
 	{ NULL }
 };
@@ -20,6 +20,7 @@ from pgq.consumer import *
 from pgq.coopconsumer import *
 from pgq.remoteconsumer import *
 from pgq.localconsumer import *
+from pgq.multiconsumer import *
 from pgq.producer import *
 
 from pgq.status import *
@@ -35,6 +36,7 @@ __all__ = (
     pgq.coopconsumer.__all__ +
     pgq.remoteconsumer.__all__ +
     pgq.localconsumer.__all__ +
+    pgq.multiconsumer.__all__ +
     pgq.cascade.nodeinfo.__all__ +
     pgq.cascade.admin.__all__ +
     pgq.cascade.consumer.__all__ +
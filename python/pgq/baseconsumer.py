@@ -22,51 +22,135 @@ class BaseBatchWalker(object):
 
      - one for loop over events
      - len() after that
+
+    If fetch_bytes is given, the number of rows per FETCH is
+    adapted so that one block takes approximately that much memory.
+    Fast round-trips let the block grow up to that budget,
+    when one FETCH takes longer than max_fetch_time the block
+    is shrunk, as there is no latency left to amortize.
     """
 
-    def __init__(self, curs, batch_id, queue_name, fetch_size = 300, consumer_filter = None):
+    # limits for adaptive fetch size
+    min_fetch_size = 10
+    max_fetch_size = 100000
+
+    # stop growing when single FETCH takes that many seconds
+    max_fetch_time = 1.0
+
+    # how many rows per block are measured for row size
+    size_sample = 50
+
+    def __init__(self, curs, batch_id, queue_name, fetch_size = 300, consumer_filter = None, fetch_bytes = 0):
         self.queue_name = queue_name
         self.fetch_size = fetch_size
         self.sql_cursor = "batch_walker"
-        self.curs = curs
+        self.curs = curs.connection.cursor(cursor_factory = EventCursor)
         self.length = 0
         self.batch_id = batch_id
         self.fetch_status = 0 # 0-not started, 1-in-progress, 2-done
         self.consumer_filter = consumer_filter
+        self.fetch_bytes = fetch_bytes
+
+        # called with list of events for each fetched block
+        self.block_hook = None
+
+        # fetch statistics
+        self.fetch_count = 0
+        self.fetch_time = 0.0
+        self.last_fetch_time = 0.0
+        self.row_bytes = 0
 
     def _make_event(self, queue_name, row):
         return Event(queue_name, row)
 
+    def _fetch(self, q, args = None):
+        t = time.time()
+        self.curs.execute(q, args)
+        rows = self.curs.fetchall()
+        self.last_fetch_time = time.time() - t
+        self.fetch_time += self.last_fetch_time
+        self.fetch_count += 1
+        return rows
+
+    def _measure_rows(self, rows):
+        """Return average row size in bytes, measured on sample."""
+        sample = rows[:self.size_sample]
+        total = 0
+        for row in sample:
+            for v in row:
+                if isinstance(v, basestring):
+                    total += len(v)
+                else:
+                    total += 8
+        return float(total) / len(sample)
+
+    def _next_fetch_size(self, avg, cur_size):
+        """Calculate row count for next FETCH from last block.
+
+        >>> w = BaseBatchWalker.__new__(BaseBatchWalker)
+        >>> w.fetch_bytes, w.last_fetch_time = 0, 0.01
+        >>> w._next_fetch_size(100, 300)
+        300
+        >>> w.fetch_bytes = 1024*1024
+        >>> w._next_fetch_size(100, 300)
+        600
+        >>> w._next_fetch_size(1000, 3000)
+        1048
+        >>> w._next_fetch_size(1000000, 300)
+        10
+        >>> w._next_fetch_size(1, 80000)
+        100000
+        >>> w.last_fetch_time = 4.0
+        >>> w._next_fetch_size(100, 8000)
+        2000
+        """
+        if not self.fetch_bytes:
+            return cur_size
+        want = int(self.fetch_bytes / max(avg, 1))
+        dur = self.last_fetch_time
+        if dur > self.max_fetch_time:
+            # latency is small compared to transfer time
+            want = min(want, int(cur_size * self.max_fetch_time / dur))
+        else:
+            # grow gradually, shrink immediately
+            want = min(want, cur_size * 2)
+        return max(self.min_fetch_size, min(want, self.max_fetch_size))
+
     def __iter__(self):
         if self.fetch_status:
             raise Exception("BatchWalker: double fetch? (%d)" % self.fetch_status)
         self.fetch_status = 1
 
-        q = "select * from pgq.get_batch_cursor(%s, %s, %s, %s)"
-        self.curs.execute(q, [self.batch_id, self.sql_cursor, self.fetch_size, self.consumer_filter])
         # this will return first batch of rows
-
-        q = "fetch %d from %s" % (self.fetch_size, self.sql_cursor)
+        q = "select %s from pgq.get_batch_cursor(%%s, %%s, %%s, %%s)" % ', '.join(EVENT_COLUMNS)
+        cur_size = self.fetch_size
+        rows = self._fetch(q, [self.batch_id, self.sql_cursor, cur_size, self.consumer_filter])
         while 1:
-            rows = self.curs.fetchall()
             if not len(rows):
                 break
 
             self.length += len(rows)
-            for row in rows:
-                ev = self._make_event(self.queue_name, row)
+            avg = self._measure_rows(rows)
+            self.row_bytes += int(avg * len(rows))
+            block = [self._make_event(self.queue_name, row) for row in rows]
+            if self.block_hook:
+                self.block_hook(block)
+            for ev in block:
                 yield ev
 
             # if less rows than requested, it was final block
-            if len(rows) < self.fetch_size:
+            if len(rows) < cur_size:
                 break
 
             # request next block of rows
-            self.curs.execute(q)
+            cur_size = self._next_fetch_size(avg, cur_size)
+            q = "fetch %d from %s" % (cur_size, self.sql_cursor)
+            rows = self._fetch(q)
 
         self.curs.execute("close %s" % self.sql_cursor)
 
         self.fetch_status = 2
+        self.fetch_size = cur_size
 
     def __len__(self):
         return self.length
@@ -92,6 +176,10 @@ class BaseConsumer(skytools.DBScript):
         # whether to use cursor to fetch events (0 disables)
         #pgq_lazy_fetch = 300
 
+        # adapt lazy fetch size to keep one fetched block under
+        # that much memory (0 disables)
+        #pgq_fetch_bytes = 8MB
+
         # whether to read from source size in autocommmit mode
         # not compatible with pgq_lazy_fetch
         # the actual user script on top of pgq.Consumer must also support it
@@ -108,6 +196,9 @@ class BaseConsumer(skytools.DBScript):
         # whether to stay behind queue top (postgres interval)
         #pgq_keep_lag =
 
+        # whether to allocate next batch in same round-trip as finish_batch (0 disables)
+        #pgq_prefetch = 0
+
         # in how many seconds to write keepalive stats for idle consumers
         # this stats is used for detecting that consumer is still running
         #keepalive_stats = 300
@@ -119,6 +210,9 @@ class BaseConsumer(skytools.DBScript):
     # should reader connection be used in autocommit mode
     pgq_autocommit = 0
 
+    # should next batch be allocated together with finish_batch
+    pgq_prefetch = 0
+
     # proper variables
     consumer_name = None
     queue_name = None
@@ -128,14 +222,22 @@ class BaseConsumer(skytools.DBScript):
     pgq_consumer_id = None
 
     pgq_lazy_fetch = None
+    pgq_fetch_bytes = None
     pgq_min_count = None
     pgq_min_interval = None
     pgq_min_lag = None
 
     batch_info = None
 
+    # batch info loaded by finish_batch in prefetch mode
+    _prefetch_info = None
+    _prefetch_conn = None
+
     consumer_filter = None
 
+    # rows per FETCH learned by previous batch walker
+    _fetch_size = None
+
     keepalive_stats = None
     # statistics: time spent waiting for events
     idle_start = None
@@ -182,12 +284,17 @@ class BaseConsumer(skytools.DBScript):
         skytools.DBScript.reload(self)
 
         self.pgq_lazy_fetch = self.cf.getint("pgq_lazy_fetch", self.default_lazy_fetch)
+        self.pgq_fetch_bytes = self.cf.getbytes("pgq_fetch_bytes", "0")
+        self._fetch_size = None
 
         # set following ones to None if not set
         self.pgq_min_count = self.cf.getint("pgq_batch_collect_events", 0) or None
         self.pgq_min_interval = self.cf.get("pgq_batch_collect_interval", '') or None
         self.pgq_min_lag = self.cf.get("pgq_keep_lag", '') or None
 
+        self.pgq_prefetch = self.cf.getint("pgq_prefetch", self.pgq_prefetch)
+        self._prefetch_info = None
+
         # filter out specific tables only
         tfilt = []
         for t in self.cf.getlist('table_filter', ''):
@@ -259,6 +366,8 @@ class BaseConsumer(skytools.DBScript):
         # done
         self._finish_batch(curs, batch_id, ev_list)
         db.commit()
+        self.stat_fetch(ev_list)
+        self._save_fetch_size(ev_list)
         self.stat_end(len(ev_list))
 
         return 1
@@ -291,12 +400,13 @@ class BaseConsumer(skytools.DBScript):
     def _load_batch_events_old(self, curs, batch_id):
         """Fetch all events for this batch."""
 
-        # load events
-        sql = "select * from pgq.get_batch_events(%d)" % batch_id
+        # load events as tuples
+        sql = "select %s from pgq.get_batch_events(%d)" % (', '.join(EVENT_COLUMNS), batch_id)
         if self.consumer_filter is not None:
             sql += " where %s" % self.consumer_filter
-        curs.execute(sql)
-        rows = curs.fetchall()
+        ev_curs = curs.connection.cursor(cursor_factory = EventCursor)
+        ev_curs.execute(sql)
+        rows = ev_curs.fetchall()
 
         # map them to python objects
         ev_list = []
@@ -310,17 +420,31 @@ class BaseConsumer(skytools.DBScript):
         """Fetch all events for this batch."""
 
         if self.pgq_lazy_fetch:
-            return self._batch_walker_class(curs, batch_id, self.queue_name, self.pgq_lazy_fetch, self.consumer_filter)
+            fetch_size = self._fetch_size or self.pgq_lazy_fetch
+            return self._batch_walker_class(curs, batch_id, self.queue_name, fetch_size,
+                                            self.consumer_filter, self.pgq_fetch_bytes)
         else:
             return self._load_batch_events_old(curs, batch_id)
 
     def _load_next_batch(self, curs):
         """Allocate next batch. (internal)"""
 
-        q = """select * from pgq.next_batch_custom(%s, %s, %s, %s, %s)"""
-        curs.execute(q, [self.queue_name, self.consumer_name,
-                         self.pgq_min_lag, self.pgq_min_count, self.pgq_min_interval])
-        inf = curs.fetchone().copy()
+        # use batch allocated by previous finish_batch
+        inf = self._prefetch_info
+        self._prefetch_info = None
+        if inf is not None and self._prefetch_conn is curs.connection:
+            return self._set_batch_info(inf)
+
+        q = "select * from pgq.next_batch_custom(%s, %s, %s, %s, %s)"
+        curs.execute(q, self._next_batch_args())
+        return self._set_batch_info(curs.fetchone())
+
+    def _next_batch_args(self):
+        return [self.queue_name, self.consumer_name,
+                self.pgq_min_lag, self.pgq_min_count, self.pgq_min_interval]
+
+    def _set_batch_info(self, row):
+        inf = row.copy()
         inf['tick_id'] = inf['cur_tick_id']
         inf['batch_end'] = inf['cur_tick_time']
         inf['batch_start'] = inf['prev_tick_time']
@@ -330,9 +454,22 @@ class BaseConsumer(skytools.DBScript):
         return self.batch_info['batch_id']
 
     def _finish_batch(self, curs, batch_id, list):
-        """Tag events and notify that the batch is done."""
+        """Tag events and notify that the batch is done.
+
+        In prefetch mode next batch is allocated in same round-trip,
+        it will be picked up by next _load_next_batch() call.
+        """
 
-        curs.execute("select pgq.finish_batch(%s)", [batch_id])
+        if not self.pgq_prefetch:
+            curs.execute("select pgq.finish_batch(%s)", [batch_id])
+            return
+
+        q = "select pgq.finish_batch(%s); select * from pgq.next_batch_custom(%s, %s, %s, %s, %s)"
+        curs.execute(q, [batch_id] + self._next_batch_args())
+        row = curs.fetchone()
+        if row['batch_id'] is not None:
+            self._prefetch_info = row
+            self._prefetch_conn = curs.connection
 
     def stat_start(self):
         t = time.time()
@@ -341,6 +478,23 @@ class BaseConsumer(skytools.DBScript):
             self.stat_put('idle', round(self.stat_batch_start - self.idle_start,4))
             self.idle_start = t
 
+    def stat_fetch(self, ev_list):
+        """Report fetch statistics from batch walker."""
+        if not isinstance(ev_list, BaseBatchWalker) or not ev_list.fetch_count:
+            return
+        self.stat_put('fetch-count', ev_list.fetch_count)
+        self.stat_put('fetch-bytes', ev_list.row_bytes)
+        self.stat_put('fetch-duration', round(ev_list.fetch_time, 4))
+        if self.pgq_fetch_bytes:
+            self.stat_put('fetch-size', ev_list.fetch_size)
+
+    def _save_fetch_size(self, ev_list):
+        """Continue next batch with fetch size adapted in this one."""
+        if not self.pgq_fetch_bytes or not isinstance(ev_list, BaseBatchWalker):
+            return
+        if ev_list.fetch_status == 2:
+            self._fetch_size = ev_list.fetch_size
+
     def stat_end(self, count):
         t = time.time()
         self.stat_put('count', count)
@@ -348,3 +502,7 @@ class BaseConsumer(skytools.DBScript):
         if count > 0: # reset timer if we got some events
             self.stat_put('idle', round(self.stat_batch_start - self.idle_start,4))
             self.idle_start = t
+
+if __name__ == '__main__':
+    import doctest
+    doctest.testmod()
@@ -99,6 +99,15 @@ class CascadedWorker(CascadedConsumer):
 
         # how often the nodes should report their wm upstream (seconds)
         #local_wm_publish_period = 300
+
+        # copy events to target queue with COPY stream from provider,
+        # only cascade events are loaded into Python.  Used only when
+        # worker state does not process events itself, otherwise
+        # batch would be read twice from provider.
+        #pass_through = 0
+
+        # with sync_watermark, how long to wait for other nodes (seconds)
+        #sync_watermark_timeout = 10
     """
 
     global_wm_publish_time = 0
@@ -119,6 +128,15 @@ class CascadedWorker(CascadedConsumer):
 
     real_global_wm = None
 
+    pass_through = False
+
+    sync_watermark_timeout = 10
+    # nodes that have cached connection for watermark sync
+    wm_sync_conns = ()
+
+    # events that are processed even without process_events
+    CASCADE_EVENT_FILTER = "(ev_type like 'pgq.%' or ev_type like 'londiste.%')"
+
     def __init__(self, service_name, db_name, args):
         """Initialize new consumer.
 
@@ -134,6 +152,47 @@ class CascadedWorker(CascadedConsumer):
 
         self.global_wm_publish_period = self.cf.getfloat('global_wm_publish_period', CascadedWorker.global_wm_publish_period)
         self.local_wm_publish_period = self.cf.getfloat('local_wm_publish_period', CascadedWorker.local_wm_publish_period)
+        self.pass_through = self.cf.getboolean('pass_through', False)
+        self.sync_watermark_timeout = self.cf.getfloat('sync_watermark_timeout', CascadedWorker.sync_watermark_timeout)
+
+    def use_pass_through(self):
+        """Should current batch be streamed to target queue.
+
+        Nodes that process events need all of them loaded anyway,
+        so they copy from loaded events instead of reading batch
+        second time.
+
+        >>> w = CascadedWorker.__new__(CascadedWorker)
+        >>> w.pass_through = True
+        >>> w._worker_state = WorkerState('q', {'node_type': 'branch',
+        ...         'node_name': 'n2', 'local_watermark': 5,
+        ...         'global_watermark': 3, 'combined_type': None})
+        >>> w.use_pass_through()
+        False
+        >>> w._worker_state.process_events = 0
+        >>> w.use_pass_through()
+        True
+        >>> w.pass_through = False
+        >>> w.use_pass_through()
+        False
+        """
+        st = self._worker_state
+        return bool(self.pass_through and self.main_worker
+                    and st.copy_events and not st.process_events)
+
+    def _load_batch_events(self, curs, batch_id):
+        """In pass-through mode load only cascade events."""
+        if not self.use_pass_through():
+            return CascadedConsumer._load_batch_events(self, curs, batch_id)
+        orig_filter = self.consumer_filter
+        if orig_filter:
+            self.consumer_filter = "(%s) and %s" % (orig_filter, self.CASCADE_EVENT_FILTER)
+        else:
+            self.consumer_filter = self.CASCADE_EVENT_FILTER
+        try:
+            return CascadedConsumer._load_batch_events(self, curs, batch_id)
+        finally:
+            self.consumer_filter = orig_filter
 
     def process_remote_batch(self, src_db, tick_id, event_list, dst_db):
         """Worker-specific event processing."""
@@ -146,8 +205,15 @@ class CascadedWorker(CascadedConsumer):
 
         src_curs = src_db.cursor()
         dst_curs = dst_db.cursor()
+
+        copy_events = st.copy_events
+        if self.use_pass_through():
+            self.stream_events(src_curs, dst_curs)
+            copy_events = False
+            max_id = self.batch_info['seq_end']
+
         for ev in event_list:
-            if st.copy_events:
+            if copy_events:
                 self.copy_event(dst_curs, ev, st.filtered_copy)
             if ev.ev_type.split('.', 1)[0] in ("pgq", "londiste"):
                 # process cascade events even on waiting leaf node
@@ -252,6 +318,7 @@ class CascadedWorker(CascadedConsumer):
             if self.real_global_wm < wm:
                 wm = self.real_global_wm
 
+            poll_list = []
             for node in st.wm_sync_nodes:
                 if node == st.node_name:
                     continue
@@ -263,24 +330,60 @@ class CascadedWorker(CascadedConsumer):
                 if n['dead']:
                     # ignore dead nodes
                     continue
-                wmdb = self.get_database('wmdb', connstr = n['node_location'], autocommit = 1, profile = 'remote')
-                wmcurs = wmdb.cursor()
-                q = 'select local_watermark from pgq_node.get_node_info(%s)'
-                wmcurs.execute(q, [self.queue_name])
-                row = wmcurs.fetchone()
-                if not row:
+                poll_list.append((node, n['node_location']))
+
+            # drop connections to nodes that are not polled anymore
+            polled = set([node for node, loc in poll_list])
+            for node in self.wm_sync_conns:
+                if node not in polled:
+                    self.close_database('wmdb_' + node)
+            self.wm_sync_conns = polled
+
+            # query all nodes at once
+            res = skytools.run_parallel(self._get_node_watermark, poll_list, len(poll_list))
+            for (node, loc), node_wm in zip(poll_list, res):
+                if node_wm is False:
+                    # cannot tell how far node is, so keep old wm
+                    self.log.warning('Node not reachable, global watermark not updated: %s', node)
+                    return
+                elif node_wm is None:
                     # partially set up node?
                     self.log.warning('Node not working: %s', node)
-                elif row['local_watermark'] < wm:
+                elif node_wm < wm:
                     # keep lowest wm
-                    wm = row['local_watermark']
-                self.close_database('wmdb')
+                    wm = node_wm
 
             # now we have lowest wm, store it
             q = "select pgq_node.set_global_watermark(%s, %s)"
             dst_curs.execute(q, [self.queue_name, wm])
             dst_db.commit()
 
+    def _get_node_watermark(self, node, location):
+        """Fetch local watermark of other node, on cached connection.
+
+        Returns None if node has no info for queue, False if node
+        could not be queried in sync_watermark_timeout.
+        """
+        cache = 'wmdb_' + node
+        timeout = self.sync_watermark_timeout
+        if timeout > 0 and 'connect_timeout' not in location:
+            location += ' connect_timeout=%d' % max(1, int(timeout))
+        try:
+            wmdb = self.get_database('wmdb', cache = cache, connstr = location,
+                                     autocommit = 1, profile = 'remote')
+            wmcurs = wmdb.cursor()
+            wmcurs.execute("set statement_timeout = %s", [int(timeout * 1000)])
+            q = 'select local_watermark from pgq_node.get_node_info(%s)'
+            wmcurs.execute(q, [self.queue_name])
+            row = wmcurs.fetchone()
+        except Exception, d:
+            self.log.warning('Failed to get watermark from node %s: %s', node, str(d))
+            self.close_database(cache)
+            return False
+        if not row:
+            return None
+        return row['local_watermark']
+
     def _get_node_map(self, curs):
         q = "select node_name, node_location, dead from pgq_node.get_queue_locations(%s)"
         curs.execute(q, [self.queue_name])
@@ -401,11 +504,98 @@ class CascadedWorker(CascadedConsumer):
             st = self._worker_state
             if st.sync_watermark:
                 # replace payload with synced global watermark
-                row = ev._event_row.copy()
+                row = dict(ev.items())
                 row['ev_data'] = str(st.global_watermark)
                 ev = Event(self.queue_name, row)
         self.ev_buf.append(ev)
 
+    def get_copy_filter(self, filtered_copy):
+        """SQL condition for events streamed to target queue.
+
+        Must skip same events as copy_event().
+        """
+        if filtered_copy:
+            return "ev_type not like 'pgq.%'"
+        return None
+
+    def stream_events(self, src_curs, dst_curs):
+        """Copy whole batch to target queue with COPY.
+
+        Rows go straight from provider to target, without
+        Python object per event.
+        """
+        st = self._worker_state
+        dst_curs.execute("select pgq.current_event_table(%s)", [st.target_queue])
+        tbl = dst_curs.fetchone()[0]
+
+        sql_to, sql_from = self.get_stream_sql(tbl, self.batch_info['batch_id'])
+        pipe = skytools.CopyPipe(dst_curs, sql_from = sql_from, double_buffer = True)
+        try:
+            src_curs.copy_expert(sql_to, pipe)
+            pipe.flush()
+        finally:
+            pipe.close()
+        self.log.debug("pass-through: copied %d events (%d bytes)", pipe.total_rows, pipe.total_bytes)
+        self.stat_increase('copied_events', pipe.total_rows)
+
+    def get_stream_sql(self, tbl, batch_id):
+        """Return COPY statements for provider and target side.
+
+        >>> w = CascadedWorker.__new__(CascadedWorker)
+        >>> w.consumer_filter = None
+        >>> w._worker_state = WorkerState('q', {'node_type': 'branch',
+        ...         'node_name': 'n2', 'local_watermark': 5,
+        ...         'global_watermark': 3, 'combined_type': None})
+        >>> sql_to, sql_from = w.get_stream_sql('pgq.event_2_1', 10)
+        >>> sql_to
+        'COPY (select ev_time, ev_type, ev_data, ev_extra1, ev_extra2, ev_extra3, ev_extra4, ev_id from pgq.get_batch_events(10)) TO STDOUT'
+        >>> sql_from
+        'COPY pgq.event_2_1 (ev_time, ev_type, ev_data, ev_extra1, ev_extra2, ev_extra3, ev_extra4, ev_id) FROM STDIN'
+
+        With sync_watermark the global watermark payload is replaced:
+
+        >>> w._worker_state = WorkerState('q', {'node_type': 'branch',
+        ...         'node_name': 'n2', 'local_watermark': 5,
+        ...         'global_watermark': 3, 'combined_type': None,
+        ...         'node_attrs': 'sync_watermark=n3'})
+        >>> print w.get_stream_sql('pgq.event_2_1', 10)[0]
+        COPY (select ev_time, ev_type, case when ev_type = 'pgq.global-watermark' then '3' else ev_data end, ev_extra1, ev_extra2, ev_extra3, ev_extra4, ev_id from pgq.get_batch_events(10)) TO STDOUT
+
+        Filtered copy to combined queue, with consumer filter:
+
+        >>> w.consumer_filter = "ev_type <> 'x'"
+        >>> w._worker_state = WorkerState('q', {'node_type': 'leaf',
+        ...         'node_name': 'n2', 'local_watermark': 5,
+        ...         'global_watermark': 3, 'combined_type': 'root',
+        ...         'combined_queue': 'cq'})
+        >>> print w.get_stream_sql('pgq.event_3_1', 10)[0]
+        COPY (select ev_time, ev_type, ev_data, ev_extra1, ev_extra2, ev_extra3, ev_extra4 from pgq.get_batch_events(10) where (ev_type <> 'x') and (ev_type not like 'pgq.%')) TO STDOUT
+        """
+        st = self._worker_state
+        flds = ['ev_time', 'ev_type', 'ev_data', 'ev_extra1',
+                'ev_extra2', 'ev_extra3', 'ev_extra4']
+        if st.keep_event_ids:
+            flds.append('ev_id')
+        cols = flds[:]
+        if st.sync_watermark:
+            # replace payload with synced global watermark
+            wm = skytools.quote_literal(str(st.global_watermark))
+            cols[2] = "case when ev_type = 'pgq.global-watermark' then %s else ev_data end" % wm
+
+        conds = []
+        if self.consumer_filter:
+            conds.append("(%s)" % self.consumer_filter)
+        copy_filter = self.get_copy_filter(st.filtered_copy)
+        if copy_filter:
+            conds.append("(%s)" % copy_filter)
+        q = "select %s from pgq.get_batch_events(%d)" % (", ".join(cols), batch_id)
+        if conds:
+            q += " where " + " and ".join(conds)
+
+        sql_to = "COPY (%s) TO STDOUT" % q
+        sql_from = "COPY %s (%s) FROM STDIN" % (tbl, ", ".join(flds))
+        return sql_to, sql_from
+
     def flush_events(self, dst_curs):
         """Send copy buffer to target queue.
         """
@@ -444,3 +634,7 @@ class CascadedWorker(CascadedConsumer):
         dst_curs.execute(q, [self.pgq_queue_name])
         dst_db.commit()
         self.global_wm_publish_time = t
+
+if __name__ == '__main__':
+    import doctest
+    doctest.testmod()
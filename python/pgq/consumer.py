@@ -63,8 +63,8 @@ class RetriableBatchWalker(BaseBatchWalker):
     """BatchWalker that returns RetriableEvents
     """
 
-    def __init__(self, curs, batch_id, queue_name, fetch_size = 300, consumer_filter = None):
-        super(RetriableBatchWalker, self).__init__(curs, batch_id, queue_name, fetch_size, consumer_filter)
+    def __init__(self, curs, batch_id, queue_name, fetch_size = 300, consumer_filter = None, fetch_bytes = 0):
+        super(RetriableBatchWalker, self).__init__(curs, batch_id, queue_name, fetch_size, consumer_filter, fetch_bytes)
         self.status_map = {}
 
     def _make_event(self, queue_name, row):
@@ -95,26 +95,34 @@ class Consumer(BaseConsumer):
     def _make_event(self, queue_name, row):
         return RetriableEvent(queue_name, row)
 
+    # does server have pgq.event_retry(bigint, bigint[], integer)
+    _bulk_retry = None
+    _bulk_retry_conn = None
+
     def _flush_retry(self, curs, batch_id, list):
         """Tag retry events."""
 
         retry = 0
+        retry_map = {}
         if self.pgq_lazy_fetch:
             for ev_id, stat in list.iter_status():
                 if stat[0] == EV_RETRY:
-                    self._tag_retry(curs, batch_id, ev_id, stat[1])
+                    retry_map.setdefault(stat[1], []).append(ev_id)
                     retry += 1
                 elif stat[0] != EV_DONE:
                     raise Exception("Untagged event: id=%d" % ev_id)
         else:
             for ev in list:
                 if ev._status == EV_RETRY:
-                    self._tag_retry(curs, batch_id, ev.id, ev.retry_time)
+                    retry_map.setdefault(ev.retry_time, []).append(ev.id)
                     retry += 1
                 elif ev._status != EV_DONE:
                     raise Exception("Untagged event: (id=%d, type=%s, data=%s, ex1=%s" % (
                                     ev.id, ev.type, ev.data, ev.extra1))
 
+        for retry_time, ev_id_list in retry_map.iteritems():
+            self._tag_retry_list(curs, batch_id, ev_id_list, retry_time)
+
         # report weird events
         if retry:
             self.stat_increase('retry-events', retry)
@@ -130,3 +138,30 @@ class Consumer(BaseConsumer):
         """Tag event for retry. (internal)"""
         cx.execute("select pgq.event_retry(%s, %s, %s)",
                     [batch_id, ev_id, retry_time])
+
+    def _tag_retry_list(self, cx, batch_id, ev_id_list, retry_time):
+        """Tag several events for retry with one call. (internal)
+
+        Array version takes only seconds, other retry_time values
+        (eg. datetime) and older servers use per-event calls.
+        """
+        if not isinstance(retry_time, (int, long)) or not self._has_bulk_retry(cx):
+            for ev_id in ev_id_list:
+                self._tag_retry(cx, batch_id, ev_id, retry_time)
+            return
+        cx.execute("select pgq.event_retry(%s, %s::int8[], %s)",
+                    [batch_id, ev_id_list, retry_time])
+
+    def _has_bulk_retry(self, cx):
+        """Check if array version of pgq.event_retry() exists. (internal)"""
+        if self._bulk_retry_conn is not cx.connection:
+            q = """select count(1) from pg_namespace n, pg_proc p
+                    where p.pronamespace = n.oid
+                      and n.nspname = 'pgq'
+                      and p.proname = 'event_retry'
+                      and p.pronargs = 3
+                      and p.proargtypes[1] = 'int8[]'::regtype::oid"""
+            cx.execute(q)
+            self._bulk_retry = cx.fetchone()[0] > 0
+            self._bulk_retry_conn = cx.connection
+        return self._bulk_retry
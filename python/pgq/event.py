@@ -1,47 +1,80 @@
-
 """PgQ event container.
 """
 
-__all__ = ['Event']
+import psycopg2.extensions
+
+__all__ = ['Event', 'EventCursor', 'EVENT_COLUMNS']
+
+#: column order of pgq.get_batch_events() and pgq.get_batch_cursor()
+EVENT_COLUMNS = ('ev_id', 'ev_time', 'ev_txid', 'ev_retry', 'ev_type',
+                 'ev_data', 'ev_extra1', 'ev_extra2', 'ev_extra3', 'ev_extra4')
+
+# slot names for EVENT_COLUMNS
+_slotlist = ('id', 'time', 'txid', 'retry', 'type',
+             'data', 'extra1', 'extra2', 'extra3', 'extra4')
 
 _fldmap = {
-        'ev_id': 'ev_id',
-        'ev_txid': 'ev_txid',
-        'ev_time': 'ev_time',
-        'ev_type': 'ev_type',
-        'ev_data': 'ev_data',
-        'ev_extra1': 'ev_extra1',
-        'ev_extra2': 'ev_extra2',
-        'ev_extra3': 'ev_extra3',
-        'ev_extra4': 'ev_extra4',
-        'ev_retry': 'ev_retry',
-
-        'id': 'ev_id',
-        'txid': 'ev_txid',
-        'time': 'ev_time',
-        'type': 'ev_type',
-        'data': 'ev_data',
-        'extra1': 'ev_extra1',
-        'extra2': 'ev_extra2',
-        'extra3': 'ev_extra3',
-        'extra4': 'ev_extra4',
-        'retry': 'ev_retry',
+        'ev_id': 'id',
+        'ev_txid': 'txid',
+        'ev_time': 'time',
+        'ev_type': 'type',
+        'ev_data': 'data',
+        'ev_extra1': 'extra1',
+        'ev_extra2': 'extra2',
+        'ev_extra3': 'extra3',
+        'ev_extra4': 'extra4',
+        'ev_retry': 'retry',
+
+        'id': 'id',
+        'txid': 'txid',
+        'time': 'time',
+        'type': 'type',
+        'data': 'data',
+        'extra1': 'extra1',
+        'extra2': 'extra2',
+        'extra3': 'extra3',
+        'extra4': 'extra4',
+        'retry': 'retry',
 }
 
+class EventCursor(psycopg2.extensions.cursor):
+    """Cursor that returns event rows as plain tuples.
+
+    Columns must be in EVENT_COLUMNS order.
+    """
+
 class Event(object):
     """Event data for consumers.
 
+    Fields are stored in slots, row can be either tuple
+    in EVENT_COLUMNS order or dict-like object.
+
     Will be removed from the queue by default.
     """
-    __slots__ = ('_event_row', 'retry_time', 'queue_name')
+    __slots__ = _slotlist + ('retry_time', 'queue_name')
 
     def __init__(self, queue_name, row):
-        self._event_row = row
+        if isinstance(row, tuple):
+            (self.id, self.time, self.txid, self.retry, self.type, self.data,
+             self.extra1, self.extra2, self.extra3, self.extra4) = row
+        else:
+            g = row.get
+            (self.id, self.time, self.txid, self.retry, self.type, self.data,
+             self.extra1, self.extra2, self.extra3, self.extra4) = [g(k) for k in EVENT_COLUMNS]
         self.retry_time = 60
         self.queue_name = queue_name
 
-    def __getattr__(self, key):
-        return self._event_row[_fldmap[key]]
+    # long field names
+    ev_id = property(lambda self: self.id)
+    ev_time = property(lambda self: self.time)
+    ev_txid = property(lambda self: self.txid)
+    ev_retry = property(lambda self: self.retry)
+    ev_type = property(lambda self: self.type)
+    ev_data = property(lambda self: self.data)
+    ev_extra1 = property(lambda self: self.extra1)
+    ev_extra2 = property(lambda self: self.extra2)
+    ev_extra3 = property(lambda self: self.extra3)
+    ev_extra4 = property(lambda self: self.extra4)
 
     # would be better in RetriableEvent only since we don't care but
     # unfortunately it needs to be defined here due to compatibility concerns
@@ -49,15 +82,21 @@ class Event(object):
         pass
 
     # be also dict-like
-    def __getitem__(self, k): return self._event_row.__getitem__(k)
-    def __contains__(self, k): return self._event_row.__contains__(k)
-    def get(self, k, d=None): return self._event_row.get(k, d)
-    def has_key(self, k): return self._event_row.has_key(k)
-    def keys(self): return self._event_row.keys()
-    def values(self): return self._event_row.keys()
-    def items(self): return self._event_row.items()
-    def iterkeys(self): return self._event_row.iterkeys()
-    def itervalues(self): return self._event_row.itervalues()
+    def __getitem__(self, k):
+        if isinstance(k, (int, long)):
+            return getattr(self, _slotlist[k])
+        return getattr(self, _fldmap[k])
+    def __contains__(self, k): return k in EVENT_COLUMNS
+    def get(self, k, d=None):
+        if k in _fldmap:
+            return getattr(self, _fldmap[k])
+        return d
+    def has_key(self, k): return k in EVENT_COLUMNS
+    def keys(self): return list(EVENT_COLUMNS)
+    def values(self): return [getattr(self, k) for k in _slotlist]
+    def items(self): return zip(EVENT_COLUMNS, self.values())
+    def iterkeys(self): return iter(EVENT_COLUMNS)
+    def itervalues(self): return iter(self.values())
 
     def __str__(self):
         return "<id=%d type=%s data=%s e1=%s e2=%s e3=%s e4=%s>" % (
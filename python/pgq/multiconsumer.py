@@ -0,0 +1,179 @@
+"""PgQ consumer that reads several queues in one process.
+"""
+
+import sys, time
+
+import skytools
+
+from pgq.consumer import Consumer
+
+__all__ = ['MultiQueueConsumer']
+
+
+class QueueState(object):
+    """Scheduling state for one queue/consumer pair."""
+
+    def __init__(self, queue_name, consumer_name):
+        self.queue_name = queue_name
+        self.consumer_name = consumer_name
+        # when to look for next batch
+        self.next_check = 0
+        # batch allocated by finish_batch in prefetch mode
+        self.prefetch_info = None
+        # last processing attempt failed
+        self.failed = False
+
+
+class MultiQueueConsumer(Consumer):
+    """Consumer that multiplexes many queue/consumer pairs
+    over single database connection.
+
+    Queues that have batches are processed round-robin, idle
+    queues are checked again after loop_delay.  If pgq_listen_channel
+    is set, notification on that channel wakes up idle queues
+    immediately - payload can be queue name to wake only that queue.
+
+    Error in one queue is logged and that queue is retried after
+    exception_sleep, other queues are processed meanwhile.  Exception
+    is passed on only when all queues are failing.
+
+    process_batch() is called with same arguments as in pgq.Consumer,
+    current queue is available as self.queue_name and ev.queue_name.
+
+    Config template::
+
+        ## Parameters for pgq.MultiQueueConsumer ##
+
+        # queues to read from, optionally with consumer name: queue:consumer
+        queue_list =
+
+        # channel to LISTEN on source db for wakeups
+        #pgq_listen_channel =
+    """
+
+    # queue_list is used instead of queue_name
+    cf_defaults = {'queue_name': ''}
+
+    def __init__(self, service_name, db_name, args):
+        """Initialize new consumer.
+
+        @param service_name: service_name for DBScript
+        @param db_name: name of database for get_database()
+        @param args: cmdline args for DBScript
+        """
+        # reload() needs them
+        self.queue_states = []
+        self.db_name = db_name
+        Consumer.__init__(self, service_name, db_name, args)
+
+    def reload(self):
+        Consumer.reload(self)
+
+        # keep state for queues that stay
+        old = {}
+        for st in self.queue_states:
+            old[(st.queue_name, st.consumer_name)] = st
+
+        default_cname = self.cf.get("consumer_name", self.job_name)
+        states = []
+        for elem in self.cf.getlist("queue_list"):
+            tmp = elem.split(':', 1)
+            qname = tmp[0].strip()
+            cname = default_cname
+            if len(tmp) > 1:
+                cname = tmp[1].strip()
+            key = (qname, cname)
+            states.append(old.get(key) or QueueState(qname, cname))
+        self.queue_states = states
+
+        listen_channel = self.cf.get("pgq_listen_channel", '')
+        self.unlisten(self.db_name)
+        if listen_channel:
+            self.listen(self.db_name, listen_channel)
+
+    def _set_queue(self, st):
+        """Make BaseConsumer machinery work on that queue."""
+        self.queue_name = self.pgq_queue_name = st.queue_name
+        self.consumer_name = self.consumer_id = st.consumer_name
+        self._prefetch_info = st.prefetch_info
+
+    def _save_queue(self, st):
+        st.prefetch_info = self._prefetch_info
+        self._prefetch_info = None
+
+    def work(self):
+        """Process one batch from each queue that is due.
+
+        Returns true if some queue had a batch.
+        """
+        found = 0
+        errors = []
+        now = time.time()
+        for st in self.queue_states:
+            if st.next_check > now:
+                continue
+            self._set_queue(st)
+            try:
+                res = Consumer.work(self)
+            except (skytools.UsageError, MemoryError):
+                self._save_queue(st)
+                raise
+            except Exception, d:
+                self._save_queue(st)
+                errors.append(sys.exc_info())
+                self._queue_failed(st, d)
+                continue
+            self._save_queue(st)
+            st.failed = False
+            if res:
+                found = 1
+                st.next_check = 0
+            else:
+                st.next_check = now + self.loop_delay
+
+        # give up only if no queue is working
+        if errors and not [st for st in self.queue_states if not st.failed]:
+            err = errors[0]
+            raise err[0], err[1], err[2]
+        return found
+
+    def _queue_failed(self, st, d):
+        """Log error, postpone failed queue and drop connections."""
+        st.failed = True
+        st.next_check = time.time() + self.exception_sleep
+        for qst in self.queue_states:
+            qst.prefetch_info = None
+        self.exception_hook(d, "queue %s: %s" % (st.queue_name, str(d).rstrip()))
+        self.reset()
+
+    def sleep(self, secs):
+        """Sleep until next queue is due or notification arrives."""
+        if self.queue_states:
+            due = min([st.next_check for st in self.queue_states]) - time.time()
+            secs = max(0, min(secs, due))
+        Consumer.sleep(self, secs)
+        self._check_notifies()
+
+    def _check_notifies(self):
+        """Wake up queues that got notification."""
+        dbc = self.db_cache.get(self.db_name)
+        conn = dbc and dbc.conn
+        if not conn or not self._listen_map.get(self.db_name):
+            return
+        conn.poll()
+        for n in conn.notifies:
+            payload = getattr(n, 'payload', '')
+            for st in self.queue_states:
+                if not payload or payload == st.queue_name:
+                    st.next_check = 0
+        del conn.notifies[:]
+
+    def register_consumer(self):
+        for st in self.queue_states:
+            self._set_queue(st)
+            Consumer.register_consumer(self)
+
+    def unregister_consumer(self):
+        for st in self.queue_states:
+            self._set_queue(st)
+            Consumer.unregister_consumer(self)
@@ -75,6 +75,7 @@ _symbols = {
     # skytools.quoting
     'db_urldecode': 'skytools.quoting:db_urldecode',
     'db_urlencode': 'skytools.quoting:db_urlencode',
+    'decode_urlenc_batch': 'skytools.quoting:decode_urlenc_batch',
     'json_decode': 'skytools.quoting:json_decode',
     'json_encode': 'skytools.quoting:json_encode',
     'make_pgarray': 'skytools.quoting:make_pgarray',
@@ -133,6 +134,9 @@ _symbols = {
     'mk_delete_sql': 'skytools.sqltools:mk_delete_sql',
     'mk_insert_sql': 'skytools.sqltools:mk_insert_sql',
     'mk_update_sql': 'skytools.sqltools:mk_update_sql',
+    # skytools.threadutil
+    'WorkerThread': 'skytools.threadutil:WorkerThread',
+    'run_parallel': 'skytools.threadutil:run_parallel',
     # skytools.timeutil
     'FixedOffsetTimezone': 'skytools.timeutil:FixedOffsetTimezone',
     'datetime_to_timestamp': 'skytools.timeutil:datetime_to_timestamp',
@@ -167,6 +171,7 @@ elif 1:
     from skytools.querybuilder import *
     from skytools.skylog import *
     from skytools.sockutil import *
+    from skytools.threadutil import *
     from skytools.timeutil import *
     from skytools.utf8 import *
 else:
@@ -192,6 +197,7 @@ else:
     import skytools.skylog
     import skytools.sockutil
     import skytools.sqltools
+    import skytools.threadutil
     import skytools.timeutil
     import skytools.utf8
     xall = (  skytools.adminscript.__all__
@@ -210,6 +216,7 @@ else:
             + skytools.skylog.__all__
             + skytools.sockutil.__all__
             + skytools.sqltools.__all__
+            + skytools.threadutil.__all__
             + skytools.timeutil.__all__
             + skytools.utf8.__all__ )
     for k in __all__:
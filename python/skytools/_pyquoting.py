@@ -10,7 +10,7 @@ import urllib, re
 __all__ = [
     "quote_literal", "quote_copy", "quote_bytea_raw",
     "db_urlencode", "db_urldecode", "unescape",
-    "unquote_literal",
+    "unquote_literal", "decode_urlenc_batch",
 ]
 
 # 
@@ -118,6 +118,41 @@ def db_urldecode(qs):
             res[name] = urllib.unquote_plus(pair[1])
     return res
 
+def decode_urlenc_batch(qs_list):
+    """Urldecode list of strings to columns.
+
+    Returns tuple of column names, in order of first appearance,
+    and list of value lists, one list per column.  Keys without '='
+    and keys missing from string give None.
+
+    Python implementation.
+    """
+
+    names = []
+    cols = []
+    colmap = {}
+    for row, qs in enumerate(qs_list):
+        for col in cols:
+            col.append(None)
+        if qs is None:
+            continue
+        for elem in qs.split('&'):
+            if not elem:
+                continue
+            pair = elem.split('=', 1)
+            k = intern(str(urllib.unquote_plus(pair[0])))
+            if len(pair) == 1:
+                v = None
+            else:
+                v = urllib.unquote_plus(pair[1])
+            i = colmap.get(k)
+            if i is None:
+                i = colmap[k] = len(names)
+                names.append(k)
+                cols.append([None] * (row + 1))
+            cols[i][row] = v
+    return tuple(names), cols
+
 #
 # Remove C-like backslash escapes
 #
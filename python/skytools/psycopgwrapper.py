@@ -107,14 +107,14 @@ class _CompatCursor(psycopg2.extras.DictCursor):
 class _CompatConnection(psycopg2.extensions.connection):
     """Connection object that uses _CompatCursor."""
     my_name = '?'
-    def cursor(self, name = None):
+    def cursor(self, name = None, cursor_factory = _CompatCursor):
         if name:
             return psycopg2.extensions.connection.cursor(self,
-                    cursor_factory = _CompatCursor,
+                    cursor_factory = cursor_factory,
                     name = name)
         else:
             return psycopg2.extensions.connection.cursor(self,
-                    cursor_factory = _CompatCursor)
+                    cursor_factory = cursor_factory)
 
 def connect_database(connstr, keepalive = True,
                      tcp_keepidle = 4 * 60,     # 7200
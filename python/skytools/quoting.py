@@ -8,7 +8,7 @@ __all__ = [
     # _pyqoting / _cquoting
     "quote_literal", "quote_copy", "quote_bytea_raw",
     "db_urlencode", "db_urldecode", "unescape",
-    "unquote_literal",
+    "unquote_literal", "decode_urlenc_batch",
     # local
     "quote_bytea_literal", "quote_bytea_copy", "quote_statement",
     "quote_ident", "quote_fqident", "quote_json", "unescape_copy",
@@ -2,6 +2,8 @@
 """Database tools."""
 
 import os
+import array
+import bisect
 from cStringIO import StringIO
 import skytools
 
@@ -10,6 +12,16 @@ try:
 except ImportError:
     pass
 
+# array type for 64-bit txids, 'q' is missing in older Pythons
+_txid_array_type = None
+for _t in ('q', 'l'):
+    try:
+        if array.array(_t).itemsize == 8:
+            _txid_array_type = _t
+            break
+    except ValueError:
+        pass
+
 __all__ = [
     "fq_name_parts", "fq_name", "get_table_oid", "get_table_pkeys",
     "get_table_columns", "exists_schema", "exists_table", "exists_type",
@@ -200,6 +212,9 @@ def exists_temp_table(curs, tbl):
 class Snapshot(object):
     """Represents a PostgreSQL snapshot.
 
+    In-progress txids are kept in set when there are few of them,
+    otherwise in sorted array that is searched with bisect.
+
     Example:
     >>> sn = Snapshot('11:20:11,12,15')
     >>> sn.contains(9)
@@ -210,8 +225,16 @@ class Snapshot(object):
     True
     >>> sn.contains(20)
     False
+    >>> sn.contains_many([9, 11, 17, 20, 11, 15])
+    [True, False, True, False, False, False]
+    >>> sn = Snapshot('100:1000:' + ','.join([str(i) for i in range(100, 1000, 3)]))
+    >>> sn.contains_many([99, 100, 101, 102, 103, 997, 998, 1000])
+    [True, False, True, True, False, False, True, False]
     """
 
+    # max size of xip list to keep in set
+    set_limit = 64
+
     def __init__(self, str):
         "Create snapshot from string."
 
@@ -226,6 +249,20 @@ class Snapshot(object):
             for s in tmp[2].split(','):
                 self.txid_list.append(int(s))
 
+        self._xip_set = None
+        self._xip_array = None
+        if len(self.txid_list) <= self.set_limit or not _txid_array_type:
+            self._xip_set = frozenset(self.txid_list)
+        else:
+            self._xip_array = array.array(_txid_array_type, sorted(self.txid_list))
+
+    def _in_progress(self, txid):
+        if self._xip_set is not None:
+            return txid in self._xip_set
+        xip = self._xip_array
+        i = bisect.bisect_left(xip, txid)
+        return i < len(xip) and xip[i] == txid
+
     def contains(self, txid):
         "Is txid visible in snapshot."
 
@@ -235,10 +272,34 @@ class Snapshot(object):
             return True
         if txid >= self.xmax:
             return False
-        if txid in self.txid_list:
+        if self._in_progress(txid):
             return False
         return True
 
+    def contains_many(self, txid_list):
+        """Visibility for list of txids, as list of bools.
+
+        Meant for filtering fetched block of events, where
+        same txid is usually repeated many times.
+        """
+        xmin = self.xmin
+        xmax = self.xmax
+        cache = {}
+        res = []
+        for txid in txid_list:
+            txid = int(txid)
+            if txid < xmin:
+                res.append(True)
+            elif txid >= xmax:
+                res.append(False)
+            else:
+                vis = cache.get(txid)
+                if vis is None:
+                    vis = not self._in_progress(txid)
+                    cache[txid] = vis
+                res.append(vis)
+        return res
+
 #
 # Copy helpers
 #
@@ -344,16 +405,60 @@ def magic_insert(curs, tablename, data, fields = None, use_insert = 0, quoted_ta
 # Full COPY of table from one db to another
 #
 
+class _BufferReader(object):
+    """File-like reader over memoryview, for copy_from()."""
+
+    def __init__(self, view):
+        self.view = view
+        self.pos = 0
+
+    def read(self, size = -1):
+        if size < 0:
+            size = len(self.view) - self.pos
+        data = self.view[self.pos : self.pos + size].tobytes()
+        self.pos += len(data)
+        return data
+
+    def readline(self, size = -1):
+        end = len(self.view)
+        if size >= 0:
+            end = min(end, self.pos + size)
+        data = self.view[self.pos : end].tobytes()
+        nl = data.find('\n')
+        if nl >= 0:
+            data = data[ : nl + 1]
+        self.pos += len(data)
+        return data
+
 class CopyPipe(object):
-    "Splits one big COPY to chunks."
+    """Splits one big COPY to chunks.
+
+    Data is collected into preallocated bytearray, on flush the
+    destination reads directly from it.  With double_buffer=True
+    chunks are sent from separate thread, so reading source and
+    writing destination overlap.
+
+    >>> class Curs:
+    ...     def copy_expert(self, sql, f):
+    ...         print repr(f.read(8192))
+    >>> p = CopyPipe(Curs(), limit = 8, sql_from = 'copy t from stdin')
+    >>> for row in ['1\\ta\\n', '2\\tb\\n', '3\\tc\\n', '4\\td\\n']:
+    ...     p.write(row)
+    '1\\ta\\n2\\tb\\n3\\tc\\n'
+    >>> p.flush()
+    '4\\td\\n'
+    >>> p.total_rows, p.total_bytes
+    (4, 16)
+    """
 
     def __init__(self, dstcurs, tablename = None, limit = 512*1024,
-                 sql_from = None):
+                 sql_from = None, double_buffer = False):
         self.tablename = tablename
         self.sql_from = sql_from
         self.dstcurs = dstcurs
-        self.buf = StringIO()
         self.limit = limit
+        self.buf = bytearray(limit + 64*1024)
+        self.used = 0
         #hook for new data, hook func should return new data
         #def write_hook(obj, data):
         #   return data
@@ -365,6 +470,13 @@ class CopyPipe(object):
         self.total_rows = 0
         self.total_bytes = 0
 
+        # second buffer is filled while first one is sent
+        self.spare_buf = None
+        self.sender = None
+        if double_buffer:
+            self.spare_buf = bytearray(len(self.buf))
+            self.sender = skytools.WorkerThread('copypipe')
+
     def write(self, data):
         "New data from psycopg"
         if self.write_hook:
@@ -373,41 +485,75 @@ class CopyPipe(object):
         self.total_bytes += len(data)
         self.total_rows += data.count("\n")
 
-        if self.buf.tell() >= self.limit:
+        if self.used >= self.limit:
             pos = data.find('\n')
             if pos >= 0:
                 # split at newline
-                p1 = data[:pos + 1]
-                p2 = data[pos + 1:]
-                self.buf.write(p1)
-                self.flush()
-
-                data = p2
-
-        self.buf.write(data)
-
-    def flush(self):
-        "Send data out."
+                view = memoryview(data)
+                self._append(view[:pos + 1])
+                self.send()
+                data = view[pos + 1:]
+
+        self._append(data)
+
+    def _append(self, data):
+        n = len(data)
+        end = self.used + n
+        if end > len(self.buf):
+            # row bigger than buffer, reallocate instead of resize
+            # as sender thread may still hold view on old one
+            nbuf = bytearray(end + self.limit)
+            nbuf[:self.used] = memoryview(self.buf)[:self.used]
+            self.buf = nbuf
+        self.buf[self.used : end] = data
+        self.used = end
+
+    def send(self):
+        "Send collected data out."
 
         if self.flush_hook:
             self.flush_hook(self)
 
-        if self.buf.tell() <= 0:
+        if self.used <= 0:
             return
 
-        self.buf.seek(0)
+        view = memoryview(self.buf)[:self.used]
+        if self.sender:
+            self.sender.wait()
+            self.sender.submit(self._copy_to_dst, view)
+            self.buf, self.spare_buf = self.spare_buf, self.buf
+        else:
+            self._copy_to_dst(view)
+        self.used = 0
+
+    def _copy_to_dst(self, view):
+        reader = _BufferReader(view)
         if self.sql_from:
-            self.dstcurs.copy_expert(self.sql_from, self.buf)
+            self.dstcurs.copy_expert(self.sql_from, reader)
         else:
-            self.dstcurs.copy_from(self.buf, self.tablename)
-        self.buf.seek(0)
-        self.buf.truncate()
+            self.dstcurs.copy_from(reader, self.tablename)
+
+    def flush(self):
+        "Send out remaining data and wait until it is written."
+        self.send()
+        if self.sender:
+            self.sender.wait()
+
+    def close(self):
+        "Stop sender thread."
+        if self.sender:
+            self.sender.stop()
+            self.sender = None
 
 
 def full_copy(tablename, src_curs, dst_curs, column_list = [], condition = None,
         dst_tablename = None, dst_column_list = None,
-        write_hook = None, flush_hook = None):
-    """COPY table from one db to another."""
+        write_hook = None, flush_hook = None, double_buffer = True):
+    """COPY table from one db to another.
+
+    With double_buffer, writing into dst_curs happens in separate
+    thread, in parallel with reading from src_curs.
+    """
 
     # default dst table and dst columns to source ones
     dst_tablename = dst_tablename or tablename
@@ -440,10 +586,14 @@ def full_copy(tablename, src_curs, dst_curs, column_list = [], condition = None,
     if hasattr(src_curs, 'copy_expert'):
         sql_to = "COPY %s TO stdout" % src
         sql_from = "COPY %s FROM stdin" % dst
-        buf = CopyPipe(dst_curs, sql_from = sql_from)
+        buf = CopyPipe(dst_curs, sql_from = sql_from, double_buffer = double_buffer)
         buf.write_hook = write_hook
         buf.flush_hook = flush_hook
-        src_curs.copy_expert(sql_to, buf)
+        try:
+            src_curs.copy_expert(sql_to, buf)
+            buf.flush()
+        finally:
+            buf.close()
     else:
         if condition:
             # regular psycopg copy_to generates invalid sql for subselect copy
@@ -452,7 +602,7 @@ def full_copy(tablename, src_curs, dst_curs, column_list = [], condition = None,
         buf.write_hook = write_hook
         buf.flush_hook = flush_hook
         src_curs.copy_to(buf, src)
-    buf.flush()
+        buf.flush()
 
     return (buf.total_bytes, buf.total_rows)
 
@@ -0,0 +1,118 @@
+"""Running database work in threads.
+
+psycopg2 releases GIL while waiting for server, so threads
+give real parallelism for database-bound work.
+
+>>> w = WorkerThread('test')
+>>> res = []
+>>> w.submit(res.append, 1)
+>>> w.submit(res.append, 2)
+>>> w.wait()
+>>> res
+[1, 2]
+>>> w.submit(int, 'x')
+>>> w.submit(res.append, 3)
+>>> w.wait()
+Traceback (most recent call last):
+    ...
+ValueError: invalid literal for int() with base 10: 'x'
+>>> res
+[1, 2]
+>>> w.stop()
+>>> run_parallel(lambda a, b: a * b, [(1, 2), (3, 4), (5, 6)], 2)
+[2, 12, 30]
+"""
+
+import sys
+import threading
+import Queue
+
+__all__ = ['WorkerThread', 'run_parallel']
+
+class WorkerThread(threading.Thread):
+    """Runs submitted functions sequentially in separate thread.
+
+    After first exception rest of queued work is skipped,
+    the exception is re-raised in wait().
+    """
+
+    def __init__(self, name = None):
+        threading.Thread.__init__(self, name = name)
+        self.setDaemon(True)
+        self._queue = Queue.Queue()
+        self._error = None
+        self.start()
+
+    def run(self):
+        while 1:
+            item = self._queue.get()
+            try:
+                if item is None:
+                    return
+                if self._error is None:
+                    func, args = item
+                    func(*args)
+            except:
+                self._error = sys.exc_info()
+            finally:
+                self._queue.task_done()
+
+    def submit(self, func, *args):
+        """Queue function call."""
+        self._queue.put((func, args))
+
+    def wait(self):
+        """Wait until queued work is done.
+
+        Re-raises exception from worker.
+        """
+        self._queue.join()
+        if self._error:
+            err = self._error
+            self._error = None
+            raise err[0], err[1], err[2]
+
+    def stop(self):
+        """Finish queued work and stop thread."""
+        self._queue.put(None)
+        self.join()
+
+def run_parallel(func, arg_list, nthreads):
+    """Call func(*args) for each args in arg_list, in up to nthreads threads.
+
+    Returns list of results in arg_list order.  First exception
+    is re-raised after all threads have stopped.
+    """
+    results = [None] * len(arg_list)
+    todo = Queue.Queue()
+    for i, args in enumerate(arg_list):
+        todo.put((i, args))
+    errors = []
+
+    def loop():
+        while not errors:
+            try:
+                i, args = todo.get_nowait()
+            except Queue.Empty:
+                return
+            try:
+                results[i] = func(*args)
+            except:
+                errors.append(sys.exc_info())
+
+    threads = []
+    for n in range(min(nthreads, len(arg_list))):
+        t = threading.Thread(target = loop)
+        t.setDaemon(True)
+        t.start()
+        threads.append(t)
+    for t in threads:
+        t.join()
+    if errors:
+        err = errors[0]
+        raise err[0], err[1], err[2]
+    return results
+
+if __name__ == '__main__':
+    import doctest
+    doctest.testmod()
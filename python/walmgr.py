@@ -8,6 +8,7 @@ Master commands:
   setup              Configure PostgreSQL for WAL archiving
   sync               Copies in-progress WALs to slave
   syncdaemon         Daemon mode for regular syncing
+  archivedaemon      Daemon that ships WAL files queued by xarchive
   stop               Stop archiving - de-configure PostgreSQL
   periodic           Run periodic command if configured.
   synch-standby      Manage synchronous streaming replication.
@@ -39,8 +40,8 @@ Internal commands:
   xpartialsync       Append data to WAL file (slave)
 """
 
-import os, sys, re, signal, time, traceback
-import errno, glob, ConfigParser, shutil, subprocess
+import os, sys, re, signal, time, traceback, select, stat
+import errno, glob, ConfigParser, shutil, subprocess, tempfile, gzip, heapq
 
 import pkgloader
 pkgloader.require('skytools', '3.0')
@@ -51,6 +52,10 @@ DEFAULT_PG_VERSION = "8.3"
 
 XLOG_SEGMENT_SIZE = 16 * 1024**2
 
+# WAL files never start with gzip magic, so compressed files can keep their names
+GZIP_MAGIC = '\x1f\x8b'
+ZERO_BLOCK = '\0' * 8192
+
 def usage(err):
     if err > 0:
         print >>sys.stderr, __doc__
@@ -94,6 +99,106 @@ def copy_conf(src, dst):
         raise Exception("Unsupported file type: %s" % src)
     return True
 
+def compress_wal(src, dst, level):
+    """Store WAL segment gzipped, without its unused zero tail.
+
+    Returns tuple of (original size, compressed size).
+    """
+    data = open(src, "rb").read()
+    size = len(data)
+    # find end of data, by whole blocks
+    end = size
+    while end > 0 and data[end - len(ZERO_BLOCK) : end] == ZERO_BLOCK:
+        end -= len(ZERO_BLOCK)
+    f = open(dst, "wb")
+    gz = gzip.GzipFile(os.path.basename(src), "wb", level, f)
+    gz.write(data[:end])
+    gz.close()
+    f.flush()
+    os.fsync(f.fileno())
+    f.close()
+    return size, os.path.getsize(dst)
+
+def is_compressed_wal(fn):
+    f = open(fn, "rb")
+    magic = f.read(len(GZIP_MAGIC))
+    f.close()
+    return magic == GZIP_MAGIC
+
+def decompress_wal(src, dst):
+    """Restore gzipped WAL segment to full length."""
+    gz = gzip.open(src, "rb")
+    f = open(dst, "wb")
+    while 1:
+        buf = gz.read(1024*1024)
+        if not buf:
+            break
+        f.write(buf)
+    gz.close()
+    # pad the file to 16MB, the tail was all zeros
+    if f.tell() < XLOG_SEGMENT_SIZE:
+        f.seek(XLOG_SEGMENT_SIZE - 1)
+        f.write('\0')
+    f.close()
+
+def next_wal_name(name):
+    """Name of WAL segment following given one.
+
+    Segment FF is skipped by PostgreSQL before 9.3, so it may
+    not exist.
+    """
+    tli = name[:8]
+    log = int(name[8:16], 16)
+    seg = int(name[16:24], 16) + 1
+    if seg > 0xFF:
+        log += 1
+        seg = 0
+    return "%s%08X%08X" % (tli, log, seg)
+
+def is_wal_name(name):
+    return re.match("^[0-9A-F]{24}$", name) is not None
+
+class DirWatch:
+    """Wait for files to appear in directory.
+
+    Uses inotify on Linux, on other systems or when it fails
+    wait() just sleeps.
+    """
+    IN_CLOSE_WRITE = 0x08
+    IN_MOVED_TO = 0x80
+
+    def __init__(self, path):
+        self.fd = None
+        try:
+            import ctypes
+            libc = ctypes.CDLL(None, use_errno = True)
+            fd = libc.inotify_init()
+            if fd < 0:
+                return
+            mask = self.IN_CLOSE_WRITE | self.IN_MOVED_TO
+            if libc.inotify_add_watch(fd, path, mask) < 0:
+                os.close(fd)
+                return
+            self.fd = fd
+        except (ImportError, OSError, AttributeError):
+            pass
+
+    def wait(self, timeout):
+        """Sleep until something is written into directory
+        or timeout passes."""
+        if self.fd is None:
+            time.sleep(timeout)
+            return
+        r, w, x = select.select([self.fd], [], [], timeout)
+        if r:
+            # events are not looked at, caller checks for files
+            os.read(self.fd, 64*1024)
+
+    def close(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
 class WalChunk:
     """Represents a chunk of WAL used in record based shipping"""
     def __init__(self,filename,pos=0,bytes=0):
@@ -448,6 +553,7 @@ class WalMgr(skytools.DBScript):
         self.not_really = self.options.not_really
         self.pg_backup = 0
         self.walchunk = None
+        self.partial_channel = None
         self.script = os.path.abspath(sys.argv[0])
 
         if len(self.args) > 1:
@@ -468,10 +574,13 @@ class WalMgr(skytools.DBScript):
             self.cfgfile = None
             self.args = []
 
-        if self.cmd not in ('sync', 'syncdaemon'):
+        if self.cmd not in ('sync', 'syncdaemon', 'archivedaemon'):
             # don't let pidfile interfere with normal operations, but
             # disallow concurrent syncing
             self.pidfile = None
+        elif self.cmd == 'archivedaemon' and self.pidfile:
+            # can run together with syncdaemon
+            self.pidfile += '.archive'
 
         cmdtab = {
             'init_master':   self.walmgr_init_master,
@@ -484,6 +593,7 @@ class WalMgr(skytools.DBScript):
             'periodic':      self.master_periodic,
             'sync':          self.master_sync,
             'syncdaemon':    self.master_syncdaemon,
+            'archivedaemon': self.master_archivedaemon,
             'pause':         self.slave_pause,
             'continue':      self.slave_continue,
             'boot':          self.slave_boot,
@@ -552,11 +662,14 @@ class WalMgr(skytools.DBScript):
                     raise
         return True
 
-    def exec_rsync(self,args,die_on_error=False):
+    def rsync_cmdline(self, args):
         cmdline = [ "rsync", "-a", "--quiet" ]
         if self.cf.getint("compression", 0) > 0:
             cmdline.append("-z")
-        cmdline += args
+        return cmdline + args
+
+    def exec_rsync(self,args,die_on_error=False,allow_partial=False):
+        cmdline = self.rsync_cmdline(args)
 
         cmd = "' '".join(cmdline)
         self.log.debug("Execute rsync cmd: %r", cmd)
@@ -566,6 +679,9 @@ class WalMgr(skytools.DBScript):
         if res == 24:
             self.log.info("Some files vanished, but thats OK")
             res = 0
+        elif res == 23 and allow_partial:
+            self.log.info("Some files were not transferred, later pass copies them")
+            res = 0
         elif res != 0:
             self.log.fatal("rsync exec failed, res=%d", res)
             if die_on_error:
@@ -936,9 +1052,21 @@ class WalMgr(skytools.DBScript):
             cmdline = ["ssh", "-nT", host, "mkdir", "-p", path]
             self.exec_cmd(cmdline)
 
+    def remote_isdir(self, loc):
+        tmp = loc.split(":", 1)
+        if len(tmp) < 2:
+            return os.path.isdir(tmp[0])
+        host, path = tmp
+        res = self.exec_cmd(["ssh", "-nT", host, "test", "-d", path], allow_error=True)
+        return res is not None and res[0] == 0
+
     def remote_walmgr(self, command, stdin_disabled = True, allow_error=False):
         """Pass a command to slave WalManager"""
 
+        cmdline = self.remote_walmgr_cmdline(command, stdin_disabled)
+        return self.exec_cmd(cmdline, allow_error)
+
+    def remote_walmgr_cmdline(self, command, stdin_disabled = True):
         sshopt = "-T"
         if stdin_disabled:
             sshopt += "n"
@@ -954,7 +1082,7 @@ class WalMgr(skytools.DBScript):
         if self.not_really:
             cmdline += ["--not-really"]
 
-        return self.exec_cmd(cmdline, allow_error)
+        return cmdline
 
     def remote_xlock(self):
         """
@@ -1334,6 +1462,35 @@ primary_conninfo     = %(primary_conninfo)s
             master_spc_dir = os.path.join(data_dir, "pg_tblspc")
             slave_spc_dir = dst_loc + "tmpspc"
 
+            # hard-link unchanged files from previous backup
+            prev_loc = None
+            if self.cf.getint("incremental_backup", 0):
+                prev_loc = dst_loc.rstrip("/") + ".0"
+                if not self.remote_isdir(prev_loc):
+                    self.log.info("No previous backup, doing full copy")
+                    prev_loc = None
+            link_args = []
+            if prev_loc:
+                prev_path = prev_loc.split(":", 1)[-1]
+                self.log.info("Linking unchanged files from %s", prev_path)
+                link_args = [ "--link-dest=" + prev_path ]
+
+            tblspc_list = self.get_tablespaces(master_spc_dir)
+            if tblspc_list:
+                self.remote_mkdir(slave_spc_dir)
+
+            # copy bulk of data files in parallel, rsyncs below
+            # then have little left to do
+            nworkers = self.cf.getint("backup_parallel", 1)
+            if nworkers > 1:
+                roots = [ (data_dir, ["base", "global"], dst_loc, link_args) ]
+                for tblspc, spc_path in tblspc_list:
+                    spc_link = []
+                    if prev_loc:
+                        spc_link = [ "--link-dest=%s/tmpspc/%s" % (prev_path, tblspc) ]
+                    roots.append((spc_path, ["."], slave_spc_dir + "/" + tblspc, spc_link))
+                self.parallel_backup(roots, nworkers)
+
             # copy data
             self.chdir(data_dir)
             cmdline = [
@@ -1346,34 +1503,19 @@ primary_conninfo     = %(primary_conninfo)s
                     "--exclude", "pg_tblspc",
                     "--exclude", "pg_log",
                     "--exclude", "base/pgsql_tmp",
-                    "--copy-unsafe-links",
+                    "--copy-unsafe-links"] + link_args + [
                     ".", dst_loc]
             self.exec_big_rsync(cmdline)
 
-            # copy tblspc first, to test
-            if os.path.isdir(master_spc_dir):
-                self.log.info("Checking tablespaces")
-                list = os.listdir(master_spc_dir)
-                if len(list) > 0:
-                    self.remote_mkdir(slave_spc_dir)
-                for tblspc in list:
-                    if tblspc[0] == ".":
-                        continue
-                    tfn = os.path.join(master_spc_dir, tblspc)
-                    if not os.path.islink(tfn):
-                        self.log.info("Suspicious pg_tblspc entry: %s", tblspc)
-                        continue
-                    spc_path = os.path.realpath(tfn)
-                    self.log.info("Got tablespace %s: %s", tblspc, spc_path)
-                    dstfn = slave_spc_dir + "/" + tblspc
-
-                    try:
-                        os.chdir(spc_path)
-                    except Exception, det:
-                        self.log.warning("Broken link: %s", det)
-                        continue
-                    cmdline = [ "--delete", "--exclude", ".*", "--copy-unsafe-links", ".", dstfn]
-                    self.exec_big_rsync(cmdline)
+            # copy tblspc
+            for tblspc, spc_path in tblspc_list:
+                dstfn = slave_spc_dir + "/" + tblspc
+                self.chdir(spc_path)
+                spc_link = []
+                if prev_loc:
+                    spc_link = [ "--link-dest=%s/tmpspc/%s" % (prev_path, tblspc) ]
+                cmdline = [ "--delete", "--exclude", ".*", "--copy-unsafe-links" ] + spc_link + [ ".", dstfn]
+                self.exec_big_rsync(cmdline)
 
             # copy the pg_log and pg_xlog directories, these may be
             # symlinked to nonstandard location, so pay attention
@@ -1412,6 +1554,88 @@ primary_conninfo     = %(primary_conninfo)s
         else:
             self.log.error("Full backup failed.")
 
+    def get_tablespaces(self, master_spc_dir):
+        """Return list of (tblspc, path) for valid pg_tblspc entries."""
+        res = []
+        if not os.path.isdir(master_spc_dir):
+            return res
+        self.log.info("Checking tablespaces")
+        for tblspc in sorted(os.listdir(master_spc_dir)):
+            if tblspc[0] == ".":
+                continue
+            tfn = os.path.join(master_spc_dir, tblspc)
+            if not os.path.islink(tfn):
+                self.log.info("Suspicious pg_tblspc entry: %s", tblspc)
+                continue
+            spc_path = os.path.realpath(tfn)
+            if not os.path.isdir(spc_path):
+                self.log.warning("Broken link: %s", tfn)
+                continue
+            self.log.info("Got tablespace %s: %s", tblspc, spc_path)
+            res.append((tblspc, spc_path))
+        return res
+
+    def parallel_backup(self, roots, nworkers):
+        """Copy files under roots with nworkers rsyncs at once.
+
+        roots is list of (src_dir, subdir_list, dst_loc, extra_args).
+        Files are split between workers by size, largest first.
+        Directory trees are created first, so workers do not race
+        creating them.
+        """
+        bins = [(0, i, []) for i in range(nworkers)]
+        files = []
+        for rootnr, (src_dir, subdirs, dst, extra) in enumerate(roots):
+            for sub in subdirs:
+                for dirpath, dirnames, filenames in os.walk(os.path.join(src_dir, sub)):
+                    dirnames[:] = [d for d in dirnames if d != "pgsql_tmp" and d[0] != "."]
+                    for fn in filenames:
+                        if fn[0] == ".":
+                            continue
+                        full = os.path.join(dirpath, fn)
+                        try:
+                            size = os.path.getsize(full)
+                        except OSError:
+                            # dropped meanwhile
+                            continue
+                        files.append((size, rootnr, os.path.relpath(full, src_dir)))
+        files.sort(reverse = True)
+        for size, rootnr, rel in files:
+            total, i, flist = heapq.heappop(bins)
+            flist.append((rootnr, rel))
+            heapq.heappush(bins, (total + size, i, flist))
+
+        for src_dir, subdirs, dst, extra in roots:
+            self.chdir(src_dir)
+            self.exec_big_rsync([ "--exclude=pgsql_tmp", "--exclude=.*",
+                                  "--include=*/", "--exclude=*" ] + subdirs + [ dst ])
+
+        total_bytes = sum([b[0] for b in bins])
+        self.log.info("Copying %d files, %d MB with %d workers",
+                      len(files), total_bytes / (1024*1024), nworkers)
+        work = [(flist, roots) for total, i, flist in bins if flist]
+        skytools.run_parallel(self.backup_worker, work, nworkers)
+
+    def backup_worker(self, flist, roots):
+        """Copy list of (rootnr, relpath) files, one rsync per root.
+
+        Files dropped after listing make rsync exit with 23, that is
+        fine as the serial pass after it syncs everything anyway.
+        """
+        for rootnr, (src_dir, subdirs, dst, extra) in enumerate(roots):
+            paths = [rel for nr, rel in flist if nr == rootnr]
+            if not paths:
+                continue
+            lst = tempfile.NamedTemporaryFile(prefix = "walmgr", delete = False)
+            try:
+                lst.write("\n".join(paths) + "\n")
+                lst.close()
+                args = [ "--files-from=" + lst.name, "--copy-unsafe-links" ] + extra + [ src_dir, dst ]
+                if self.exec_rsync(args, allow_partial = True) != 0:
+                    raise Exception("rsync failed for %s" % src_dir)
+            finally:
+                os.remove(lst.name)
+
     def slave_backup(self):
         """
         Create backup on slave host.
@@ -1525,6 +1749,10 @@ STOP TIME: %(stop_time)s
         srcpath = self.args[0]
         srcname = self.args[1]
 
+        if self.cf.getfile("archive_spool", ""):
+            self.master_spool_wal(srcpath, srcname)
+            return
+
         start_time = time.time()
         self.log.debug("%s: start copy", srcname)
 
@@ -1534,8 +1762,18 @@ STOP TIME: %(stop_time)s
         if dst_loc[-1] != "/":
             dst_loc += "/"
 
-        # copy data
-        self.exec_rsync([ srcpath, dst_loc ], True)
+        # copy data, compressed if requested
+        tmpdir = None
+        if self.use_wal_compression(srcpath):
+            tmpdir = tempfile.mkdtemp(prefix = "walmgr")
+            tmpfile = os.path.join(tmpdir, srcname)
+            self.compress_wal_file(srcpath, tmpfile)
+            srcpath = tmpfile
+        try:
+            self.exec_rsync([ srcpath, dst_loc ], True)
+        finally:
+            if tmpdir:
+                shutil.rmtree(tmpdir)
 
         # sync the buffers to disk - this is should reduce the chance
         # of WAL file corruption in case the slave crashes.
@@ -1552,31 +1790,208 @@ STOP TIME: %(stop_time)s
         self.stat_add('duration', end_time - start_time)
         self.send_stats()
 
+    def use_wal_compression(self, srcpath):
+        """Compress only full segments, history and backup label
+        files are left as they are."""
+        if self.cf.getint("wal_compression", 0) <= 0 or self.not_really:
+            return False
+        return os.path.getsize(srcpath) == XLOG_SEGMENT_SIZE
+
+    def compress_wal_file(self, srcpath, dstpath):
+        level = min(9, self.cf.getint("wal_compression", 0))
+        size, csize = compress_wal(srcpath, dstpath, level)
+        self.log.debug("%s: compressed %d -> %d bytes", os.path.basename(srcpath), size, csize)
+        self.stat_add('compressed_bytes', csize)
+
+    def restore_wal_file(self, srcfile, dstpath):
+        """Copy WAL file to dstpath, decompressing if needed."""
+        if not self.not_really and is_compressed_wal(srcfile):
+            self.log.debug("%s: decompress to %s", srcfile, dstpath)
+            decompress_wal(srcfile, dstpath)
+        else:
+            self.exec_cmd(["cp", srcfile, dstpath])
+
+    def master_spool_wal(self, srcpath, srcname):
+        """Queue WAL file for archivedaemon.
+
+        File is copied, as postgres may recycle the segment as soon
+        as archive_command returns.
+        """
+        spool = self.cf.getfile("archive_spool")
+        dstfile = os.path.join(spool, srcname)
+        tmpfile = dstfile + ".tmp"
+
+        self.log.debug("%s: queue for archiving", srcname)
+        if self.not_really:
+            return
+
+        if not os.path.isdir(spool):
+            os.makedirs(spool)
+        if self.use_wal_compression(srcpath):
+            self.compress_wal_file(srcpath, tmpfile)
+        else:
+            shutil.copyfile(srcpath, tmpfile)
+            f = open(tmpfile, "r")
+            os.fsync(f.fileno())
+            f.close()
+        os.rename(tmpfile, dstfile)
+
+        # make the rename durable too
+        dirfd = os.open(spool, os.O_RDONLY)
+        os.fsync(dirfd)
+        os.close(dirfd)
+
+        self.stat_add('queued', 1)
+        self.send_stats()
+
+    def master_archivedaemon(self):
+        self.assert_is_master(True)
+        self.set_single_loop(0)
+        return self.master_archive_spool()
+
+    def ssh_options(self):
+        """Options for ssh to keep single connection to slave open."""
+        spool = self.cf.getfile("archive_spool")
+        ctl_path = os.path.join(spool, ".ssh-control")
+        return [ "-o", "Batchmode=yes",
+                 "-o", "ControlMaster=auto",
+                 "-o", "ControlPath=%s" % ctl_path,
+                 "-o", "ControlPersist=%d" % max(60, 2 * self.loop_delay) ]
+
+    def master_archive_spool(self):
+        """Ship WAL files queued by xarchive.
+
+        Files are copied with several rsync processes in parallel,
+        then slave is synced once for whole batch.  The .walshipping.last
+        marker is set to last file of the batch, in archiving order,
+        only after all files in it have been synced.
+
+        Returns 1 if batch was shipped, so next one is started
+        without sleeping.
+        """
+        spool = self.cf.getfile("archive_spool")
+        nworkers = self.cf.getint("archive_parallel", 4)
+        max_batch = self.cf.getint("archive_batch", 32)
+
+        if not os.path.isdir(spool):
+            return
+
+        # keep the order files were archived in
+        flist = []
+        for fn in os.listdir(spool):
+            if fn.startswith(".") or fn.endswith(".tmp"):
+                continue
+            st = os.stat(os.path.join(spool, fn))
+            flist.append((st.st_mtime, fn))
+        if not flist:
+            return
+        flist.sort()
+        batch = [fn for mtime, fn in flist[:max_batch]]
+
+        start_time = time.time()
+        self.log.debug("archiving %d files: %s .. %s", len(batch), batch[0], batch[-1])
+
+        self.master_periodic()
+
+        dst_loc = self.cf.getfile("completed_wals")
+        if dst_loc[-1] != "/":
+            dst_loc += "/"
+
+        # spread files between workers, each rsync pipelines its list
+        ssh_cmd = " ".join(["ssh"] + self.ssh_options())
+        procs = []
+        for i in range(min(nworkers, len(batch))):
+            files = [os.path.join(spool, fn) for fn in batch[i::nworkers]]
+            cmdline = self.rsync_cmdline([ "-e", ssh_cmd ] + files + [ dst_loc ])
+            self.log.debug("Execute rsync cmd: %r", cmdline)
+            if not self.not_really:
+                procs.append(subprocess.Popen(cmdline))
+        failed = 0
+        for p in procs:
+            if p.wait() != 0:
+                self.log.error("rsync exec failed, res=%d", p.returncode)
+                failed = 1
+        if failed:
+            # retry whole batch on next loop
+            return
+
+        # sync the buffers to disk on slave, once per batch
+        slave = self.cf.get("slave")
+        cmdline = [ "ssh", "-nT" ] + self.ssh_options() + [ slave, "sync" ]
+        res = self.exec_cmd(cmdline, allow_error=True)
+        if res and res[0] != 0:
+            self.log.error("sync on slave failed, res=%d", res[0])
+            return
+
+        # slave has the files now, set markers
+        self.set_last_complete(batch[-1])
+        if not self.not_really:
+            for fn in batch:
+                os.remove(os.path.join(spool, fn))
+
+        self.log.debug("%s: done", batch[-1])
+        self.stat_add('count', len(batch))
+        self.stat_add('duration', time.time() - start_time)
+        self.send_stats()
+        return 1
+
     def slave_append_partial(self):
         """
         Read 'bytes' worth of data from stdin, append to the partial log file
         starting from 'offset'. On error it is assumed that master restarts
         from zero.
 
+        Without arguments, reads stream of records from stdin, each is
+        line of "<filename> <offset> <bytes>" followed by data.  Each
+        record is acknowledged with "ok" line on stdout.
+
         The resulting file is always padded to XLOG_SEGMENT_SIZE bytes to
         simplify recovery.
         """
 
-        def fail(message):
-            self.log.error("Slave: %s: %s", filename, message)
-            sys.exit(1)
-
         self.assert_is_master(False)
+        if len(self.args) == 0:
+            self.slave_append_partial_stream()
+            return
         if len(self.args) < 3:
-            die(1, "usage: xpartialsync <filename> <offset> <bytes>")
+            die(1, "usage: xpartialsync [<filename> <offset> <bytes>]")
 
         filename = self.args[0]
         offset = int(self.args[1])
         bytes = int(self.args[2])
 
         data = sys.stdin.read(bytes)
+        if not self.append_partial(filename, offset, bytes, data):
+            sys.exit(1)
+
+    def slave_append_partial_stream(self):
+        """Handle records from syncdaemon until it closes the channel."""
+        while 1:
+            hdr = sys.stdin.readline()
+            if not hdr:
+                break
+            try:
+                filename, offset, bytes = hdr.split()
+                offset = int(offset)
+                bytes = int(bytes)
+            except ValueError:
+                self.log.error("Slave: bad record header: %r", hdr)
+                sys.exit(1)
+            data = sys.stdin.read(bytes)
+            if not self.append_partial(filename, offset, bytes, data):
+                sys.exit(1)
+            sys.stdout.write("ok\n")
+            sys.stdout.flush()
+
+    def append_partial(self, filename, offset, bytes, data):
+        """Write data to partial WAL file.  Returns False on error."""
+
+        def fail(message):
+            self.log.error("Slave: %s: %s", filename, message)
+            return False
+
         if len(data) != bytes:
-            fail("not enough data, expected %d, got %d" % (bytes, len(data)))
+            return fail("not enough data, expected %d, got %d" % (bytes, len(data)))
 
         chunk = WalChunk(filename, offset, bytes)
         self.log.debug("Slave: adding to %s", chunk)
@@ -1585,12 +2000,12 @@ STOP TIME: %(stop_time)s
 
         if self.not_really:
             self.log.info("Adding to partial: %s", name)
-            return
+            return True
 
         try:
             xlog = open(name, (offset == 0) and "w+" or "r+")
         except:
-            fail("unable to open partial WAL: %s" % name)
+            return fail("unable to open partial WAL: %s" % name)
         xlog.seek(offset)
         xlog.write(data)
 
@@ -1601,11 +2016,13 @@ STOP TIME: %(stop_time)s
             xlog.write('\0')
 
         xlog.close()
+        return True
 
     def master_send_partial(self, xlog_dir, chunk, daemon_mode):
         """
-        Send the partial log chunk to slave. Use SSH with input redirection for the copy,
-        consider other options if the overhead becomes visible.
+        Send the partial log chunk to slave.  Chunks are written to
+        long-running xpartialsync process on slave, over single SSH
+        connection that is kept open between syncs.
         """
 
         try:
@@ -1615,22 +2032,25 @@ STOP TIME: %(stop_time)s
             return
 
         xlog.seek(chunk.pos)
+        data = xlog.read(chunk.bytes)
+        xlog.close()
+        if len(data) != chunk.bytes:
+            self.log.warning("Short read from %s: %d of %d bytes",
+                             chunk.filename, len(data), chunk.bytes)
+            return
 
-        # Fork the sync process
-        childpid = os.fork()
         syncstart = time.time()
-        if childpid == 0:
-            os.dup2(xlog.fileno(), sys.stdin.fileno())
-            try:
-                self.remote_walmgr("xpartialsync %s %d %d" % (chunk.filename, chunk.pos, chunk.bytes), False)
-            except:
-                os._exit(1)
-            os._exit(0)
+        try:
+            ch = self.get_partial_channel()
+            ch.stdin.write("%s %d %d\n" % (chunk.filename, chunk.pos, chunk.bytes))
+            ch.stdin.write(data)
+            ch.stdin.flush()
+            ack = ch.stdout.readline().strip()
+        except (IOError, OSError), det:
+            ack = str(det)
         chunk.sync_time += (time.time() - syncstart)
 
-        status = os.waitpid(childpid, 0)
-        rc = os.WEXITSTATUS(status[1])
-        if rc == 0:
+        if ack == "ok":
             log = daemon_mode and self.log.debug or self.log.info
             log("sent to slave: %s" % chunk)
             chunk.pos += chunk.bytes
@@ -1638,9 +2058,34 @@ STOP TIME: %(stop_time)s
         else:
             # Start from zero after an error
             chunk.pos = 0
-            self.log.error("xpartialsync exited with status %d, restarting from zero.", rc)
+            self.close_partial_channel()
+            self.log.error("xpartialsync failed (%s), restarting from zero.", ack or "channel closed")
             time.sleep(5)
 
+    def get_partial_channel(self):
+        """Start xpartialsync on slave, if not running yet."""
+        if self.partial_channel is None:
+            cmdline = self.remote_walmgr_cmdline("xpartialsync", False)
+            self.log.debug("Starting partial sync channel: %r", cmdline)
+            self.partial_channel = subprocess.Popen(cmdline,
+                    stdin = subprocess.PIPE, stdout = subprocess.PIPE)
+        return self.partial_channel
+
+    def close_partial_channel(self):
+        ch = self.partial_channel
+        if ch is None:
+            return
+        self.partial_channel = None
+        try:
+            ch.stdin.close()
+        except IOError:
+            pass
+        ch.wait()
+
+    def shutdown(self):
+        self.close_partial_channel()
+        skytools.DBScript.shutdown(self)
+
     def master_syncdaemon(self):
         self.assert_is_master(True)
         self.set_single_loop(0)
@@ -1796,6 +2241,11 @@ STOP TIME: %(stop_time)s
             self.log.debug("Looking in %s", src)
             srcfile = os.path.join(src, srcname)
             if self.exec_rsync([srcfile, dstpath]) == 0:
+                if not self.not_really and is_compressed_wal(dstpath):
+                    tmpfile = dstpath + ".gz"
+                    os.rename(dstpath, tmpfile)
+                    decompress_wal(tmpfile, dstpath)
+                    os.remove(tmpfile)
                 return
         self.log.warning("Could not restore file %s", srcname)
 
@@ -1832,6 +2282,7 @@ STOP TIME: %(stop_time)s
             os.remove(prgrfile)
 
         # loop until srcfile or stopfile appears
+        watch = None
         while 1:
             if os.path.isfile(pausefile):
                 self.log.info("pause requested, sleeping")
@@ -1863,13 +2314,26 @@ STOP TIME: %(stop_time)s
                 self.log.warning("Parent dead, quitting")
                 sys.exit(1)
 
-            # nothing to do, sleep
+            # nothing to do, sleep until something is written to srcdir
             self.log.debug("%s: not found, sleeping", srcname)
-            time.sleep(1)
+            if watch is None:
+                watch = DirWatch(srcdir)
+                # file may have appeared before the watch was set up
+                continue
+            watch.wait(1)
+
+        if watch:
+            watch.close()
 
         # got one, copy it
-        cmdline = ["cp", srcfile, dstpath]
-        self.exec_cmd(cmdline)
+        prefetch_dir = os.path.join(os.path.dirname(os.path.abspath(dstpath)), ".walmgr_prefetch")
+        prefetched = os.path.join(prefetch_dir, srcname)
+        if srcfile != partfile and os.path.isfile(prefetched):
+            self.log.debug("%s: using prefetched file", srcname)
+            if not self.not_really:
+                os.rename(prefetched, dstpath)
+        else:
+            self.restore_wal_file(srcfile, dstpath)
 
         if self.cf.getint("keep_backups", 0) == 0:
             # cleanup only if we don't keep backup history, keep the files needed
@@ -1891,6 +2355,39 @@ STOP TIME: %(stop_time)s
         self.stat_add('count', 1)
         self.send_stats()
 
+        if srcfile != partfile and is_wal_name(srcname) and not self.not_really:
+            self.slave_prefetch_wal(srcdir, next_wal_name(srcname), prefetch_dir)
+
+    def slave_prefetch_wal(self, srcdir, walname, prefetch_dir):
+        """Copy next segment next to restore target in background,
+        so next xrestore can just rename it into place.
+
+        Runs in forked child, so current xrestore returns immediately.
+        """
+        srcfile = os.path.join(srcdir, walname)
+        if not os.path.isfile(srcfile):
+            return
+        if os.fork() != 0:
+            return
+        try:
+            if not os.path.isdir(prefetch_dir):
+                os.mkdir(prefetch_dir)
+            # drop files not used by restore, eg. after timeline switch
+            for fn in os.listdir(prefetch_dir):
+                if fn != walname:
+                    os.remove(os.path.join(prefetch_dir, fn))
+            dstfile = os.path.join(prefetch_dir, walname)
+            tmpfile = dstfile + ".tmp"
+            if is_compressed_wal(srcfile):
+                decompress_wal(srcfile, tmpfile)
+            else:
+                shutil.copyfile(srcfile, tmpfile)
+            os.rename(tmpfile, dstfile)
+            self.log.debug("%s: prefetched", walname)
+        except Exception, d:
+            self.log.warning("%s: prefetch failed: %s", walname, d)
+        os._exit(0)
+
     def restore_database(self, restore_config=True):
         """Restore the database from backup
 
@@ -1986,6 +2483,8 @@ STOP TIME: %(stop_time)s
         if not self.not_really:
             if not setname and not link_xlog_dir:
                 os.rename(full_dir, data_dir)
+                # files of incremental backup may be shared with older ones
+                self.break_hardlinks(data_dir)
             else:
                 rsync_args=["--delete", "--no-relative", "--exclude=pg_xlog/*"]
                 if exclude_pg_xlog:
@@ -2307,6 +2806,23 @@ STOP TIME: %(stop_time)s
             sys.exit(1)
 
 
+    def break_hardlinks(self, path):
+        """Replace hard-linked files under path with own copies,
+        so postgres does not modify files of other backups."""
+        count = 0
+        for dirpath, dirnames, filenames in os.walk(path):
+            for fn in filenames:
+                full = os.path.join(dirpath, fn)
+                st = os.lstat(full)
+                if not stat.S_ISREG(st.st_mode) or st.st_nlink < 2:
+                    continue
+                tmp = full + ".walmgr_tmp"
+                shutil.copy2(full, tmp)
+                os.rename(tmp, full)
+                count += 1
+        if count:
+            self.log.info("Copied %d files shared with other backups", count)
+
     def slave_pause(self, waitcomplete=0):
         """Pause the WAL apply, wait until last file applied if needed"""
         self.assert_is_master(False)
@@ -2536,34 +3052,57 @@ STOP TIME: %(stop_time)s
         self.log.debug("cleaning done")
 
     def del_wals(self, path, last):
+        """Remove WAL files older than 'last' from path.
+
+        Name of 'last' is remembered in path/.walmgr_cleanup.  Next call
+        in same timeline and xlog id only removes segments between these
+        two, without listing the directory.  Full scan is done when xlog
+        id changes, it also removes backup label files.
+        """
         dot = last.find(".")
         if dot > 0:
             last = last[:dot]
-        list = os.listdir(path)
-        list.sort()
-        cur_last = None
-        n = len(list)
-        for i in range(n):
-            fname = list[i]
-            full = os.path.join(path, fname)
-            if fname[0] < "0" or fname[0] > "9":
-                continue
-            if not fname.startswith(last[0:8]):
-                # only look at WAL segments in a same timeline
-                continue
 
-            ok_del = 0
-            if fname < last:
-                self.log.debug("deleting %s", full)
-                if not self.not_really:
-                    try:
-                        os.remove(full)
-                    except:
-                        # don't report the errors if the file has been already removed
-                        # happens due to conflicts with pg_archivecleanup for instance.
-                        pass
-            cur_last = fname
-        return cur_last
+        markfile = os.path.join(path, ".walmgr_cleanup")
+        prev = None
+        if is_wal_name(last) and os.path.isfile(markfile):
+            prev = open(markfile).read().strip()
+
+        if prev and is_wal_name(prev) and prev[:16] == last[:16]:
+            # everything before prev is already deleted
+            name = prev
+            while name < last:
+                self.del_wal_file(os.path.join(path, name))
+                name = next_wal_name(name)
+        else:
+            list = os.listdir(path)
+            list.sort()
+            for fname in list:
+                full = os.path.join(path, fname)
+                if fname[0] < "0" or fname[0] > "9":
+                    continue
+                if not fname.startswith(last[0:8]):
+                    # only look at WAL segments in a same timeline
+                    continue
+                if fname < last:
+                    self.del_wal_file(full)
+
+        if is_wal_name(last) and last != prev and not self.not_really:
+            tmp = markfile + ".tmp"
+            open(tmp, "w").write(last)
+            os.rename(tmp, markfile)
+
+    def del_wal_file(self, full):
+        if not os.path.exists(full):
+            return
+        self.log.debug("deleting %s", full)
+        if not self.not_really:
+            try:
+                os.remove(full)
+            except:
+                # don't report the errors if the file has been already removed
+                # happens due to conflicts with pg_archivecleanup for instance.
+                pass
 
 if __name__ == "__main__":
     script = WalMgr(sys.argv[1:])
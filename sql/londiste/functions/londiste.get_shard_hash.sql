@@ -0,0 +1,21 @@
+
+create or replace function londiste.get_shard_hash(i_extra3 text)
+returns bigint as $$
+-- ----------------------------------------------------------------------
+-- Function: londiste.get_shard_hash(1)
+--
+--      Extract hash value that shard handler trigger puts
+--      into ev_extra3 as 'hash=NUM'.
+--
+--      Used in consumer filter, so events for other shards
+--      are dropped on provider side.
+--
+-- Parameters:
+--      i_extra3  - urlencoded ev_extra3 value.
+--
+-- Returns:
+--      Hash value or NULL if not present.
+-- ----------------------------------------------------------------------
+    select substring($1 from '(?:^|&)hash=(-?[0-9]+)(?:&|$)')::bigint;
+$$ language sql strict immutable;
+
@@ -70,3 +70,8 @@ select count(*) from pg_rules where schemaname = 'public' and tablename ilike 'b
 -- \dp events
 -- \dp events_2011_01
 
+-- shard hash for consumer filter
+select londiste.get_shard_hash('hash=123');
+select londiste.get_shard_hash('foo=1&hash=-5');
+select londiste.get_shard_hash('foo=1') is null as nohash;
+select (londiste.get_shard_hash('hash=1234') & 15) = 2 as myshard;
@@ -55,4 +55,5 @@ select londiste.upgrade_schema();
 \i functions/londiste.is_obsolete_partition.sql
 \i functions/londiste.list_obsolete_partitions.sql
 \i functions/londiste.drop_obsolete_partitions.sql
+\i functions/londiste.get_shard_hash.sql
 
@@ -76,3 +76,60 @@ begin
 end;
 $$ language plpgsql security definer;
 
+
+
+create or replace function pgq.event_retry(
+    x_batch_id bigint,
+    x_event_ids bigint[],
+    x_retry_seconds integer)
+returns integer as $$
+-- ----------------------------------------------------------------------
+-- Function: pgq.event_retry(3c)
+--
+--     Put several events into retry queue at once.
+--
+-- Parameters:
+--      x_batch_id      - ID of active batch.
+--      x_event_ids     - array of event ids
+--      x_retry_seconds - Time when the events should be put back into queue
+--
+-- Returns:
+--     number of events inserted, events already in retry queue are skipped
+-- Calls:
+--      None
+-- Tables directly manipulated:
+--      insert - pgq.retry_queue
+-- ----------------------------------------------------------------------
+declare
+    _retry timestamptz;
+    _cnt   integer;
+    _s     record;
+begin
+    _retry := current_timestamp + ((x_retry_seconds::text || ' seconds')::interval);
+
+    select * into _s from pgq.subscription where sub_batch = x_batch_id;
+    if not found then
+        raise exception 'event_retry: batch % not found', x_batch_id;
+    end if;
+
+    insert into pgq.retry_queue (ev_retry_after, ev_queue,
+        ev_id, ev_time, ev_txid, ev_owner, ev_retry,
+        ev_type, ev_data, ev_extra1, ev_extra2,
+        ev_extra3, ev_extra4)
+    select distinct _retry, _s.sub_queue,
+           b.ev_id, b.ev_time, NULL::int8, _s.sub_id, coalesce(b.ev_retry, 0) + 1,
+           b.ev_type, b.ev_data, b.ev_extra1, b.ev_extra2,
+           b.ev_extra3, b.ev_extra4
+      from pgq.get_batch_events(x_batch_id) b
+           left join pgq.retry_queue rq
+                  on (rq.ev_id = b.ev_id
+                      and rq.ev_owner = _s.sub_id
+                      and rq.ev_queue = _s.sub_queue)
+      where b.ev_id = any (x_event_ids)
+        and rq.ev_id is null;
+
+    GET DIAGNOSTICS _cnt = ROW_COUNT;
+    return _cnt;
+end;
+$$ language plpgsql security definer;
+
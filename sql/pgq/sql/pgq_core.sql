@@ -126,3 +126,26 @@ select * from pgq.maint_operations();
 update pgq.queue set queue_extra_maint = array['baz', 'foo.bar'];
 select * from pgq.maint_operations();
 
+-- test set-based retry in separate batch
+select pgq.create_queue('retryqueue');
+select pgq.register_consumer('retryqueue', 'consumer');
+update pgq.queue set queue_ticker_max_lag = '0' where queue_name = 'retryqueue';
+select pgq.insert_event('retryqueue', 'x1', 'data');
+select pgq.insert_event('retryqueue', 'x2', 'data');
+select pgq.insert_event('retryqueue', 'x3', 'data');
+select pgq.ticker('retryqueue') is not null as ticked;
+select pgq.next_batch('retryqueue', 'consumer') is not null as got_batch;
+select pgq.event_retry(sub_batch, array[1, 2]::int8[], 0)
+  from pgq.subscription join pgq.queue on (queue_id = sub_queue)
+ where queue_name = 'retryqueue';
+select pgq.event_retry(sub_batch, array[2, 3]::int8[], 0)
+  from pgq.subscription join pgq.queue on (queue_id = sub_queue)
+ where queue_name = 'retryqueue';
+select pgq.finish_batch(sub_batch)
+  from pgq.subscription join pgq.queue on (queue_id = sub_queue)
+ where queue_name = 'retryqueue';
+select ev_id, ev_retry, ev_type
+  from pgq.retry_queue join pgq.queue on (queue_id = ev_queue)
+ where queue_name = 'retryqueue'
+ order by ev_id;
+
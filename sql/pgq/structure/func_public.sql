@@ -24,6 +24,10 @@
 --    
 --         pgq.event_retry(batch_id int8, event_id int8, retry_seconds int4)
 --    
+--         or for several events at once
+--    
+--         pgq.event_retry(batch_id int8, event_ids int8[], retry_seconds int4)
+--    
 --    2e. To finish processing and release the batch, use
 --    
 --         pgq.finish_batch(batch_id int8)
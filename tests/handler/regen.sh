@@ -172,3 +172,97 @@ run_sql hdst 'select * from logtable order by id'
 
 ../zcheck.sh
 
+
+
+
+
+msg "== prepared statements =="
+
+msg "Create table on root node and fill couple of rows"
+run_sql hsrc "create table preptable (id int4 primary key, data text)"
+for n in 1 2 3; do
+  run_sql hsrc "insert into preptable values ($n, 'row$n')"
+done
+
+msg "Register table on root node"
+run londiste3 $v conf/londiste_hsrc.ini add-table preptable
+
+msg "Register table on other node with creation"
+run londiste3 $v conf/londiste_hdst.ini add-table preptable --create --handler=londiste --handler-arg="prepared=1"
+
+msg "Wait until table is in sync"
+cnt=0
+while test $cnt -ne 3; do
+  sleep 3
+  cnt=`psql -A -t -d hdst -c "select count(*) from londiste.table_info where merge_state = 'ok'"`
+  echo "  cnt=$cnt"
+done
+
+msg "Do updates in several batches, statements are prepared once per connection"
+for n in 4 5 6; do
+  run_sql hsrc "insert into preptable values ($n, 'row$n')"
+  run_sql hsrc "update preptable set data = 'row${n}x' where id = $n - 2"
+  run_sql hsrc "delete from preptable where id = $n - 3"
+  run sleep 6
+done
+
+msg "Check status"
+run londiste3 $v conf/londiste_hsrc.ini status
+
+run_sql hdst 'select * from preptable order by id'
+
+../zcheck.sh
+
+
+
+
+
+msg "== max_buffer =="
+
+msg "Create tables on root node"
+for tbl in bufbulk bufdisp; do
+  run_sql hsrc "create table $tbl (id int4 primary key, data text)"
+  run_sql hsrc "insert into $tbl values (9, 'row9')"
+  run londiste3 $v conf/londiste_hsrc.ini add-table $tbl
+done
+
+msg "Register tables on other node, with small buffer"
+run londiste3 $v conf/londiste_hdst.ini add-table bufbulk --create --handler=bulk --handler-arg="max_buffer=40"
+run londiste3 $v conf/londiste_hdst.ini add-table bufdisp --create --handler=bulk_direct --handler-arg="max_buffer=40"
+
+msg "Wait until tables are in sync"
+cnt=0
+while test $cnt -ne 5; do
+  sleep 3
+  cnt=`psql -A -t -d hdst -c "select count(*) from londiste.table_info where merge_state = 'ok'"`
+  echo "  cnt=$cnt"
+done
+
+msg "Change same rows in one batch, buffer gets flushed in between"
+for tbl in bufbulk bufdisp; do
+  run_sql hsrc "begin;
+    insert into $tbl values (1, 'row1');
+    update $tbl set data = 'row1x' where id = 1;
+    update $tbl set data = 'row9x' where id = 9;
+    insert into $tbl values (2, 'row2');
+    delete from $tbl where id = 1;
+    insert into $tbl values (1, 'row1y');
+    update $tbl set data = 'row2x' where id = 2;
+    delete from $tbl where id = 2;
+    delete from $tbl where id = 9;
+    insert into $tbl values (9, 'row9y');
+    insert into $tbl values (3, 'row3');
+    update $tbl set data = 'row3x' where id = 3;
+    commit;"
+done
+
+run sleep 10
+
+for tbl in bufbulk bufdisp; do
+  run_sql hdst "select * from $tbl order by id"
+  psql -A -t -d hsrc -c "select * from $tbl order by id" > log/$tbl.src
+  psql -A -t -d hdst -c "select * from $tbl order by id" > log/$tbl.dst
+  run diff -u log/$tbl.src log/$tbl.dst
+done
+
+../zcheck.sh
@@ -94,6 +94,14 @@ t_urldec = [
 regtest("db_urldecode/c", skytools._cquoting.db_urldecode, t_urldec)
 regtest("db_urldecode/py", skytools._pyquoting.db_urldecode, t_urldec)
 
+t_urldec_batch = [
+    [[], ((), [])],
+    [["a=1&b", "b=2&c=3", None], (('a', 'b', 'c'), [['1', None, None], [None, '2', None], [None, '3', None]])],
+    [["b=%41+&a=", u"a=x&&a=y"], (('b', 'a'), [['A ', None], ['', 'y']])],
+]
+regtest("decode_urlenc_batch/c", skytools._cquoting.decode_urlenc_batch, t_urldec_batch)
+regtest("decode_urlenc_batch/py", skytools._pyquoting.decode_urlenc_batch, t_urldec_batch)
+
 t_unesc = [
     ["", ""],
     ["\\N", "N"],
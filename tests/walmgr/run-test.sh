@@ -23,6 +23,35 @@ export PATH LANG
 
 mkdir log slave slave/logs.complete slave/logs.partial
 
+#
+# WAL compression round-trip
+#
+echo "### WAL compression round-trip ###"
+python - $src/../../python <<'EOF'
+import sys, os, random
+sys.path.insert(0, sys.argv[1])
+from walmgr import *
+
+# random head, zero tail, as in partially used segment
+random.seed(1)
+head = "".join([chr(random.randint(0, 255)) for i in range(3 * 8192 + 100)])
+f = open("wal.raw", "wb")
+f.write(head + "\0" * (XLOG_SEGMENT_SIZE - len(head)))
+f.close()
+
+size, csize = compress_wal("wal.raw", "wal.gz", 6)
+assert size == XLOG_SEGMENT_SIZE, size
+assert csize < len(head) + 1024, csize
+assert is_compressed_wal("wal.gz")
+assert not is_compressed_wal("wal.raw")
+
+decompress_wal("wal.gz", "wal.restored")
+assert os.path.getsize("wal.restored") == XLOG_SEGMENT_SIZE
+assert open("wal.restored", "rb").read() == open("wal.raw", "rb").read()
+print "compress: %d -> %d bytes, restored ok" % (size, csize)
+EOF
+rm -f wal.raw wal.gz wal.restored
+
 #
 # Prepare configs
 #
@@ -66,6 +95,186 @@ pg_ctl -l $tmp/log/pg.slave.log -D $tmp/data.slave "\$1"
 EOF
 chmod +x rc.slave
 
+#
+# Slave side cleanup marker and prefetch
+#
+echo "### WAL cleanup and prefetch ###"
+cat > wal.xrestore.ini <<EOF
+[walmgr]
+job_name             = wal-xrestore
+logfile              = $tmp/log/%(job_name)s.log
+slave                = $tmp/slave
+completed_wals       = %(slave)s/logs.complete
+partial_wals         = %(slave)s/logs.partial
+full_backup          = %(slave)s/data.master
+EOF
+python - $src/../../python $tmp <<'EOF'
+import sys, os
+sys.path.insert(0, sys.argv[1])
+tmp = sys.argv[2]
+from walmgr import *
+
+w = WalMgr([tmp + "/wal.xrestore.ini", "xrestore"])
+srcdir = w.cf.getfile("completed_wals")
+
+def seg(log, n):
+    return "00000001%08X%08X" % (log, n)
+
+def touch(dir, fn, data = "x"):
+    open(os.path.join(dir, fn), "w").write(data)
+
+# count directory scans done by walmgr
+real_listdir = os.listdir
+def listdir(dir):
+    return sorted(fn for fn in real_listdir(dir) if fn[0] != ".")
+scans = []
+def counting_listdir(dir):
+    scans.append(dir)
+    return real_listdir(dir)
+os.listdir = counting_listdir
+
+# first cleanup does full scan, also removes backup label
+cdir = tmp + "/cleanup"
+os.mkdir(cdir)
+for n in range(1, 16):
+    touch(cdir, seg(2, n))
+touch(cdir, seg(2, 1) + ".00000020.backup")
+w.del_wals(cdir, seg(2, 5))
+assert len(scans) == 1
+assert real_listdir(cdir).count(".walmgr_cleanup") == 1
+assert open(cdir + "/.walmgr_cleanup").read() == seg(2, 5)
+assert listdir(cdir) == [seg(2, n) for n in range(5, 16)]
+
+# same xlog id, only new segments removed, directory not listed
+touch(cdir, seg(2, 2))
+w.del_wals(cdir, seg(2, 8))
+assert len(scans) == 1
+assert open(cdir + "/.walmgr_cleanup").read() == seg(2, 8)
+assert listdir(cdir) == [seg(2, 2)] + [seg(2, n) for n in range(8, 16)]
+
+# new xlog id, full scan again
+touch(cdir, seg(3, 1))
+touch(cdir, seg(3, 2))
+w.del_wals(cdir, seg(3, 2))
+assert len(scans) == 2
+assert open(cdir + "/.walmgr_cleanup").read() == seg(3, 2)
+assert listdir(cdir) == [seg(3, 2)]
+os.listdir = real_listdir
+
+# prefetched file is used instead of source
+rdir = tmp + "/restore"
+pdir = rdir + "/.walmgr_prefetch"
+os.makedirs(pdir)
+touch(srcdir, seg(4, 1), "src1")
+touch(srcdir, seg(4, 2), "src2")
+touch(pdir, seg(4, 1), "prefetched1")
+dst = rdir + "/RECOVERYXLOG"
+w.slave_xrestore_unsafe(seg(4, 1), dst, os.getpid(), seg(4, 1))
+assert open(dst).read() == "prefetched1"
+assert not os.path.exists(os.path.join(pdir, seg(4, 1)))
+
+# next segment is prefetched in background and used by next restore
+os.wait()
+assert real_listdir(pdir) == [seg(4, 2)]
+assert open(os.path.join(pdir, seg(4, 2))).read() == "src2"
+os.remove(os.path.join(srcdir, seg(4, 2)))
+touch(srcdir, seg(4, 2), "changed2")
+w.slave_xrestore_unsafe(seg(4, 2), dst, os.getpid(), seg(4, 2))
+assert open(dst).read() == "src2"
+assert real_listdir(pdir) == []
+print "cleanup and prefetch ok"
+EOF
+rm -rf cleanup restore wal.xrestore.ini
+rm -f slave/logs.complete/* slave/logs.complete/.walmgr_cleanup
+
+#
+# Parallel backup split and hardlink breaking
+#
+echo "### Parallel backup ###"
+mkdir fakebin rsync.lists
+cat > fakebin/rsync <<EOF
+#! /bin/sh
+# record file lists, exit with given code for file copies
+for a in "\$@"; do
+  case "\$a" in
+  --files-from=*) cp "\${a#--files-from=}" $tmp/rsync.lists/list.\$\$
+                  exit \${FAKE_RSYNC_RC:-0};;
+  esac
+done
+EOF
+chmod +x fakebin/rsync
+cat > wal.backup.ini <<EOF
+[walmgr]
+job_name             = wal-backup
+logfile              = $tmp/log/%(job_name)s.log
+EOF
+PATH=$tmp/fakebin:$PATH python - $src/../../python $tmp <<'EOF'
+import sys, os
+sys.path.insert(0, sys.argv[1])
+tmp = sys.argv[2]
+from walmgr import *
+
+w = WalMgr([tmp + "/wal.backup.ini", "backup"])
+
+def mkfile(fn, size):
+    if not os.path.isdir(os.path.dirname(fn)):
+        os.makedirs(os.path.dirname(fn))
+    open(fn, "w").write("x" * size)
+
+src = tmp + "/bsrc"
+mkfile(src + "/base/1/a", 3000)
+mkfile(src + "/base/1/b", 2000)
+mkfile(src + "/base/1/c", 1000)
+mkfile(src + "/base/1/d", 500)
+mkfile(src + "/base/1/.hidden", 100)
+mkfile(src + "/base/pgsql_tmp/tmp1", 100)
+mkfile(src + "/global/g", 1500)
+roots = [(src, ["base", "global"], tmp + "/bdst", [])]
+
+def get_lists():
+    ldir = tmp + "/rsync.lists"
+    res = []
+    for fn in os.listdir(ldir):
+        res.append(sorted(open(os.path.join(ldir, fn)).read().split()))
+        os.remove(os.path.join(ldir, fn))
+    return sorted(res)
+
+# largest first, each to least loaded worker
+w.parallel_backup(roots, 2)
+lists = get_lists()
+assert lists == [["base/1/a", "base/1/c"],
+                 ["base/1/b", "base/1/d", "global/g"]], lists
+
+# files vanished after listing are not fatal
+os.environ["FAKE_RSYNC_RC"] = "23"
+w.parallel_backup(roots, 3)
+assert len(get_lists()) == 3
+
+# other errors are
+os.environ["FAKE_RSYNC_RC"] = "12"
+try:
+    w.parallel_backup(roots, 2)
+    assert False, "rsync error not noticed"
+except Exception, d:
+    assert str(d).startswith("rsync failed"), d
+get_lists()
+
+# files shared with older backup get own copies
+old = tmp + "/bk.0/base/1/f"
+new = tmp + "/bk/base/1/f"
+mkfile(old, 100)
+mkfile(tmp + "/bk/base/1/own", 100)
+os.link(old, new)
+w.break_hardlinks(tmp + "/bk")
+assert os.stat(new).st_nlink == 1
+assert os.stat(old).st_nlink == 1
+assert open(new).read() == "x" * 100
+open(new, "w").write("changed")
+assert open(old).read() == "x" * 100
+print "parallel backup ok"
+EOF
+rm -rf fakebin rsync.lists wal.backup.ini bsrc bdst bk bk.0
+
 #
 # Initialize master db
 #